@@ -0,0 +1,309 @@
+"""Headless HTTP/JSON API for the shopping assistant.
+
+Serves app.ChatService on an asyncio server, so the mobile client (or a load balancer
+in front of several processes) can chat and call tools without Streamlit. The event loop
+only parses and routes; blocking SQLite and LLM work runs in a bounded thread pool, with
+a timeout per request and a cap on requests admitted at once. Each session has its own
+user, cart and chat history:
+
+    python api_server.py --port 8000                       # Ollama when reachable, else patterns
+    python api_server.py --stand-in-llm --db :memory:      # offline and deterministic, for tests
+
+Endpoints (JSON bodies and responses):
+
+    GET    /health
+    POST   /sessions               {"user_id": "..."}                    -> {"session_id", "user_id"}
+    GET    /sessions/<id>/history
+    DELETE /sessions/<id>
+    POST   /chat                   {"message", "session_id", "mode"}     -> {"session_id", "reply", "stats"}
+    POST   /tools/<name>           {"session_id", ...tool arguments}     -> {"session_id", "text", "result"}
+
+mode is 'auto' (default), 'ai', 'hybrid' or 'pattern'; with --deadline, 'auto' turns race
+the LLM against that many seconds and answer from the pattern router if it is late. Tool
+names are app.SERVICE_TOOLS. /chat and /tools start a session for user1 when no session_id
+is given.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import re
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Callable, Dict, Optional, Tuple
+
+from app import (DB_PATH, SERVICE_TOOLS, BackgroundSemanticIndex, CachedLLM, ChatService, ChatSessionNotFound,
+                 CountingLLM, EcommerceDB, LLMScheduler)
+
+logger = logging.getLogger("api_server")
+
+MAX_BODY_BYTES = 1 << 20
+MAX_HEADER_LINES = 100
+# Idle keep-alive connections are closed after this many seconds
+KEEP_ALIVE_SECONDS = 15
+CHAT_MODES = ('auto', 'ai', 'hybrid', 'pattern')
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class ApiServer:
+    """Routes JSON requests to a ChatService, running its blocking calls in a thread pool.
+
+    A request that takes longer than request_timeout gets a 504; its worker thread still
+    finishes the call (threads can't be cancelled), and it keeps counting towards
+    max_pending until it does, so slow LLM calls can't pile up unboundedly.
+    """
+
+    def __init__(self, service: ChatService, workers: int = 8, request_timeout: float = 30.0,
+                 max_pending: int = 64):
+        self.service = service
+        self.request_timeout = request_timeout
+        self.max_pending = max_pending
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api-worker")
+        # Blocking calls running or queued for a worker; only touched on the event loop
+        self._pending = 0
+        self.routes = [
+            ('GET', re.compile(r'/health'), self.health),
+            ('POST', re.compile(r'/sessions'), self.create_session),
+            ('GET', re.compile(r'/sessions/(?P<session_id>[\w-]+)/history'), self.history),
+            ('DELETE', re.compile(r'/sessions/(?P<session_id>[\w-]+)'), self.end_session),
+            ('POST', re.compile(r'/chat'), self.chat),
+            ('POST', re.compile(r'/tools/(?P<name>\w+)'), self.tool),
+        ]
+
+    async def run_blocking(self, func: Callable, *args):
+        """Run func(*args) on the worker pool, bounded by max_pending and request_timeout"""
+        if self._pending >= self.max_pending:
+            raise HttpError(503, "server busy, retry later")
+        self._pending += 1
+        future = asyncio.get_running_loop().run_in_executor(self.pool, functools.partial(func, *args))
+        future.add_done_callback(self._release)
+        try:
+            # shield: a timeout abandons the wait, not the call (see class docstring)
+            return await asyncio.wait_for(asyncio.shield(future), self.request_timeout)
+        except asyncio.TimeoutError:
+            raise HttpError(504, f"request timed out after {self.request_timeout:g}s")
+
+    def _release(self, _future):
+        self._pending -= 1
+
+    # Handlers: (request, path parameters) -> JSON-serializable response
+
+    async def health(self, request: Dict, params: Dict) -> Dict:
+        return {
+            'status': 'ok',
+            'ai_available': await self.run_blocking(self.service.ai_available),
+            'sessions': self.service.session_count(),
+            'pending_requests': self._pending,
+        }
+
+    async def create_session(self, request: Dict, params: Dict) -> Dict:
+        user_id = request['json'].get('user_id', 'user1')
+        if not isinstance(user_id, str) or not user_id.strip():
+            raise HttpError(400, "user_id must be a non-empty string")
+        session = await self.run_blocking(self.service.create_session, user_id.strip())
+        return {'session_id': session.session_id, 'user_id': session.user_id}
+
+    async def history(self, request: Dict, params: Dict) -> Dict:
+        history = await self.run_blocking(self.service.history, params['session_id'])
+        return {'session_id': params['session_id'], 'history': history}
+
+    async def end_session(self, request: Dict, params: Dict) -> Dict:
+        return {'ended': self.service.end_session(params['session_id'])}
+
+    async def chat(self, request: Dict, params: Dict) -> Dict:
+        body = request['json']
+        message = body.get('message')
+        if not isinstance(message, str) or not message.strip():
+            raise HttpError(400, "message must be a non-empty string")
+        mode = body.get('mode', 'auto')
+        if mode not in CHAT_MODES:
+            raise HttpError(400, f"mode must be one of {', '.join(CHAT_MODES)}")
+        session_id = await self._session_id(body)
+        return await self.run_blocking(self.service.chat, session_id, message, mode)
+
+    async def tool(self, request: Dict, params: Dict) -> Dict:
+        if params['name'] not in SERVICE_TOOLS:
+            raise HttpError(404, f"unknown tool '{params['name']}'; use one of {', '.join(SERVICE_TOOLS)}")
+        arguments = dict(request['json'])
+        session_id = await self._session_id(arguments)
+        arguments.pop('session_id', None)
+        result = await self.run_blocking(self.service.call_tool, session_id, params['name'], arguments)
+        return {'session_id': session_id, **result}
+
+    async def _session_id(self, body: Dict) -> str:
+        session_id = body.get('session_id')
+        if session_id is None:
+            return (await self.run_blocking(self.service.create_session)).session_id
+        if not isinstance(session_id, str):
+            raise HttpError(400, "session_id must be a string")
+        return session_id
+
+    # HTTP plumbing
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), KEEP_ALIVE_SECONDS)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except HttpError as e:
+                    self._write_response(writer, e.status, {'error': str(e)}, keep_alive=False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                status, payload = await self._dispatch(request)
+                keep_alive = (request['version'] == 'HTTP/1.1'
+                              and request['headers'].get('connection', '').lower() != 'close')
+                self._write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader) -> Optional[Dict]:
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise HttpError(400, "malformed request line")
+
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            header = await reader.readline()
+            if header in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = header.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise HttpError(431, "too many headers")
+
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise HttpError(400, "invalid Content-Length")
+        if length > MAX_BODY_BYTES:
+            raise HttpError(413, f"body larger than {MAX_BODY_BYTES} bytes")
+        body = await reader.readexactly(length) if length else b''
+
+        url = urllib.parse.urlsplit(target)
+        return {'method': method.upper(), 'path': url.path.rstrip('/') or '/', 'version': version,
+                'headers': headers, 'body': body}
+
+    async def _dispatch(self, request: Dict) -> Tuple[int, Dict]:
+        allowed = []
+        for method, pattern, handler in self.routes:
+            match = pattern.fullmatch(request['path'])
+            if not match:
+                continue
+            if method != request['method']:
+                allowed.append(method)
+                continue
+            try:
+                request['json'] = self._parse_body(request['body'])
+                return 200, await handler(request, match.groupdict())
+            except HttpError as e:
+                return e.status, {'error': str(e)}
+            except ChatSessionNotFound as e:
+                return 404, {'error': f"session {e.args[0]} not found or expired"}
+            except ValueError as e:
+                return 400, {'error': str(e)}
+            except Exception:
+                logger.exception("error handling %s %s", request['method'], request['path'])
+                return 500, {'error': "internal server error"}
+        if allowed:
+            return 405, {'error': f"use {' or '.join(allowed)} for {request['path']}"}
+        return 404, {'error': f"no route for {request['path']}"}
+
+    @staticmethod
+    def _parse_body(body: bytes) -> Dict:
+        if not body:
+            return {}
+        try:
+            parsed = json.loads(body)
+        except ValueError:
+            raise HttpError(400, "body must be JSON")
+        if not isinstance(parsed, dict):
+            raise HttpError(400, "body must be a JSON object")
+        return parsed
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: int, payload: Dict, keep_alive: bool):
+        body = json.dumps(payload, default=str).encode()
+        head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8000) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8000):
+        server = await self.start(host, port)
+        logger.info("listening on http://%s:%d", host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown(wait=False)
+
+
+def build_service(db_path: str = DB_PATH, stand_in_llm: bool = False, llm_latency: float = 0.0,
+                  semantic: bool = True, hybrid_deadline: Optional[float] = None) -> ChatService:
+    """ChatService over db_path, with the offline stand-in LLM or Ollama (both behind an LLMScheduler)"""
+    db = EcommerceDB(db_path)
+    semantic_index = None
+    if semantic:
+        # Built in the background while the server starts answering with keyword search
+        semantic_index = BackgroundSemanticIndex(db)
+        semantic_index.get()
+    llm = None
+    if stand_in_llm:
+        from fake_llm import StandInLLM
+        llm = CachedLLM(CountingLLM(LLMScheduler(StandInLLM(latency=llm_latency))))
+    return ChatService(db, semantic_index, llm=llm, hybrid_deadline=hybrid_deadline)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--db', default=DB_PATH, help="SQLite database path (':memory:' for a throwaway catalog)")
+    parser.add_argument('--workers', type=int, default=8, help="threads for blocking database and LLM work")
+    parser.add_argument('--timeout', type=float, default=30.0, help="seconds before a request gets a 504")
+    parser.add_argument('--max-pending', type=int, default=64, help="requests admitted at once before 503s")
+    parser.add_argument('--stand-in-llm', action='store_true', help="answer with fake_llm.StandInLLM instead of Ollama")
+    parser.add_argument('--llm-latency', type=float, default=0.0, help="stand-in LLM seconds per call")
+    parser.add_argument('--no-semantic', action='store_true', help="keyword search only")
+    parser.add_argument('--deadline', type=float,
+                        help="seconds 'auto' chat turns wait for the LLM before answering from patterns")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    service = build_service(args.db, args.stand_in_llm, args.llm_latency, semantic=not args.no_semantic,
+                            hybrid_deadline=args.deadline)
+    server = ApiServer(service, workers=args.workers, request_timeout=args.timeout, max_pending=args.max_pending)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,30 @@
 import streamlit as st
+import hashlib
+import heapq
 import json
+import math
+import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+import weakref
+import urllib.request
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future
+from contextvars import ContextVar, copy_context
 from datetime import datetime
-from typing import Dict, List, Optional
-from dataclasses import dataclass
-from langchain_ollama import OllamaLLM
-from langchain.agents import Tool, initialize_agent, AgentType
-import pandas as pd
+from itertools import count, islice
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from dataclasses import asdict, dataclass, field
+from instrumentation import METRICS, count_cache, instrument, instrument_class, record_duration, span, timed_iter
+
+# LangChain, langchain_ollama, pandas and NumPy (via semantic_index) are imported where
+# they are first used, so pattern mode and the first page load don't pay for them
+if TYPE_CHECKING:
+    from semantic_index import SemanticIndex
 
 # Configuration
 
@@ -43,239 +61,1499 @@ class User:
     purchase_history: List[Dict]
 
 
+# Sample catalog loaded into new databases
+SAMPLE_PRODUCTS = [
+    Product("1", "iPhone 15 Pro", "Electronics", 999.99, "Latest iPhone with A17 Pro chip", 50, 4.8, ["smartphone", "apple", "premium"]),
+    Product("2", "Samsung Galaxy S24", "Electronics", 799.99, "Android flagship with AI features", 30, 4.7, ["smartphone", "samsung", "android"]),
+    Product("3", "MacBook Air M3", "Electronics", 1299.99, "Lightweight laptop with M3 chip", 25, 4.9, ["laptop", "apple", "m3"]),
+    Product("4", "Nike Air Max 270", "Fashion", 150.00, "Comfortable running shoes", 100, 4.5, ["shoes", "nike", "running"]),
+    Product("5", "Levi's 501 Jeans", "Fashion", 89.99, "Classic straight-fit jeans", 75, 4.4, ["jeans", "levis", "denim"]),
+    Product("6", "The Great Gatsby", "Books", 12.99, "Classic American novel", 200, 4.6, ["book", "classic", "fiction"]),
+    Product("7", "Instant Pot Duo 7-in-1", "Home & Kitchen", 79.99, "Multi-use pressure cooker", 40, 4.7, ["kitchen", "cooking", "appliance"]),
+    Product("8", "Dyson V15 Detect", "Home & Kitchen", 749.99, "Cordless vacuum with laser detection", 15, 4.8, ["vacuum", "dyson", "cordless"]),
+    Product("9", "PlayStation 5", "Electronics", 499.99, "Next-gen gaming console", 20, 4.9, ["gaming", "playstation", "console"]),
+    Product("10", "AirPods Pro 2", "Electronics", 249.99, "Noise-cancelling wireless earbuds", 60, 4.6, ["earbuds", "apple", "wireless"])
+]
+
+
 # Database setup
+
+# On-disk catalog shared by every Streamlit session (see get_shared_db)
+DB_PATH = os.environ.get("ECOMMERCE_DB_PATH", "ecommerce.db")
+
+
+# Triggers that keep products_fts in step with products (dropped during bulk_load)
+FTS_TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name, description, tags)
+        VALUES (new.rowid, new.name, new.description, new.tags);
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description, tags)
+        VALUES ('delete', old.rowid, old.name, old.description, old.tags);
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description, tags)
+        VALUES ('delete', old.rowid, old.name, old.description, old.tags);
+        INSERT INTO products_fts(rowid, name, description, tags)
+        VALUES (new.rowid, new.name, new.description, new.tags);
+    END;
+'''
+FTS_TRIGGER_NAMES = ('products_fts_insert', 'products_fts_delete', 'products_fts_update')
+
+# Trigram index of names, descriptions and tags for substring matches ('phone' in 'iPhone'),
+# kept in step the same way (dropped during bulk_load)
+TRIGRAM_TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS products_trigram_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_trigram(rowid, name, description, tags)
+        VALUES (new.rowid, new.name, new.description, new.tags);
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_trigram_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_trigram(products_trigram, rowid, name, description, tags)
+        VALUES ('delete', old.rowid, old.name, old.description, old.tags);
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_trigram_update AFTER UPDATE OF name, description, tags ON products BEGIN
+        INSERT INTO products_trigram(products_trigram, rowid, name, description, tags)
+        VALUES ('delete', old.rowid, old.name, old.description, old.tags);
+        INSERT INTO products_trigram(rowid, name, description, tags)
+        VALUES (new.rowid, new.name, new.description, new.tags);
+    END;
+'''
+TRIGRAM_TRIGGER_NAMES = ('products_trigram_insert', 'products_trigram_delete', 'products_trigram_update')
+
+# Shorter query words ('s' of "levi's", 'me') match too much to be worth searching for
+MIN_SEARCH_TERM_LENGTH = 3
+
+# Triggers that keep product_tags in step with products.tags (dropped during bulk_load)
+TAG_TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS products_tags_insert AFTER INSERT ON products BEGIN
+        INSERT OR IGNORE INTO product_tags SELECT new.id, TRIM(value), key FROM json_each(new.tags);
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_tags_delete AFTER DELETE ON products BEGIN
+        DELETE FROM product_tags WHERE product_id = old.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_tags_update AFTER UPDATE OF id, tags ON products BEGIN
+        DELETE FROM product_tags WHERE product_id = old.id;
+        INSERT OR IGNORE INTO product_tags SELECT new.id, TRIM(value), key FROM json_each(new.tags);
+    END;
+'''
+TAG_TRIGGER_NAMES = ('products_tags_insert', 'products_tags_delete', 'products_tags_update')
+
+# Products whose text changed or that were deleted, latest change last (one row per product),
+# so derived indexes such as SemanticIndex can catch up without rescanning the catalog.
+# New products are found by rowid instead. Kept live during bulk_load.
+CHANGE_TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS products_changes_delete AFTER DELETE ON products BEGIN
+        INSERT OR REPLACE INTO product_changes (product_id) VALUES (old.id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_changes_update
+    AFTER UPDATE OF id, name, category, description, tags ON products
+    WHEN (old.id, old.name, old.category, old.description, old.tags)
+         IS NOT (new.id, new.name, new.category, new.description, new.tags) BEGIN
+        INSERT OR REPLACE INTO product_changes (product_id) VALUES (old.id);
+        INSERT OR REPLACE INTO product_changes (product_id) VALUES (new.id);
+    END;
+'''
+
+# Product columns as read by _row_to_product: the tag list comes from product_tags joined with
+# the unit separator, which is cheaper to split than decoding products.tags as JSON
+PRODUCT_COLUMNS = '''
+    p.id, p.name, p.category, p.price, p.description, p.stock, p.rating,
+    (SELECT group_concat(tag, char(31)) FROM (
+        SELECT tag FROM product_tags WHERE product_id = p.id ORDER BY position
+    )) AS tag_list
+'''
+
+# Catalog statistics (category_stats, catalog_histograms) are kept current by triggers so
+# counts, stock totals and facets cost O(categories) instead of a catalog scan.
+# Price histogram bucket i covers [PRICE_BUCKETS[i], PRICE_BUCKETS[i + 1]); ratings bucket by whole star.
+PRICE_BUCKETS = [0, 25, 50, 100, 250, 500, 1000, 2500]
+
+
+def _stats_change(row: str, sign: int) -> str:
+    """Trigger statements adding (sign=1) or removing (sign=-1) products row `row` from the stats"""
+    price_bucket = ' + '.join(f'({row}.price >= {edge})' for edge in PRICE_BUCKETS[1:])
+    statements = [
+        f'''INSERT INTO category_stats VALUES ({row}.category, {sign}, {sign} * {row}.stock,
+               {sign} * ({row}.stock > 0), {sign} * {row}.price, {sign} * IFNULL({row}.rating, 0))
+           ON CONFLICT (category) DO UPDATE SET
+               product_count = product_count + excluded.product_count,
+               stock_total = stock_total + excluded.stock_total,
+               in_stock_count = in_stock_count + excluded.in_stock_count,
+               price_sum = price_sum + excluded.price_sum,
+               rating_sum = rating_sum + excluded.rating_sum;''',
+        f'''INSERT INTO catalog_histograms VALUES ({row}.category, 'price', {price_bucket}, {sign})
+           ON CONFLICT (category, facet, bucket) DO UPDATE SET count = count + excluded.count;''',
+        f'''INSERT INTO catalog_histograms VALUES ({row}.category, 'rating', CAST(IFNULL({row}.rating, 0) AS INTEGER), {sign})
+           ON CONFLICT (category, facet, bucket) DO UPDATE SET count = count + excluded.count;''',
+    ]
+    if sign < 0:
+        statements += [
+            f"DELETE FROM category_stats WHERE category = {row}.category AND product_count = 0;",
+            f"DELETE FROM catalog_histograms WHERE category = {row}.category AND count = 0;",
+        ]
+    return '\n'.join(statements)
+
+
+STATS_TRIGGERS = f'''
+    CREATE TRIGGER IF NOT EXISTS products_stats_insert AFTER INSERT ON products BEGIN
+        {_stats_change('new', 1)}
+        UPDATE catalog_meta SET value = value + 1 WHERE key = 'version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_stats_delete AFTER DELETE ON products BEGIN
+        {_stats_change('old', -1)}
+        UPDATE catalog_meta SET value = value + 1 WHERE key = 'version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_stats_update AFTER UPDATE OF category, price, stock, rating ON products BEGIN
+        {_stats_change('old', -1)}
+        {_stats_change('new', 1)}
+        UPDATE catalog_meta SET value = value + 1 WHERE key = 'version';
+    END;
+'''
+STATS_TRIGGER_NAMES = ('products_stats_insert', 'products_stats_delete', 'products_stats_update')
+
+# Recommendations: product_pairs counts how many users had two products in their cart or
+# wishlist together. Triggers bump the counts as items are added and mark the products
+# involved stale in recommendation_state, so adding to the cart stays a cheap write. A
+# background refresher, woken after cart / wishlist writes and every
+# RECOMMENDATION_REFRESH_SECONDS, recomputes only stale products' top-k rows in
+# product_neighbors; lookups are plain reads.
+RECOMMENDATION_NEIGHBORS = 10
+RECOMMENDATION_REFRESH_SECONDS = 60.0
+# Blend of co-occurrence (cosine over users) and tag-Jaccard similarity in a neighbour's score
+CO_OCCURRENCE_WEIGHT = 0.7
+TAG_SIMILARITY_WEIGHT = 0.3
+# Tags on more products than this are too generic to suggest neighbours (like stop words)
+TAG_SIMILARITY_MAX_PRODUCTS = 500
+
+
+def _pair_updates(table: str, other_table: str) -> str:
+    """Trigger for a new item in table: count it as co-occurring with the user's other items"""
+    user_items = '''(
+                SELECT product_id FROM cart_items WHERE user_id = new.user_id
+                UNION SELECT product_id FROM wishlist_items WHERE user_id = new.user_id
+            )'''
+    return f'''
+    CREATE TRIGGER IF NOT EXISTS {table}_pairs AFTER INSERT ON {table}
+    WHEN NOT EXISTS (SELECT 1 FROM {other_table} WHERE user_id = new.user_id AND product_id = new.product_id)
+    BEGIN
+        INSERT INTO product_pairs (product_id, other_id, count)
+            SELECT new.product_id, product_id, 1 FROM {user_items} WHERE product_id != new.product_id
+            ON CONFLICT (product_id, other_id) DO UPDATE SET count = count + 1;
+        INSERT INTO product_pairs (product_id, other_id, count)
+            SELECT product_id, new.product_id, 1 FROM {user_items} WHERE product_id != new.product_id
+            ON CONFLICT (product_id, other_id) DO UPDATE SET count = count + 1;
+        INSERT INTO recommendation_state (product_id, stale)
+            SELECT product_id, 1 FROM {user_items} WHERE true
+            ON CONFLICT (product_id) DO UPDATE SET stale = 1;
+    END;
+'''
+
+
+RECOMMENDATION_TRIGGERS = _pair_updates('cart_items', 'wishlist_items') + _pair_updates('wishlist_items', 'cart_items') + '''
+    CREATE TRIGGER IF NOT EXISTS products_neighbors_stale AFTER UPDATE OF tags ON products BEGIN
+        UPDATE recommendation_state SET stale = 1 WHERE product_id = new.id;
+    END;
+'''
+
+# Secondary indexes on products (rebuilt after bulk_load), backing the browse orders and
+# category + price / rating filters in search_products_page
+PRODUCT_INDEXES = {
+    'idx_products_rating': 'products(rating)',
+    'idx_products_price': 'products(price)',
+    'idx_products_category_rating': 'products(category, rating)',
+    'idx_products_category_price': 'products(category, price)',
+}
+
+# Keys accepted by the JSON form of the SearchProducts tool input
+SEARCH_ARGUMENTS = ('query', 'category', 'min_price', 'max_price', 'min_rating', 'in_stock', 'sort')
+
+# search_products sort options -> (products column, direction); 'relevance' is BM25 for text
+# queries and falls back to rating when browsing
+SEARCH_SORTS = {
+    'relevance': ('rating', 'DESC'),
+    'rating': ('rating', 'DESC'),
+    'price_asc': ('price', 'ASC'),
+    'price_desc': ('price', 'DESC'),
+}
+
+# Other names a model or client may give a SEARCH_SORTS option
+SORT_ALIASES = {
+    'price': 'price_asc', 'cheapest': 'price_asc', 'lowest_price': 'price_asc', 'price_low': 'price_asc',
+    'expensive': 'price_desc', 'highest_price': 'price_desc', 'price_high': 'price_desc',
+    'best_rated': 'rating', 'top_rated': 'rating', 'ratings': 'rating',
+    'best_match': 'relevance', 'default': 'relevance',
+}
+
+FLAG_VALUES = {'true': True, 'yes': True, '1': True, 'false': False, 'no': False, '0': False, '': False}
+
+
+def _execute_script(cursor, script: str):
+    """Run the statements of script one at a time with execute.
+
+    cursor.executescript would COMMIT first, ending the transaction of the _write() block it
+    runs in; statements run this way stay inside it and roll back with it.
+    """
+    statement = ''
+    for part in script.split(';'):
+        statement += part + ';'
+        # A trigger body has its own semicolons; wait for the statement to be complete
+        if sqlite3.complete_statement(statement):
+            if statement.strip(' \t\n;'):
+                cursor.execute(statement)
+            statement = ''
+    if statement.strip(' \t\n;'):
+        raise ValueError(f"incomplete SQL statement: {statement.strip()[:80]}")
+
+
+def _refresh_recommendations_loop(db_ref, wanted: threading.Event):
+    """Body of EcommerceDB's recommendation refresher; holds the database only while working"""
+    while True:
+        wanted.wait(RECOMMENDATION_REFRESH_SECONDS)
+        wanted.clear()
+        db = db_ref()
+        if db is None:
+            return
+        try:
+            unscored = db._take_unscored()
+            if unscored:
+                db.refresh_recommendations(unscored)
+            while db.refresh_recommendations():
+                pass
+        except sqlite3.Error as e:
+            # Still stale, so the next wake-up retries
+            db.recommendation_refresh_error = e
+        del db
+
+
+@instrument_class('db', exclude=('bulk_load',))
 class EcommerceDB:
+    """SQLite-backed catalog and user store.
+
+    With a file path the database runs in WAL mode: every thread reads through its own
+    connection while writes are serialized through a single writer connection (self.conn).
+    The default ':memory:' database has only one connection, so all access is serialized.
+    """
     
-    def __init__(self):
-        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+    def __init__(self, path: str = ':memory:', sample_data: bool = True):
+        self.path = path
+        self.in_memory = path == ':memory:'
+        # (catalog version, stats) from the last get_catalog_stats call
+        self._stats_cache = (None, None)
+        # Number of SQL statements issued, so callers can check per-view query budgets
+        self.query_count = 0
+        self._count_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        # Wakes the recommendation refresher (see schedule_recommendation_refresh); products
+        # looked up before they were ever scored wait in _unscored
+        self._refresh_wanted = threading.Event()
+        self._refresher: Optional[threading.Thread] = None
+        self._unscored: set = set()
+        self.recommendation_refresh_error: Optional[Exception] = None
+        self.conn = self._connect()
         self.set_database()
-        self.populate_sample_data()
+        if sample_data:
+            self.populate_sample_data()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.set_trace_callback(self._count_query)
+        if not self.in_memory:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _count_query(self, statement: str):
+        # Statements run by triggers are reported as '-- TRIGGER ...'; only count top-level ones
+        if not statement.startswith('--'):
+            with self._count_lock:
+                self.query_count += 1
+
+    @contextmanager
+    def _read(self):
+        """Cursor for read-only queries on this thread's connection"""
+        if self.in_memory:
+            with self._write_lock:
+                yield self.conn.cursor()
+            return
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        yield conn.cursor()
+
+    @contextmanager
+    def _write(self):
+        """Cursor on the writer connection; commits on success and rolls back on error"""
+        with self._write_lock:
+            cursor = self.conn.cursor()
+            try:
+                yield cursor
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
 
     def set_database(self):
-        cursor = self.conn.cursor()
-
-        # Products table
-
-        cursor.execute('''
-                    CREATE TABLE products (
-                       id TEXT PRIMARY KEY,
-                       name TEXT NOT NULL,
-                       category TEXT NOT NULL,
-                       price REAL NOT NULL,
-                       description TEXT,
-                       stock INTEGER NOT NULL,
-                       rating REAL,
-                       tags TEXT
-                       )
-                ''')
+        with self._write() as cursor:
+            # Products table
+
+            cursor.execute('''
+                        CREATE TABLE IF NOT EXISTS products (
+                           id TEXT PRIMARY KEY,
+                           name TEXT NOT NULL,
+                           category TEXT NOT NULL,
+                           price REAL NOT NULL,
+                           description TEXT,
+                           stock INTEGER NOT NULL,
+                           rating REAL,
+                           tags TEXT
+                           )
+                    ''')
         
-        # Users table
-
-        cursor.execute('''
-            CREATE TABLE users (
-                       id TEXT PRIMARY KEY,
-                       name TEXT NOT NULL,
-                       cart TEXT,
-                       wishlist TEXT,
-                       purchase_history TEXT
-                       )
-        ''')
-
-        self.conn.commit()
+            # Users table
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                           id TEXT PRIMARY KEY,
+                           name TEXT NOT NULL,
+                           cart TEXT,
+                           wishlist TEXT,
+                           purchase_history TEXT
+                           )
+            ''')
+
+            # Cart and wishlist line items (one row per user/product)
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS cart_items (
+                           user_id TEXT NOT NULL REFERENCES users(id),
+                           product_id TEXT NOT NULL REFERENCES products(id),
+                           quantity INTEGER NOT NULL CHECK (quantity > 0),
+                           added_at TEXT NOT NULL,
+                           PRIMARY KEY (user_id, product_id)
+                           )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS wishlist_items (
+                           user_id TEXT NOT NULL REFERENCES users(id),
+                           product_id TEXT NOT NULL REFERENCES products(id),
+                           added_at TEXT NOT NULL,
+                           PRIMARY KEY (user_id, product_id)
+                           )
+            ''')
+
+            for index, columns in PRODUCT_INDEXES.items():
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS {index} ON {columns}')
+
+            # Recommendations (see RECOMMENDATION_TRIGGERS)
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS product_pairs (
+                           product_id TEXT NOT NULL,
+                           other_id TEXT NOT NULL,
+                           count INTEGER NOT NULL,
+                           PRIMARY KEY (product_id, other_id)
+                           ) WITHOUT ROWID
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS product_neighbors (
+                           product_id TEXT NOT NULL,
+                           neighbor_id TEXT NOT NULL,
+                           score REAL NOT NULL,
+                           PRIMARY KEY (product_id, neighbor_id)
+                           ) WITHOUT ROWID
+            ''')
+            # Products whose neighbours were computed; stale = 1 once their pairs or tags change
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS recommendation_state (
+                           product_id TEXT PRIMARY KEY,
+                           stale INTEGER NOT NULL
+                           ) WITHOUT ROWID
+            ''')
+            # Users per product, for normalizing co-occurrence counts
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_cart_items_product ON cart_items(product_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_wishlist_items_product ON wishlist_items(product_id)')
+
+            # Tags, one row per product/tag (matched case-insensitively), kept in sync by triggers
+
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_tags'")
+            tags_exist = cursor.fetchone() is not None
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS product_tags (
+                           product_id TEXT NOT NULL REFERENCES products(id),
+                           tag TEXT NOT NULL COLLATE NOCASE,
+                           position INTEGER NOT NULL,
+                           PRIMARY KEY (product_id, tag)
+                           ) WITHOUT ROWID
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_tags_tag ON product_tags(tag, product_id)')
+            _execute_script(cursor, TAG_TRIGGERS)
+
+            # Catalog statistics, kept in sync by triggers
+
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'category_stats'")
+            stats_exist = cursor.fetchone() is not None
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS category_stats (
+                           category TEXT PRIMARY KEY,
+                           product_count INTEGER NOT NULL,
+                           stock_total INTEGER NOT NULL,
+                           in_stock_count INTEGER NOT NULL,
+                           price_sum REAL NOT NULL,
+                           rating_sum REAL NOT NULL
+                           )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS catalog_histograms (
+                           category TEXT NOT NULL,
+                           facet TEXT NOT NULL,
+                           bucket INTEGER NOT NULL,
+                           count INTEGER NOT NULL,
+                           PRIMARY KEY (category, facet, bucket)
+                           )
+            ''')
+            # Bumped on every catalog change; get_catalog_stats caches on it
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS catalog_meta (
+                           key TEXT PRIMARY KEY,
+                           value INTEGER NOT NULL
+                           )
+            ''')
+            cursor.execute("INSERT OR IGNORE INTO catalog_meta VALUES ('version', 0)")
+            _execute_script(cursor, STATS_TRIGGERS)
+            _execute_script(cursor, RECOMMENDATION_TRIGGERS)
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS product_changes (
+                           seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                           product_id TEXT NOT NULL UNIQUE
+                           )
+            ''')
+            _execute_script(cursor, CHANGE_TRIGGERS)
+
+            # Full-text index over products, kept in sync by triggers
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'")
+            fts_exists = cursor.fetchone() is not None
+            try:
+                cursor.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+                               name,
+                               description,
+                               tags,
+                               content='products',
+                               content_rowid='rowid',
+                               tokenize='porter unicode61'
+                               )
+                ''')
+                _execute_script(cursor, FTS_TRIGGERS)
+                self.fts_enabled = True
+                if not fts_exists:
+                    # Index the products of a database created before the index existed
+                    cursor.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+            except sqlite3.OperationalError:
+                # SQLite built without FTS5 - search_products falls back to LIKE scans
+                self.fts_enabled = False
+
+            self.trigram_enabled = False
+            if self.fts_enabled:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_trigram'")
+                trigram_exists = cursor.fetchone() is not None
+                try:
+                    cursor.execute('''
+                        CREATE VIRTUAL TABLE IF NOT EXISTS products_trigram USING fts5(
+                                   name,
+                                   description,
+                                   tags,
+                                   content='products',
+                                   content_rowid='rowid',
+                                   tokenize='trigram'
+                                   )
+                    ''')
+                    _execute_script(cursor, TRIGRAM_TRIGGERS)
+                    self.trigram_enabled = True
+                    if not trigram_exists:
+                        cursor.execute("INSERT INTO products_trigram(products_trigram) VALUES ('rebuild')")
+                except sqlite3.OperationalError:
+                    # SQLite before 3.34 has no trigram tokenizer - substrings are matched with LIKE
+                    pass
+
+        # Databases created before the tag and stats tables existed
+        if not tags_exist:
+            self.rebuild_product_tags()
+        if not stats_exist:
+            self.rebuild_catalog_stats()
+        self.migrate_user_blobs()
+
+    def migrate_user_blobs(self):
+        """Move legacy users.cart / users.wishlist JSON blobs into cart_items / wishlist_items.
+
+        Safe to run repeatedly: migrated blobs are reset to '[]' and existing rows are merged.
+        """
+        with self._write() as cursor:
+            cursor.execute("SELECT id, cart, wishlist FROM users WHERE cart NOT IN ('', '[]') OR wishlist NOT IN ('', '[]')")
+
+            for user_id, cart_blob, wishlist_blob in cursor.fetchall():
+                for item in json.loads(cart_blob or '[]'):
+                    cursor.execute(
+                        '''
+                            INSERT INTO cart_items (user_id, product_id, quantity, added_at) VALUES (?, ?, ?, ?)
+                            ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+                        ''', (user_id, item['product_id'], item['quantity'], item.get('added_at') or datetime.now().isoformat())
+                    )
+                for item in json.loads(wishlist_blob or '[]'):
+                    # Older rows stored bare product ids, newer ones {'product_id': ...}
+                    product_id = item['product_id'] if isinstance(item, dict) else item
+                    cursor.execute(
+                        'INSERT OR IGNORE INTO wishlist_items (user_id, product_id, added_at) VALUES (?, ?, ?)',
+                        (user_id, product_id, datetime.now().isoformat())
+                    )
+                cursor.execute("UPDATE users SET cart = '[]', wishlist = '[]' WHERE id = ?", (user_id,))
 
     def populate_sample_data(self):
-        sample_products = [
-            Product("1", "iPhone 15 Pro", "Electronics", 999.99, "Latest iPhone with A17 Pro chip", 50, 4.8, ["smartphone", "apple", "premium"]),
-            Product("2", "Samsung Galaxy S24", "Electronics", 799.99, "Android flagship with AI features", 30, 4.7, ["smartphone", "samsung", "android"]),
-            Product("3", "MacBook Air M3", "Electronics", 1299.99, "Lightweight laptop with M3 chip", 25, 4.9, ["laptop", "apple", "m3"]),
-            Product("4", "Nike Air Max 270", "Fashion", 150.00, "Comfortable running shoes", 100, 4.5, ["shoes", "nike", "running"]),
-            Product("5", "Levi's 501 Jeans", "Fashion", 89.99, "Classic straight-fit jeans", 75, 4.4, ["jeans", "levis", "denim"]),
-            Product("6", "The Great Gatsby", "Books", 12.99, "Classic American novel", 200, 4.6, ["book", "classic", "fiction"]),
-            Product("7", "Instant Pot Duo 7-in-1", "Home & Kitchen", 79.99, "Multi-use pressure cooker", 40, 4.7, ["kitchen", "cooking", "appliance"]),
-            Product("8", "Dyson V15 Detect", "Home & Kitchen", 749.99, "Cordless vacuum with laser detection", 15, 4.8, ["vacuum", "dyson", "cordless"]),
-            Product("9", "PlayStation 5", "Electronics", 499.99, "Next-gen gaming console", 20, 4.9, ["gaming", "playstation", "console"]),
-            Product("10", "AirPods Pro 2", "Electronics", 249.99, "Noise-cancelling wireless earbuds", 60, 4.6, ["earbuds", "apple", "wireless"])
-        ]
-
-        cursor = self.conn.cursor()
-
-        for product in sample_products:
-            cursor.execute(
-                '''
-                    INSERT INTO products VALUES (?,?,?,?,?, ?, ?, ?)
-                ''', (product.id, product.name, product.category, product.price, product.description, product.stock, product.rating, json.dumps(product.tags))
-            )
+        self.add_products(SAMPLE_PRODUCTS)
 
         # sample user
         sample_user = User("user1", "Ronnie Kakunguwo", [], [], [])
-        cursor.execute(
-            '''INSERT INTO users VALUES(?,?,?,?,?)''',
-            (sample_user.id, sample_user.name, json.dumps([]), json.dumps([]), json.dumps([]))
+        self.add_user(sample_user.id, sample_user.name)
+
+    @staticmethod
+    def _product_row(p: Product) -> Tuple:
+        return (p.id, p.name, p.category, p.price, p.description, p.stock, p.rating, json.dumps(p.tags))
+
+    def add_products(self, products: Iterable[Product], batch_size: int = 5000) -> int:
+        """Insert products with executemany, one transaction per batch; existing ids are kept.
+
+        Accepts any iterable (including generators), so large catalogs stream in constant memory.
+        Returns the number of rows inserted.
+        """
+        inserted = 0
+        products = iter(products)
+        while True:
+            batch = [self._product_row(p) for p in islice(products, batch_size)]
+            if not batch:
+                return inserted
+            with self._write() as cursor:
+                cursor.executemany('INSERT OR IGNORE INTO products VALUES (?,?,?,?,?, ?, ?, ?)', batch)
+                inserted += cursor.rowcount
+
+    def upsert_products(self, products: Iterable[Product], batch_size: int = 5000) -> int:
+        """Insert new products and update changed ones, one transaction per batch.
+
+        Rows whose fields all match the stored product are left alone, so re-importing a
+        catalog export only rewrites (and re-indexes) the SKUs that changed.
+        Returns the number of rows inserted or updated.
+        """
+        written = 0
+        products = iter(products)
+        while True:
+            batch = [self._product_row(p) for p in islice(products, batch_size)]
+            if not batch:
+                return written
+            with self._write() as cursor:
+                cursor.executemany(
+                    '''
+                        INSERT INTO products VALUES (?,?,?,?,?, ?, ?, ?)
+                        ON CONFLICT (id) DO UPDATE SET
+                            name = excluded.name, category = excluded.category, price = excluded.price,
+                            description = excluded.description, stock = excluded.stock,
+                            rating = excluded.rating, tags = excluded.tags
+                        WHERE (name, category, price, description, stock, rating, tags)
+                            IS NOT (excluded.name, excluded.category, excluded.price, excluded.description,
+                                    excluded.stock, excluded.rating, excluded.tags)
+                    ''', batch
+                )
+                written += cursor.rowcount
+
+    @contextmanager
+    def bulk_load(self):
+        """Defer index maintenance for a large load.
+
+        Drops the secondary indexes and the tag, statistics and full-text triggers for the duration
+        of the block, then rebuilds the indexes, product_tags, catalog stats and products_fts once
+        at the end, which is far cheaper than updating them row by row. Other writers are blocked
+        until the block exits; readers keep working but won't find new rows by text search until
+        the rebuild.
+        """
+        with self._write_lock:
+            with self._write() as cursor:
+                for index in PRODUCT_INDEXES:
+                    cursor.execute(f'DROP INDEX IF EXISTS {index}')
+                for trigger in TAG_TRIGGER_NAMES + STATS_TRIGGER_NAMES:
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+                if self.fts_enabled:
+                    for trigger in FTS_TRIGGER_NAMES:
+                        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+                if self.trigram_enabled:
+                    for trigger in TRIGRAM_TRIGGER_NAMES:
+                        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+            try:
+                yield self
+            finally:
+                with self._write() as cursor:
+                    for index, columns in PRODUCT_INDEXES.items():
+                        cursor.execute(f'CREATE INDEX IF NOT EXISTS {index} ON {columns}')
+                    _execute_script(cursor, TAG_TRIGGERS)
+                    _execute_script(cursor, STATS_TRIGGERS)
+                    if self.fts_enabled:
+                        _execute_script(cursor, FTS_TRIGGERS)
+                        cursor.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+                    if self.trigram_enabled:
+                        _execute_script(cursor, TRIGRAM_TRIGGERS)
+                        cursor.execute("INSERT INTO products_trigram(products_trigram) VALUES ('rebuild')")
+                self.rebuild_product_tags()
+                self.rebuild_catalog_stats()
+                with self._write() as cursor:
+                    # Tags may have changed under the loaded products
+                    cursor.execute('UPDATE recommendation_state SET stale = 1')
+                self.schedule_recommendation_refresh()
+
+    def rebuild_product_tags(self):
+        """Repopulate product_tags from the products.tags JSON arrays"""
+        with self._write() as cursor:
+            cursor.execute('DELETE FROM product_tags')
+            cursor.execute('''
+                INSERT OR IGNORE INTO product_tags
+                SELECT p.id, TRIM(t.value), t.key FROM products p, json_each(p.tags) t
+            ''')
+
+    def rebuild_catalog_stats(self):
+        """Recompute category_stats and catalog_histograms from scratch (one pass per table)"""
+        price_bucket = ' + '.join(f'(price >= {edge})' for edge in PRICE_BUCKETS[1:])
+        with self._write() as cursor:
+            cursor.execute('DELETE FROM category_stats')
+            cursor.execute('''
+                INSERT INTO category_stats
+                SELECT category, COUNT(*), SUM(stock), SUM(stock > 0), SUM(price), SUM(IFNULL(rating, 0))
+                FROM products GROUP BY category
+            ''')
+            cursor.execute('DELETE FROM catalog_histograms')
+            cursor.execute(f'''
+                INSERT INTO catalog_histograms
+                SELECT category, 'price', {price_bucket} AS bucket, COUNT(*) FROM products GROUP BY category, bucket
+                UNION ALL
+                SELECT category, 'rating', CAST(IFNULL(rating, 0) AS INTEGER) AS bucket, COUNT(*) FROM products
+                GROUP BY category, bucket
+            ''')
+            cursor.execute("UPDATE catalog_meta SET value = value + 1 WHERE key = 'version'")
+
+    def add_user(self, user_id: str, name: str) -> bool:
+        with self._write() as cursor:
+            cursor.execute(
+                '''INSERT OR IGNORE INTO users VALUES(?,?,?,?,?)''',
+                (user_id, name, json.dumps([]), json.dumps([]), json.dumps([]))
+            )
+            return cursor.rowcount > 0
+
+    @staticmethod
+    def _row_to_product(row) -> Dict:
+        return {'id': row[0], 'name': row[1], 'category': row[2], 'price': row[3],
+                'description': row[4], 'stock': row[5], 'rating': row[6],
+                'tags': row[7].split('\x1f') if row[7] else []}
+
+    @staticmethod
+    def _like_filter(query: str) -> Tuple[str, List]:
+        """WHERE clause for the non-FTS fallback: substring of name/description, or an exact tag"""
+        return (
+            '(p.name LIKE ? OR p.description LIKE ? OR '
+            'EXISTS (SELECT 1 FROM product_tags t WHERE t.product_id = p.id AND t.tag = ?))',
+            [f'%{query}%', f'%{query}%', query]
         )
 
-        self.conn.commit()
-
-    def search_products(self, query: str, category: str = None) -> List[Dict]:
-        cursor = self.conn.cursor()
-
+    @staticmethod
+    def _search_terms(query: str) -> List[str]:
+        """Words of query worth searching for, e.g. "levi's jeans" -> ['levi', 'jeans']"""
+        return [term for term in re.findall(r'\w+', query.lower()) if len(term) >= MIN_SEARCH_TERM_LENGTH]
+
+    @staticmethod
+    def _fts_query(terms: List[str]) -> str:
+        """FTS5 query matching any of terms, e.g. ['running', 'shoes'] -> '"running" OR "shoes"'"""
+        return ' OR '.join(f'"{term}"' for term in terms)
+
+    def _substring_rowids(self, terms: List[str]) -> Tuple[str, List]:
+        """Subquery of product rowids whose name, description or tags contain any of terms"""
+        if self.trigram_enabled:
+            return 'SELECT rowid FROM products_trigram WHERE products_trigram MATCH ?', [self._fts_query(terms)]
+        likes = ' OR '.join(['name LIKE ? OR description LIKE ? OR tags LIKE ?'] * len(terms))
+        return f'SELECT rowid FROM products WHERE {likes}', [f'%{term}%' for term in terms for _ in range(3)]
+
+    def _matching_rowids(self, terms: List[str]) -> Tuple[str, List]:
+        """Subquery of product rowids matching any of terms as a (stemmed) word or a substring"""
+        substring_sql, substring_params = self._substring_rowids(terms)
+        return (f'SELECT rowid FROM products_fts WHERE products_fts MATCH ? UNION {substring_sql}',
+                [self._fts_query(terms)] + substring_params)
+
+    def search_products(self, query: str, category: str = None, limit: Optional[int] = None,
+                        **filters) -> List[Dict]:
+        """Search products by relevance (BM25 over name, description and tags).
+
+        Words also match inside longer ones ('phone' finds iPhone), ranked after whole-word hits.
+
+        An empty query lists every product (optionally within a category) ordered by rating.
+        Accepts the same price / rating / stock filters and sort as search_products_page.
+        """
+        return self.search_products_page(query, category, limit, **filters)[0]
+
+    def search_products_page(self, query: str, category: str = None, limit: Optional[int] = None,
+                             after: Optional[Tuple] = None, min_price: Optional[float] = None,
+                             max_price: Optional[float] = None, min_rating: Optional[float] = None,
+                             in_stock: bool = False, sort: str = 'relevance') -> Tuple[List[Dict], Optional[Tuple]]:
+        """One page of search_products results and the cursor for the next page (None on the last).
+
+        Results can be narrowed to a price range, a minimum rating and in-stock products, and
+        sorted by any of SEARCH_SORTS; 'relevance' means BM25 for text queries and rating when
+        browsing. Pages are keyset-based: pass the returned cursor back as `after` (with the same
+        query, filters and sort) and the query resumes from the last row's sort key instead of
+        skipping rows. Browsing walks the (category,) rating / price indexes, so every page costs
+        the same; text search still finds all matches but only builds dicts for the page.
+        """
+        if sort not in SEARCH_SORTS:
+            raise ValueError(f"Unknown sort {sort!r}; use one of {', '.join(SEARCH_SORTS)}")
+
+        conditions, params = [], []
         if category:
+            conditions.append('p.category = ?')
+            params.append(category)
+        if min_price is not None:
+            conditions.append('p.price >= ?')
+            params.append(min_price)
+        if max_price is not None:
+            conditions.append('p.price <= ?')
+            params.append(max_price)
+        if min_rating is not None:
+            conditions.append('p.rating >= ?')
+            params.append(min_rating)
+        if in_stock:
+            conditions.append('p.stock > 0')
+
+        query = query.strip()
+        terms = self._search_terms(query)
+        if terms and self.fts_enabled:
+            if sort == 'relevance':
+                return self._relevance_page(terms, conditions, params, limit, after)
+            rowids, rowid_params = self._matching_rowids(terms)
+            conditions.insert(0, f'p.rowid IN ({rowids})')
+            params[:0] = rowid_params
+        elif query:
+            condition, like_params = self._like_filter(query)
+            conditions.append(condition)
+            params += like_params
+
+        # Keyset on (sort column, rowid), both in the same direction so a row-value comparison
+        # can seek the index
+        column, direction = SEARCH_SORTS[sort]
+        if after:
+            conditions.append(f"(p.{column}, p.rowid) {'<' if direction == 'DESC' else '>'} (?, ?)")
+            params += list(after)
+
+        sql = f'SELECT {PRODUCT_COLUMNS}, p.{column}, p.rowid FROM products p'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += f' ORDER BY p.{column} {direction}, p.rowid {direction} LIMIT ?'
+
+        rows = self._fetch_page(sql, params, limit)
+        return self._page(rows, limit, lambda row: (row[8], row[9]))
+
+    def _relevance_page(self, terms: List[str], conditions: List[str], params: List, limit: Optional[int],
+                        after: Optional[Tuple]) -> Tuple[List[Dict], Optional[Tuple]]:
+        # Name hits weigh most, then tags, then description; substring-only hits score 0 and so
+        # rank after every word hit (bm25 scores are negative)
+        substring_sql, substring_params = self._substring_rowids(terms)
+        sql = f'''
+            SELECT * FROM (
+                SELECT {PRODUCT_COLUMNS}, p.rowid AS rid, MIN(hits.score) AS score
+                FROM (
+                    SELECT rowid, bm25(products_fts, 10.0, 1.0, 5.0) AS score
+                    FROM products_fts WHERE products_fts MATCH ?
+                    UNION ALL
+                    SELECT rowid, 0.0 FROM ({substring_sql})
+                ) hits
+                JOIN products p ON p.rowid = hits.rowid
+        '''
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' GROUP BY p.rowid)'
+        params = [self._fts_query(terms)] + substring_params + params
+        if after:
+            score, rating, rid = after
+            sql += ' WHERE score > ? OR (score = ? AND (rating < ? OR (rating = ? AND rid < ?)))'
+            params += [score, score, rating, rating, rid]
+        sql += ' ORDER BY score, rating DESC, rid DESC LIMIT ?'
+
+        rows = self._fetch_page(sql, params, limit)
+        return self._page(rows, limit, lambda row: (row[9], row[6], row[8]))
+
+    def search_by_tags(self, all_of: Iterable[str] = (), any_of: Iterable[str] = (), category: str = None,
+                       limit: Optional[int] = None) -> List[Dict]:
+        """Products carrying every tag in all_of and at least one in any_of, best rated first.
+
+        Tags match whole and case-insensitively through the product_tags index.
+        """
+        all_of, any_of = list(dict.fromkeys(t.lower() for t in all_of)), list(any_of)
+        conditions, params = [], []
+        if all_of:
+            conditions.append('''p.id IN (
+                SELECT product_id FROM product_tags WHERE tag IN (SELECT value FROM json_each(?))
+                GROUP BY product_id HAVING COUNT(*) = ?
+            )''')
+            params += [json.dumps(all_of), len(all_of)]
+        if any_of:
+            conditions.append('p.id IN (SELECT product_id FROM product_tags WHERE tag IN (SELECT value FROM json_each(?)))')
+            params.append(json.dumps(any_of))
+        if category:
+            conditions.append('p.category = ?')
+            params.append(category)
+
+        sql = f'SELECT {PRODUCT_COLUMNS} FROM products p'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY p.rating DESC, p.rowid DESC LIMIT ?'
+
+        with self._read() as cursor:
+            cursor.execute(sql, params + [limit if limit is not None else -1])
+            return [self._row_to_product(r) for r in cursor.fetchall()]
+
+    def _fetch_page(self, sql: str, params: List, limit: Optional[int]) -> List[Tuple]:
+        # One extra row tells us whether there is a next page; -1 means no limit
+        with self._read() as cursor:
+            cursor.execute(sql, params + [limit + 1 if limit is not None else -1])
+            return cursor.fetchall()
+
+    def _page(self, rows: List[Tuple], limit: Optional[int], sort_key) -> Tuple[List[Dict], Optional[Tuple]]:
+        if limit is None or len(rows) <= limit:
+            return [self._row_to_product(r) for r in rows], None
+        rows = rows[:limit]
+        return [self._row_to_product(r) for r in rows], sort_key(rows[-1])
+
+    def count_products(self) -> int:
+        return self.get_catalog_stats()['total_products']
+
+    def get_catalog_stats(self) -> Dict:
+        """Per-category counts, stock totals, averages and price / rating histograms.
+
+        Read from the trigger-maintained stats tables and cached until the catalog version
+        changes, so a call with nothing changed is a single primary-key lookup.
+        """
+        with self._read() as cursor:
+            cursor.execute("SELECT value FROM catalog_meta WHERE key = 'version'")
+            version = cursor.fetchone()[0]
+            cached_version, stats = self._stats_cache
+            count_cache('catalog_stats', version == cached_version)
+            if version == cached_version:
+                return stats
+
+            cursor.execute('SELECT * FROM category_stats ORDER BY category')
+            categories = {
+                category: {'products': count, 'stock': stock, 'in_stock': in_stock,
+                           'avg_price': price_sum / count, 'avg_rating': rating_sum / count}
+                for category, count, stock, in_stock, price_sum, rating_sum in cursor.fetchall()
+            }
+            price_labels = [f"${low}-{high}" for low, high in zip(PRICE_BUCKETS, PRICE_BUCKETS[1:])]
+            price_labels.append(f"${PRICE_BUCKETS[-1]}+")
+            histograms = {'price': dict.fromkeys(price_labels, 0), 'rating': {f"{star}★": 0 for star in range(6)}}
+            cursor.execute('SELECT facet, bucket, SUM(count) FROM catalog_histograms GROUP BY facet, bucket')
+            for facet, bucket, count in cursor.fetchall():
+                labels = list(histograms[facet])
+                histograms[facet][labels[min(bucket, len(labels) - 1)]] += count
+
+        stats = {
+            'version': version,
+            'total_products': sum(c['products'] for c in categories.values()),
+            'total_stock': sum(c['stock'] for c in categories.values()),
+            'categories': categories,
+            'price_histogram': histograms['price'],
+            'rating_histogram': histograms['rating'],
+        }
+        self._stats_cache = (version, stats)
+        return stats
+
+    def category_facets(self, query: str = "") -> Dict[str, int]:
+        """Number of products per category matching query (every product when query is empty)"""
+        if not query.strip():
+            return {category: c['products'] for category, c in self.get_catalog_stats()['categories'].items()}
+        terms = self._search_terms(query)
+        if terms and self.fts_enabled:
+            rowids, params = self._matching_rowids(terms)
+            sql = f'''
+                SELECT p.category, COUNT(*) FROM products p
+                WHERE p.rowid IN ({rowids}) GROUP BY p.category ORDER BY p.category
+            '''
+        else:
+            condition, params = self._like_filter(query.strip())
+            sql = f'SELECT p.category, COUNT(*) FROM products p WHERE {condition} GROUP BY p.category ORDER BY p.category'
+        with self._read() as cursor:
+            cursor.execute(sql, params)
+            return dict(cursor.fetchall())
+    
+    def get_product(self, product_id: str) -> Optional[Dict]:
+        return self.get_products([product_id]).get(product_id)
+
+    def get_products(self, product_ids: List[str]) -> Dict[str, Dict]:
+        """Fetch several products in one query, keyed by product id (unknown ids are omitted)"""
+        if not product_ids:
+            return {}
+        with self._read() as cursor:
+            # Ids travel as one JSON array parameter, so the statement never hits SQLite's variable limit
             cursor.execute(
-                '''
-                    SELECT * FROM products
-                    WHERE (name LIKE ? OR description LIKE ? OR tags LIKE ?)
-                    AND category = ?
-                    ORDER BY rating DESC
-                ''', (f'%{query}%', f'%{query}%', f'%{query}%', category)
+                f'SELECT {PRODUCT_COLUMNS} FROM products p WHERE p.id IN (SELECT value FROM json_each(?))',
+                (json.dumps([str(product_id) for product_id in product_ids]),)
             )
-        else:
+            return {row[0]: self._row_to_product(row) for row in cursor.fetchall()}
+    
+    def get_products_after(self, rowid: int, limit: int = 5000) -> List[Tuple[int, Dict]]:
+        """(rowid, product) for up to `limit` products inserted after rowid, oldest first"""
+        with self._read() as cursor:
             cursor.execute(
-                '''
-                    SELECT * FROM products
-                    WHERE name LIKE ? OR description LIKE ? OR tags LIKE ?
-                    ORDER BY rating DESC
-                ''', (f'%{query}%', f'%{query}%', f'%{query}%')
+                f'SELECT p.rowid, {PRODUCT_COLUMNS} FROM products p WHERE p.rowid > ? ORDER BY p.rowid LIMIT ?',
+                (rowid, limit)
             )
-        
-        results = cursor.fetchall()
+            return [(row[0], self._row_to_product(row[1:])) for row in cursor.fetchall()]
 
-        return [
-            {'id': r[0], 'name': r[1], 'category': r[2], 'price': r[3], 'description': r[4], 'stock': r[5], 'rating': r[6], 'tags': json.loads(r[7])} for r in results
-        ]
-    
-    def get_product(self, product_id: str) -> Optional[Dict]:
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM products WHERE id = ?', (product_id,))
-        result = cursor.fetchone()
-        if result:
-            return {'id': result[0], 'name': result[1], 'category': result[2], 
-                   'price': result[3], 'description': result[4], 'stock': result[5], 
-                   'rating': result[6], 'tags': json.loads(result[7])}
-        return None
+    def get_product_changes_after(self, seq: int, limit: int = 5000) -> List[Tuple[int, str, Optional[Dict]]]:
+        """(seq, product id, current product or None if deleted) for up to `limit` products
+        updated or deleted after change seq, oldest change first"""
+        with self._read() as cursor:
+            cursor.execute(
+                f'''SELECT c.seq, c.product_id, {PRODUCT_COLUMNS} FROM product_changes c
+                    LEFT JOIN products p ON p.id = c.product_id WHERE c.seq > ? ORDER BY c.seq LIMIT ?''',
+                (seq, limit)
+            )
+            return [(row[0], row[1], self._row_to_product(row[2:]) if row[2] is not None else None)
+                    for row in cursor.fetchall()]
+
+    def last_product_change(self) -> int:
+        """Seq of the latest product_changes entry (0 if none)"""
+        with self._read() as cursor:
+            cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM product_changes')
+            return cursor.fetchone()[0]
     
     def get_user_cart(self, user_id: str) -> List[Dict]:
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT cart FROM users WHERE id = ?', (user_id,))
-        result = cursor.fetchone()
-        if result:
-            cart_items = json.loads(result[0])
-            detailed_cart = []
-            for item in cart_items:
-                product = self.get_product(item['product_id'])
-                if product:
-                    detailed_cart.append({
-                        'product': product,
-                        'quantity': item['quantity'],
-                        'added_at': item['added_at']
-                    })
-            return detailed_cart
-        return []
+        with self._read() as cursor:
+            cursor.execute(
+                'SELECT product_id, quantity, added_at FROM cart_items WHERE user_id = ? ORDER BY added_at',
+                (user_id,)
+            )
+            rows = cursor.fetchall()
+        products = self.get_products([row[0] for row in rows])
+        detailed_cart = []
+        for product_id, quantity, added_at in rows:
+            product = products.get(product_id)
+            if product:
+                detailed_cart.append({
+                    'product': product,
+                    'quantity': quantity,
+                    'added_at': added_at
+                })
+        return detailed_cart
     
     def get_user_wishlist(self, user_id: str) -> List[Dict]:
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT wishlist FROM users WHERE id = ?', (user_id))
-        result = cursor.fetchone()
-        if result:
-            wishlist_items = json.loads(result[0])
-            detailed_wishlist = []
-            for item in wishlist_items:
-                product = self.get_product(item['product_id'])
-                if product:
-                    detailed_wishlist.append({
-                        'product': product
-                    })
-            return detailed_wishlist
-        return []
+        with self._read() as cursor:
+            cursor.execute(
+                'SELECT product_id, added_at FROM wishlist_items WHERE user_id = ? ORDER BY added_at',
+                (user_id,)
+            )
+            rows = cursor.fetchall()
+        products = self.get_products([row[0] for row in rows])
+        detailed_wishlist = []
+        for product_id, added_at in rows:
+            product = products.get(product_id)
+            if product:
+                detailed_wishlist.append({
+                    'product': product,
+                    'added_at': added_at
+                })
+        return detailed_wishlist
     
 
     def add_to_cart(self, user_id: str, product_id: str, quantity: int = 1):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT cart FROM users WHERE id = ?', (user_id,))
-        result = cursor.fetchone()
-        if result:
-            cart = json.loads(result[0])
-            # Check if product already in cart
-            for item in cart:
-                if item['product_id'] == product_id:
-                    item['quantity'] += quantity
-                    break
-            else:
-                cart.append({
-                    'product_id': product_id,
-                    'quantity': quantity,
-                    'added_at': datetime.now().isoformat()
-                })
-            
-            cursor.execute('UPDATE users SET cart = ? WHERE id = ?', 
-                         (json.dumps(cart), user_id))
-            self.conn.commit()
-            return True
-        return False
+        with self._write() as cursor:
+            # Single-row upsert: concurrent adds of the same product accumulate instead of overwriting
+            cursor.execute(
+                '''
+                    INSERT INTO cart_items (user_id, product_id, quantity, added_at)
+                    SELECT id, ?, ?, ? FROM users WHERE id = ?
+                    ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+                ''', (product_id, quantity, datetime.now().isoformat(), user_id)
+            )
+            added = cursor.rowcount > 0
+        if added:
+            self.schedule_recommendation_refresh()
+        return added
     
 
     def add_to_wishlist(self, user_id: str, product_id: str):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT wishlist FROM users WHERE id = ?', (user_id,))
-        result = cursor.fetchone()
-        if result:
-            wishlist = json.loads(result[0])
-            if product_id not in wishlist:
-                wishlist.append(product_id)
-                cursor.execute('UPDATE users SET wishlist = ? WHERE id = ?', 
-                             (json.dumps(wishlist), user_id))
-                self.conn.commit()
-            return True
-        return False
+        with self._write() as cursor:
+            cursor.execute(
+                '''
+                    INSERT INTO wishlist_items (user_id, product_id, added_at)
+                    SELECT id, ?, ? FROM users WHERE id = ?
+                    ON CONFLICT (user_id, product_id) DO UPDATE SET added_at = wishlist_items.added_at
+                ''', (product_id, datetime.now().isoformat(), user_id)
+            )
+            added = cursor.rowcount > 0
+        if added:
+            self.schedule_recommendation_refresh()
+        return added
+
+    def schedule_recommendation_refresh(self, product_ids: Iterable[str] = ()):
+        """Wake the background refresher (starting it on first use), optionally to score product_ids.
+
+        The refresher runs refresh_recommendations until nothing is stale, then sleeps until
+        the next call or RECOMMENDATION_REFRESH_SECONDS, whichever comes first.
+        """
+        with self._count_lock:
+            self._unscored.update(str(product_id) for product_id in product_ids)
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=_refresh_recommendations_loop,
+                                                   args=(weakref.ref(self), self._refresh_wanted),
+                                                   name="recommendations", daemon=True)
+                self._refresher.start()
+        self._refresh_wanted.set()
+
+    def _take_unscored(self) -> List[str]:
+        with self._count_lock:
+            unscored, self._unscored = list(self._unscored), set()
+            return unscored
+
+    def refresh_recommendations(self, product_ids: Optional[List[str]] = None, batch_size: int = 500) -> int:
+        """Recompute product_neighbors for stale products (or for product_ids not yet current).
+
+        Returns the number of products recomputed; at most batch_size stale products per call.
+        """
+        with self._read() as cursor:
+            if product_ids is None:
+                cursor.execute('SELECT product_id FROM recommendation_state WHERE stale = 1 LIMIT ?', (batch_size,))
+            else:
+                cursor.execute(
+                    '''
+                        SELECT value FROM json_each(?)
+                        WHERE NOT EXISTS (SELECT 1 FROM recommendation_state WHERE product_id = value AND stale = 0)
+                    ''', (json.dumps([str(product_id) for product_id in product_ids]),)
+                )
+            pending = [row[0] for row in cursor.fetchall()]
+        if not pending:
+            return 0
+
+        with self._write() as cursor:
+            for product_id in pending:
+                neighbors = self._score_neighbors(cursor, product_id)
+                cursor.execute('DELETE FROM product_neighbors WHERE product_id = ?', (product_id,))
+                cursor.executemany('INSERT INTO product_neighbors VALUES (?, ?, ?)',
+                                   [(product_id, neighbor_id, score) for neighbor_id, score in neighbors])
+                cursor.execute(
+                    '''
+                        INSERT INTO recommendation_state VALUES (?, 0)
+                        ON CONFLICT (product_id) DO UPDATE SET stale = 0
+                    ''', (product_id,)
+                )
+        return len(pending)
+
+    @staticmethod
+    def _score_neighbors(cursor, product_id: str) -> List[Tuple[str, float]]:
+        """Top RECOMMENDATION_NEIGHBORS (neighbor id, score) pairs for one product"""
+        # Co-occurrence as cosine similarity: shared users / sqrt(users of each product)
+        cursor.execute(
+            '''
+                SELECT pairs.other_id, pairs.count, (
+                    SELECT COUNT(*) FROM (
+                        SELECT user_id FROM cart_items WHERE product_id = pairs.other_id
+                        UNION SELECT user_id FROM wishlist_items WHERE product_id = pairs.other_id
+                    )
+                )
+                FROM product_pairs pairs WHERE pairs.product_id = ?
+            ''', (product_id,)
+        )
+        pairs = cursor.fetchall()
+        cursor.execute(
+            '''
+                SELECT COUNT(*) FROM (
+                    SELECT user_id FROM cart_items WHERE product_id = ?
+                    UNION SELECT user_id FROM wishlist_items WHERE product_id = ?
+                )
+            ''', (product_id, product_id)
+        )
+        users = max(1, cursor.fetchone()[0])
+        scores = {other_id: CO_OCCURRENCE_WEIGHT * min(1.0, shared / (users * max(1, other_users)) ** 0.5)
+                  for other_id, shared, other_users in pairs}
+
+        # Tag overlap as Jaccard: shared tags / tags of either product, over the specific tags
+        cursor.execute(
+            '''
+                SELECT t2.product_id, COUNT(*) * 1.0 / (
+                    (SELECT COUNT(*) FROM product_tags WHERE product_id = ?)
+                    + (SELECT COUNT(*) FROM product_tags WHERE product_id = t2.product_id) - COUNT(*)
+                )
+                FROM product_tags t1 JOIN product_tags t2 ON t2.tag = t1.tag
+                WHERE t1.product_id = ? AND t2.product_id != ?
+                AND (SELECT COUNT(*) FROM (SELECT 1 FROM product_tags WHERE tag = t1.tag LIMIT ?)) < ?
+                GROUP BY t2.product_id
+            ''', (product_id, product_id, product_id,
+                  TAG_SIMILARITY_MAX_PRODUCTS + 1, TAG_SIMILARITY_MAX_PRODUCTS + 1)
+        )
+        for other_id, jaccard in cursor.fetchall():
+            scores[other_id] = scores.get(other_id, 0.0) + TAG_SIMILARITY_WEIGHT * jaccard
+
+        return heapq.nlargest(RECOMMENDATION_NEIGHBORS, scores.items(), key=lambda item: item[1])
+
+    def get_recommendations(self, product_ids: List[str], limit: int = 5,
+                            exclude: Iterable[str] = ()) -> List[Dict]:
+        """Products most similar to product_ids combined (summed neighbour scores), best first.
+
+        Read-only: uses the precomputed neighbour rows, which may lag a cart change until the
+        background refresher catches up. Products never scored yet are scored in memory for
+        this call and queued for the refresher. Each returned product dict carries its 'score'.
+        """
+        if not product_ids:
+            return []
+        product_ids = [str(product_id) for product_id in product_ids]
+        excluded = set(product_ids) | {str(product_id) for product_id in exclude}
+        with self._read() as cursor:
+            cursor.execute(
+                '''
+                    SELECT value FROM json_each(?)
+                    WHERE NOT EXISTS (SELECT 1 FROM recommendation_state WHERE product_id = value)
+                ''', (json.dumps(product_ids),)
+            )
+            unscored = [row[0] for row in cursor.fetchall()]
+            cursor.execute(
+                '''
+                    SELECT neighbor_id, score FROM product_neighbors
+                    WHERE product_id IN (SELECT value FROM json_each(?))
+                ''', (json.dumps(product_ids),)
+            )
+            neighbors = cursor.fetchall()
+            for product_id in unscored:
+                neighbors += self._score_neighbors(cursor, product_id)
+        if unscored:
+            self.schedule_recommendation_refresh(unscored)
+
+        totals: Dict[str, float] = {}
+        for neighbor_id, score in neighbors:
+            if neighbor_id not in excluded:
+                totals[neighbor_id] = totals.get(neighbor_id, 0.0) + score
+        ranked = heapq.nlargest(limit, totals.items(), key=lambda item: item[1])
+        products = self.get_products([neighbor_id for neighbor_id, _ in ranked])
+        return [dict(products[neighbor_id], score=score) for neighbor_id, score in ranked if neighbor_id in products]
+
+    def get_user_recommendations(self, user_id: str, limit: int = 5) -> List[Dict]:
+        """"You may also like" for everything in the user's cart and wishlist"""
+        with self._read() as cursor:
+            cursor.execute(
+                '''
+                    SELECT product_id FROM cart_items WHERE user_id = ?
+                    UNION SELECT product_id FROM wishlist_items WHERE user_id = ?
+                ''', (user_id, user_id)
+            )
+            items = [row[0] for row in cursor.fetchall()]
+        return self.get_recommendations(items, limit)
     
 
     def get_categories(self) -> List[str]:
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT DISTINCT category FROM products')
-        return [row[0] for row in cursor.fetchall()]
+        return list(self.get_catalog_stats()['categories'])
     
 
 # Initialize database
-if 'db' not in st.session_state:
-    st.session_state.db = EcommerceDB()
+@st.cache_resource
+def get_shared_db() -> EcommerceDB:
+    """One on-disk catalog per process, shared by every session"""
+    return EcommerceDB(DB_PATH)
+
+
+# Saved semantic index (SEMANTIC_INDEX_PATH.npy / .json); unset keeps it in memory only
+SEMANTIC_INDEX_PATH = os.environ.get("SEMANTIC_INDEX_PATH", "")
+
+
+class BackgroundSemanticIndex:
+    """A SemanticIndex built on a background thread the first time it is asked for.
+
+    get() returns None until the build finishes (or if it failed), so searches meanwhile
+    serve keyword results instead of waiting for NumPy and a pass over the catalog.
+    """
+
+    def __init__(self, db: EcommerceDB, path: str = ""):
+        self.db = db
+        self.path = path
+        self.error: Optional[Exception] = None
+        self._index: Optional['SemanticIndex'] = None
+        self._started = False
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional['SemanticIndex']:
+        with self._lock:
+            if not self._started:
+                self._started = True
+                threading.Thread(target=self._build, name="semantic-index", daemon=True).start()
+        return self._index
+
+    def _build(self):
+        from semantic_index import SemanticIndex
+
+        try:
+            with span('semantic_index.build'):
+                if self.path and os.path.exists(f"{self.path}.json"):
+                    index = SemanticIndex.load(self.path)
+                    index.sync(self.db)
+                else:
+                    index = SemanticIndex.build(self.db)
+                    if self.path:
+                        index.save(self.path)
+            self._index = index
+        except Exception as e:
+            self.error = e
+
+
+@st.cache_resource
+def get_semantic_index() -> BackgroundSemanticIndex:
+    """Semantic index over the shared catalog, loaded from SEMANTIC_INDEX_PATH when saved there.
+
+    Building starts with the first search that could use it; see BackgroundSemanticIndex.
+    """
+    return BackgroundSemanticIndex(get_shared_db(), SEMANTIC_INDEX_PATH)
 
 
 # AI Agent Tools
+
+# Token budget for tool output pasted into a reply prompt (see render_compact)
+TOOL_OUTPUT_TOKENS = 300
+
+# How each product field reads in render_human, in display order
+HUMAN_PRODUCT_FIELDS = {
+    'id': "ID: {}",
+    'name': "Name: {}",
+    'price': "Price: ${:.2f}",
+    'rating': "Rating: {}/5",
+    'stock': "Stock: {}",
+}
+
+
+@dataclass
+class ToolResult:
+    """Structured output of a tool, turned into text by a renderer (render_human / render_compact).
+
+    kind is 'products' (records are product rows), 'details' (one full product record),
+    'cart' (records have name, quantity and subtotal; total is set) or 'message' (title only).
+    """
+    kind: str
+    title: str = ""
+    records: List[Dict] = field(default_factory=list)
+    total: Optional[float] = None
+    # Usage hint shown to people but never sent to the model
+    hint: str = ""
+
+
+def render_human(result: ToolResult) -> str:
+    """The friendly multi-line text shown in pattern mode and the chat UI"""
+    if result.kind == 'products':
+        lines = [
+            ", ".join(HUMAN_PRODUCT_FIELDS[key].format(value) for key, value in record.items())
+            for record in result.records
+        ]
+        text = result.title + "\n" + "\n".join(lines)
+        return text + "\n\n" + result.hint if result.hint else text
+    if result.kind == 'details':
+        product = result.records[0]
+        return (f"{result.title}\n"
+                f"Name: {product['name']}\n"
+                f"Category: {product['category']}\n"
+                f"Price: ${product['price']:.2f}\n"
+                f"Description: {product['description']}\n"
+                f"Rating: {product['rating']}/5\n"
+                f"Stock: {product['stock']} available\n"
+                f"Tags: {', '.join(product['tags'])}")
+    if result.kind == 'cart':
+        lines = [f"- {item['name']} x{item['quantity']} = ${item['subtotal']:.2f}" for item in result.records]
+        return "\n".join([result.title] + lines + [f"Total: ${result.total:.2f}"])
+    return result.title
+
+
+def render_compact(result: ToolResult, max_tokens: int = TOOL_OUTPUT_TOKENS) -> str:
+    """Terse pipe-separated rows for LLM prompts, cut to max_tokens.
+
+    Rows past the budget are dropped from the end with a '(+N more)' marker, and a long
+    product description is shortened, so the same result always renders the same way.
+    """
+    if result.kind == 'details':
+        product = result.records[0]
+        text = (f"{product['id']}|{product['name']}|{product['category']}|{product['price']:.2f}|"
+                f"{product['rating']}|{product['stock']}|{','.join(product['tags'])}\n")
+        header = "product (id|name|category|price|rating|stock|tags) and description:\n"
+        room = max_tokens - estimate_tokens(header + text)
+        return header + text + truncate_to_tokens(product['description'], max(room, 0))
+
+    if result.kind == 'products':
+        columns = list(result.records[0]) if result.records else []
+        header = f"{result.title.rstrip(':')} ({'|'.join(columns)}):"
+        rows = ["|".join(f"{value:.2f}" if key == 'price' else str(value) for key, value in record.items())
+                for record in result.records]
+    elif result.kind == 'cart':
+        header = f"cart (name|qty|subtotal), total {result.total:.2f}:"
+        rows = [f"{item['name']}|{item['quantity']}|{item['subtotal']:.2f}" for item in result.records]
+    else:
+        return truncate_to_tokens(result.title, max_tokens)
+
+    lines = [header]
+    budget = max_tokens - estimate_tokens(header)
+    for shown, row in enumerate(rows):
+        # Leave room for the '(+N more)' marker unless this is the last row
+        reserve = 0 if shown == len(rows) - 1 else 3
+        if estimate_tokens(row) + 1 > budget - reserve:
+            lines.append(f"(+{len(rows) - shown} more)")
+            break
+        lines.append(row)
+        budget -= estimate_tokens(row) + 1
+    return "\n".join(lines)
+
+
+@instrument_class('tool')
 class EcommerceTools:
-    def __init__(self, db: EcommerceDB):
+    """Agent tools over an EcommerceDB.
+
+    Each *_result method returns a ToolResult; the matching *_tool method renders it with
+    `renderer` (human-friendly text by default, render_compact for LLM-facing agents).
+    Cart, wishlist and recommendation tools act for user_id.
+    """
+
+    def __init__(self, db: EcommerceDB, semantic_index: Optional['SemanticIndex'] = None, renderer=render_human,
+                 user_id: str = "user1"):
         self.db = db
+        # When set, plain-text searches blend keyword and semantic matches (see hybrid_search);
+        # a BackgroundSemanticIndex is used once it has been built
+        self.semantic_index = semantic_index
+        self.renderer = renderer
+        self.user_id = user_id
 
     def search_products_tool(self, query: str) -> str:
-        """Search for products based on query"""
-        # Try both with and without category filter
-        results = self.db.search_products(query)
-        
-       
-        if not results and query.lower() in ['smartphone', 'smartphones', 'phone', 'phones']:
-            results = self.db.search_products("", "Electronics")
-            # Filter for phone-related products
-            results = [p for p in results if any(tag in ['smartphone', 'apple', 'samsung', 'phone'] for tag in p['tags'])]
-        
+        """Search for products based on query (see search_products_result)"""
+        return self.renderer(self.search_products_result(query))
+
+    def search_products_result(self, query: str) -> ToolResult:
+        """Search for products based on query
+
+        The input may also be a JSON object of SEARCH_ARGUMENTS, so price, rating and stock
+        filters and the sort order run in SQL, e.g.
+        {"query": "laptop", "max_price": 1000, "in_stock": true, "sort": "price_asc"}
+        """
+        append_turn_stat('tools', 'search_products')
+        filters, ignored = {}, []
+        if query.strip().startswith('{'):
+            try:
+                query, filters, ignored = self._parse_search_arguments(query)
+            except (TypeError, ValueError) as e:
+                return ToolResult('message', f"Invalid search arguments: {e}")
+
+        # Only the top 5 results are shown, so only fetch 5. A requested sort order replaces
+        # ranking; filters alone still go through it
+        ranked = 'sort' not in filters
+        semantic_index = self.semantic_index
+        if isinstance(semantic_index, BackgroundSemanticIndex) and ranked and query.strip():
+            semantic_index = semantic_index.get()
+        if semantic_index is not None and ranked and query.strip():
+            from semantic_index import hybrid_search
+            semantic_index.sync(self.db)
+            results = hybrid_search(self.db, semantic_index, query, limit=5, **filters)
+        else:
+            results = self.db.search_products(query, limit=5, **filters)
+
+        if (not results and set(filters) <= {'sort'}
+                and query.lower() in ['smartphone', 'smartphones', 'phone', 'phones']):
+            results = self.db.search_by_tags(any_of=['smartphone', 'apple', 'samsung', 'phone'],
+                                             category="Electronics", limit=5)
+            if not ranked:
+                column, direction = SEARCH_SORTS[filters['sort']]
+                results.sort(key=lambda product: product[column], reverse=direction == 'DESC')
+
         if not results:
-            return f"No products found for '{query}'. Try searching for 'phone', 'laptop', 'shoes', or browse by category."
-        
-        formatted_results = []
-        for product in results[:5]:  # Limit to top 5 results
-            formatted_results.append(
-                f"ID: {product['id']}, Name: {product['name']}, "
-                f"Price: ${product['price']:.2f}, Rating: {product['rating']}/5, "
-                f"Stock: {product['stock']}"
-            )
-        
-        # Add helpful instructions at the end
-        response = "Found products:\n" + "\n".join(formatted_results)
-        response += "\n\nTo add any product to cart, say 'add product ID X to cart' where X is the product ID."
-        response += "\nFor more details about a product, say 'show details for product ID X'."
-        
-        return response
+            return ToolResult('message', f"No products found for '{self._describe_search(query, filters)}'. Try searching for 'phone', 'laptop', 'shoes', or browse by category.")
+
+        records = [
+            {'id': product['id'], 'name': product['name'], 'price': product['price'],
+             'rating': product['rating'], 'stock': product['stock']}
+            for product in results
+        ]
+
+        # Helpful instructions for people reading the results
+        hint = ("To add any product to cart, say 'add product ID X to cart' where X is the product ID."
+                "\nFor more details about a product, say 'show details for product ID X'.")
+        if ignored:
+            hint += "\nIgnored search arguments: " + ", ".join(ignored)
+
+        return ToolResult('products', "Found products:", records, hint=hint)
     
+    @staticmethod
+    def _parse_search_arguments(arguments: str) -> Tuple[str, Dict, List[str]]:
+        """(query, filters for search_products, ignored arguments) from a JSON SearchProducts input.
+
+        Values are normalized one at a time ("$1,500" -> 1500.0, "price" -> "price_asc",
+        "false" -> False); one that can't be is left out and described in the ignored list,
+        so a single bad value from the model doesn't lose the whole search. A 'relevance'
+        sort is the default and isn't passed on.
+        """
+        parsed = json.loads(arguments)
+        if not isinstance(parsed, dict):
+            raise ValueError("expected a JSON object")
+        unknown = set(parsed) - set(SEARCH_ARGUMENTS)
+        if unknown:
+            raise ValueError(f"unknown keys {', '.join(sorted(unknown))}; use {', '.join(SEARCH_ARGUMENTS)}")
+
+        filters, ignored = {}, []
+        for key in ('min_price', 'max_price', 'min_rating'):
+            value = parsed.get(key)
+            if value in (None, ''):
+                continue
+            try:
+                if isinstance(value, bool):
+                    raise ValueError
+                number = float(str(value).strip().lstrip('$').replace(',', '')) if isinstance(value, str) else float(value)
+                if not math.isfinite(number) or number < 0:
+                    raise ValueError
+                filters[key] = number
+            except (TypeError, ValueError):
+                ignored.append(f"{key} {value!r}")
+        if parsed.get('category'):
+            filters['category'] = str(parsed['category'])
+        if 'in_stock' in parsed and parsed['in_stock'] is not None:
+            value = parsed['in_stock']
+            flag = value if isinstance(value, bool) else FLAG_VALUES.get(str(value).strip().lower())
+            if flag is None:
+                ignored.append(f"in_stock {value!r}")
+            elif flag:
+                filters['in_stock'] = True
+        if parsed.get('sort'):
+            sort = str(parsed['sort']).strip().lower().replace(' ', '_').replace('-', '_')
+            sort = SORT_ALIASES.get(sort, sort)
+            if sort not in SEARCH_SORTS:
+                ignored.append(f"sort {parsed['sort']!r} (use {', '.join(SEARCH_SORTS)})")
+            elif sort != 'relevance':
+                filters['sort'] = sort
+        return str(parsed.get('query') or ''), filters, ignored
+
+    @staticmethod
+    def _describe_search(query: str, filters: Dict) -> str:
+        parts = [query] if query else []
+        if 'category' in filters:
+            parts.append(f"in {filters['category']}")
+        if 'min_price' in filters:
+            parts.append(f"from ${filters['min_price']:.2f}")
+        if 'max_price' in filters:
+            parts.append(f"up to ${filters['max_price']:.2f}")
+        if 'min_rating' in filters:
+            parts.append(f"rated {filters['min_rating']}+")
+        if filters.get('in_stock'):
+            parts.append("in stock")
+        return ' '.join(parts) or 'all products'
+
     def add_to_cart_tool(self, product_id: str, quantity: str = "1") -> str:
-        """Add a product to the user's cart"""
+        """Add a product to the user's cart (once per hybrid turn, see SideEffectLedger)"""
+        return run_side_effect(('add_to_cart', self.user_id, str(product_id).strip()),
+                               lambda: self._add_to_cart(product_id, quantity))
+
+    def _add_to_cart(self, product_id: str, quantity: str) -> str:
+        append_turn_stat('tools', 'add_to_cart')
         try:
             qty = int(quantity)
+            if qty < 1:
+                return "Quantity must be at least 1"
             product = self.db.get_product(product_id)
             if not product:
                 return f"Product with ID {product_id} not found"
@@ -283,7 +1561,7 @@ class EcommerceTools:
             if product['stock'] < qty:
                 return f"Sorry, only {product['stock']} items available for {product['name']}"
             
-            success = self.db.add_to_cart("user1", product_id, qty)
+            success = self.db.add_to_cart(self.user_id, product_id, qty)
             if success:
                 return f"Added {qty} x {product['name']} to cart successfully!"
             else:
@@ -293,12 +1571,17 @@ class EcommerceTools:
         
 
     def add_to_wishlist_tool(self, product_id: str) -> str:
-        """Add a product to the user's wishlist"""
+        """Add a product to the user's wishlist (once per hybrid turn, see SideEffectLedger)"""
+        return run_side_effect(('add_to_wishlist', self.user_id, str(product_id).strip()),
+                               lambda: self._add_to_wishlist(product_id))
+
+    def _add_to_wishlist(self, product_id: str) -> str:
+        append_turn_stat('tools', 'add_to_wishlist')
         product = self.db.get_product(product_id)
         if not product:
             return f"Product with ID {product_id} not found"
         
-        success = self.db.add_to_wishlist("user1", product_id)
+        success = self.db.add_to_wishlist(self.user_id, product_id)
         if success:
             return f"Added {product['name']} to wishlist!"
         else:
@@ -307,88 +1590,849 @@ class EcommerceTools:
     
     def get_cart_tool(self, dummy: str = "") -> str:
         """Get the current cart contents"""
-        cart = self.db.get_user_cart("user1")
+        return self.renderer(self.cart_result())
+
+    def cart_result(self) -> ToolResult:
+        append_turn_stat('tools', 'cart')
+        cart = self.db.get_user_cart(self.user_id)
         if not cart:
-            return "Your cart is empty"
+            return ToolResult('message', "Your cart is empty")
         
-        cart_info = ["Current cart contents:"]
-        total = 0
-        for item in cart:
-            subtotal = item['product']['price'] * item['quantity']
-            total += subtotal
-            cart_info.append(
-                f"- {item['product']['name']} x{item['quantity']} = ${subtotal:.2f}"
-            )
-        cart_info.append(f"Total: ${total:.2f}")
-        return "\n".join(cart_info)
+        records = [
+            {'name': item['product']['name'], 'quantity': item['quantity'],
+             'subtotal': item['product']['price'] * item['quantity']}
+            for item in cart
+        ]
+        return ToolResult('cart', "Current cart contents:", records, total=sum(r['subtotal'] for r in records))
     
 
     def get_product_details_tool(self, product_id: str) -> str:
         """Get detailed information about a specific product"""
+        return self.renderer(self.product_details_result(product_id))
+
+    def product_details_result(self, product_id: str) -> ToolResult:
+        append_turn_stat('tools', 'product_details')
         product = self.db.get_product(product_id)
         if not product:
-            return f"Product with ID {product_id} not found"
+            return ToolResult('message', f"Product with ID {product_id} not found")
         
-        return (f"Product Details:\n"
-                f"Name: {product['name']}\n"
-                f"Category: {product['category']}\n"
-                f"Price: ${product['price']:.2f}\n"
-                f"Description: {product['description']}\n"
-                f"Rating: {product['rating']}/5\n"
-                f"Stock: {product['stock']} available\n"
-                f"Tags: {', '.join(product['tags'])}")
+        return ToolResult('details', "Product Details:", [product])
+    
+    def get_recommendations_tool(self, product_id: str = "") -> str:
+        """Recommend products similar to product_id, or to the user's cart and wishlist if empty"""
+        return self.renderer(self.recommendations_result(product_id))
+
+    def recommendations_result(self, product_id: str = "") -> ToolResult:
+        append_turn_stat('tools', 'recommendations')
+        product_id = product_id.strip()
+        if product_id:
+            if not self.db.get_product(product_id):
+                return ToolResult('message', f"Product with ID {product_id} not found")
+            recommendations = self.db.get_recommendations([product_id], limit=5)
+            heading = f"Shoppers interested in product {product_id} also like:"
+        else:
+            recommendations = self.db.get_user_recommendations(self.user_id, limit=5)
+            heading = "Recommended for you, based on your cart and wishlist:"
+
+        if not recommendations:
+            return ToolResult('message', "No recommendations yet. Add a few items to your cart or wishlist first.")
+
+        records = [
+            {'id': product['id'], 'name': product['name'], 'price': product['price'], 'rating': product['rating']}
+            for product in recommendations
+        ]
+        return ToolResult('products', heading, records)
     
 
 # Initialise Ollama LLM
+OLLAMA_MODEL = "gemma3:1b"
+OLLAMA_BASE_URL = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+if not OLLAMA_BASE_URL.startswith(("http://", "https://")):
+    OLLAMA_BASE_URL = f"http://{OLLAMA_BASE_URL}"
+
+
 @st.cache_resource
 def initialize_llm():
-    return OllamaLLM(model="gemma3:1b")
+    from langchain_ollama import OllamaLLM
+    return OllamaLLM(model=OLLAMA_MODEL, base_url=OLLAMA_BASE_URL)
+
+
+@st.cache_resource
+def get_llm_scheduler() -> 'LLMScheduler':
+    """Process-wide queue in front of Ollama, so sessions can't flood it with parallel generations"""
+    return LLMScheduler(initialize_llm(), LLM_MAX_CONCURRENCY)
+
+
+# Hard ceiling on any prompt sent to the model (see CountingLLM); history and tool output are trimmed to fit
+PROMPT_TOKEN_BUDGET = 1500
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token for English), no tokenizer needed"""
+    return (len(text) + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep: str = 'head') -> str:
+    """Cut text to about max_tokens, keeping its start (keep='head') or its end ('tail')"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    limit = max(0, max_tokens * 4 - 1)
+    return text[:limit] + "…" if keep == 'head' else "…" + text[len(text) - limit:]
+
+
+def fit_prompt(prompt: str, max_tokens: int = PROMPT_TOKEN_BUDGET) -> str:
+    """Cut the middle out of an over-budget prompt, keeping its instructions and its ending"""
+    if estimate_tokens(prompt) <= max_tokens:
+        return prompt
+    half = max(0, max_tokens * 2 - 2)
+    return prompt[:half] + "\n…\n" + prompt[len(prompt) - half:]
+
+
+# Stats for the chat turn currently running in this context (see handle_user_query_with_ai)
+_turn_stats: ContextVar[Optional[Dict]] = ContextVar('turn_stats', default=None)
+
+
+def record_turn_stat(key: str, amount: int = 1):
+    """Add to a counter on the active turn's stats; a no-op outside of a turn"""
+    stats = _turn_stats.get()
+    if stats is not None:
+        stats[key] = stats.get(key, 0) + amount
+
+
+def set_turn_stat(key: str, value):
+    """Set a value (e.g. the detected intent) on the active turn's stats"""
+    stats = _turn_stats.get()
+    if stats is not None:
+        stats[key] = value
+
+
+def append_turn_stat(key: str, value):
+    """Append to a list on the active turn's stats (e.g. 'tools', the tools it called)"""
+    stats = _turn_stats.get()
+    if stats is not None:
+        stats.setdefault(key, []).append(value)
+
+
+@contextmanager
+def _active_turn(stats: Dict):
+    token = _turn_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _turn_stats.reset(token)
+
+
+class TurnCancelled(BaseException):
+    """Raised in the losing path of a hybrid turn when it tries to act again.
+
+    A BaseException, like asyncio.CancelledError, so the AI path doesn't mistake it for
+    an Ollama failure and fall back to patterns.
+    """
+
+
+class SideEffectLedger:
+    """Runs each side effect (cart and wishlist writes) of a hybrid turn at most once.
+
+    Effects are keyed by tool, user and product, so a second write to the same product in
+    a turn (even with another quantity) gets the first result back instead of running. Once decide() names the winning path, the other path's
+    effects and LLM calls raise TurnCancelled. Deciding waits for an effect in progress, so
+    each one either ran before the decision or never runs.
+    """
+
+    def __init__(self):
+        self.winner: Optional[str] = None
+        # key -> (path that ran it, result), in the order they ran
+        self.effects: Dict[Tuple, Tuple[str, Any]] = {}
+        # Keys whose result was returned to a path other than the one that ran them
+        self.shared = set()
+        self._lock = threading.Lock()
+
+    def run(self, path: str, key: Tuple, func):
+        with self._lock:
+            if key in self.effects:
+                if self.effects[key][0] != path:
+                    self.shared.add(key)
+                return self.effects[key][1]
+            if self.lost(path):
+                raise TurnCancelled(f"{key[0]} skipped: the {self.winner} path answered this turn")
+            result = func()
+            self.effects[key] = (path, result)
+            return result
+
+    def decide(self, path: str) -> bool:
+        """Make path the winner unless one was already chosen; True if path won"""
+        with self._lock:
+            if self.winner is None:
+                self.winner = path
+            return self.winner == path
+
+    def lost(self, path: str) -> bool:
+        return self.winner is not None and self.winner != path
+
+    def unshared_results(self, path: str) -> List:
+        """Results of effects path ran that no other path saw (e.g. the LLM's cart add when patterns answered)"""
+        with self._lock:
+            return [result for key, (ran_by, result) in self.effects.items()
+                    if ran_by == path and key not in self.shared]
+
+
+# (ledger, path name) of the hybrid-turn path running in this context
+_race_path: ContextVar[Optional[Tuple[SideEffectLedger, str]]] = ContextVar('race_path', default=None)
+
+
+def run_side_effect(key: Tuple, func):
+    """func(), or inside a hybrid turn at most once per turn for the winning path"""
+    race = _race_path.get()
+    if race is None:
+        return func()
+    ledger, path = race
+    return ledger.run(path, key, func)
+
+
+def raise_if_cancelled():
+    """Stop a hybrid-turn path that has lost the race before its next LLM call"""
+    race = _race_path.get()
+    if race is not None and race[0].lost(race[1]):
+        raise TurnCancelled(f"the {race[0].winner} path answered this turn")
+
+
+class CountingLLM:
+    """Wraps an LLM, counting every generation against the active turn's 'llm_calls' and timing it.
+
+    Prompts over PROMPT_TOKEN_BUDGET are cut in the middle (where tool output and history
+    sit) before reaching the model; the turn's 'prompt_tokens' adds up what was sent.
+    """
+
+    def __init__(self, llm, token_budget: Optional[int] = None):
+        self.llm = llm
+        self.token_budget = token_budget
+
+    def _fit(self, prompt: str) -> str:
+        prompt = fit_prompt(prompt, self.token_budget or PROMPT_TOKEN_BUDGET)
+        record_turn_stat('prompt_tokens', estimate_tokens(prompt))
+        return prompt
+
+    def invoke(self, prompt: str, **kwargs) -> str:
+        raise_if_cancelled()
+        record_turn_stat('llm_calls')
+        prompt = self._fit(prompt)
+        with span('llm.invoke'):
+            return self.llm.invoke(prompt, **kwargs)
+
+    def stream(self, prompt: str, **kwargs) -> Iterator[str]:
+        raise_if_cancelled()
+        record_turn_stat('llm_calls')
+        return timed_iter('llm.stream', self.llm.stream(self._fit(prompt), **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+
+# Generations sent to Ollama at once by this process; more wait in LLMScheduler's queue
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "2"))
+
+# Queue order of waiting generations, lowest first
+LLM_PRIORITIES = {'interactive': 0, 'testing': 1, 'batch': 2}
+
+# Priority of LLM calls made in this context (see llm_priority)
+_llm_priority: ContextVar[str] = ContextVar('llm_priority', default='interactive')
+
+
+@contextmanager
+def llm_priority(name: str):
+    """Queue LLM calls made inside the block at this LLM_PRIORITIES level"""
+    if name not in LLM_PRIORITIES:
+        raise ValueError(f"unknown LLM priority '{name}'; use one of {', '.join(LLM_PRIORITIES)}")
+    token = _llm_priority.set(name)
+    try:
+        yield
+    finally:
+        _llm_priority.reset(token)
+
+
+class LLMScheduler:
+    """Bounded-concurrency dispatch in front of one LLM (the local Ollama instance).
+
+    At most max_concurrency generations run at once; the rest wait in a priority queue
+    (interactive chat before agent testing before batch jobs, FIFO within a level), and
+    time spent waiting is recorded as 'llm.queue_wait.<priority>' spans and the turn's
+    'llm_queue_ms'. Identical prompts already in flight are coalesced (single-flight): the
+    later callers wait for the first one's answer instead of generating again.
+    """
+
+    def __init__(self, llm, max_concurrency: int = LLM_MAX_CONCURRENCY):
+        self.llm = llm
+        self.max_concurrency = max(1, max_concurrency)
+        self.generations = 0
+        self.coalesced = 0
+        self.max_queued = 0
+        self._running = 0
+        # Heap of (priority, arrival, event) for callers waiting for a slot
+        self._waiting: List[Tuple[int, int, threading.Event]] = []
+        self._arrivals = count()
+        # prompt key -> Future of the generation in flight for it
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _slot(self):
+        priority = _llm_priority.get()
+        started = time.perf_counter()
+        with self._lock:
+            if self._running < self.max_concurrency and not self._waiting:
+                self._running += 1
+                ticket = None
+            else:
+                ticket = threading.Event()
+                heapq.heappush(self._waiting, (LLM_PRIORITIES[priority], next(self._arrivals), ticket))
+                self.max_queued = max(self.max_queued, len(self._waiting))
+        if ticket is not None:
+            # _release hands its slot straight to us
+            ticket.wait()
+        waited_ms = (time.perf_counter() - started) * 1000
+        record_duration(f'llm.queue_wait.{priority}', waited_ms)
+        record_turn_stat('llm_queue_ms', waited_ms)
+        try:
+            # A hybrid turn may have been decided while we queued (see SideEffectLedger)
+            raise_if_cancelled()
+            with self._lock:
+                self.generations += 1
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            if self._waiting:
+                heapq.heappop(self._waiting)[2].set()
+            else:
+                self._running -= 1
+
+    def invoke(self, prompt: str, **kwargs) -> str:
+        if kwargs:
+            with self._slot():
+                return self.llm.invoke(prompt, **kwargs)
+
+        key = str(prompt)
+        with self._lock:
+            leader = self._in_flight.get(key)
+            if leader is None:
+                future = self._in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+        if leader is not None:
+            count_cache('llm_single_flight', True)
+            try:
+                return leader.result()
+            except TurnCancelled:
+                # The first caller's turn was cancelled, not ours
+                return self.invoke(prompt)
+
+        count_cache('llm_single_flight', False)
+        try:
+            with self._slot():
+                response = self.llm.invoke(prompt)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(response)
+            return response
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stream(self, prompt: str, **kwargs) -> Iterator[str]:
+        """Stream from the model, holding a slot until the last chunk (streams are not coalesced)"""
+        with self._slot():
+            yield from self.llm.stream(prompt, **kwargs)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'max_concurrency': self.max_concurrency,
+                'running': self._running,
+                'queued': len(self._waiting),
+                'max_queued': self.max_queued,
+                'generations': self.generations,
+                'coalesced': self.coalesced,
+            }
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+
+class OllamaHealthMonitor:
+    """Cached Ollama availability, refreshed by a background thread.
+
+    Probes hit /api/tags, which lists the pulled models without generating anything.
+    The circuit opens when a probe finds Ollama down (or the model missing), or after
+    `failure_threshold` consecutive failures of real LLM calls reported via record_failure:
+    the monitor then reports Ollama as down and only re-probes every `open_seconds` until
+    a probe succeeds again.
+    """
+
+    def __init__(self, base_url: str = OLLAMA_BASE_URL, model: str = OLLAMA_MODEL, ttl: float = 15.0,
+                 timeout: float = 2.0, failure_threshold: int = 2, open_seconds: float = 30.0):
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self.ttl = ttl
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+
+        self.available = False
+        self.last_latency_ms: Optional[float] = None
+        self.last_checked: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.consecutive_failures = 0
+        self.circuit_open = False
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def is_available(self) -> bool:
+        """Cached status; the first call probes synchronously and starts the background refresher"""
+        if self._thread is None:
+            with self._lock:
+                start_thread = self._thread is None
+                if start_thread:
+                    self._thread = threading.Thread(target=self._run, name="ollama-health", daemon=True)
+            if start_thread:
+                self.probe()
+                self._thread.start()
+        return self.available
+
+    @instrument('ollama.health_probe')
+    def probe(self) -> bool:
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(f"{self.base_url}/api/tags", timeout=self.timeout) as response:
+                models = json.load(response).get('models', [])
+            names = {m.get('name') for m in models} | {m.get('model') for m in models}
+            ok = self.model in names or f"{self.model}:latest" in names
+            error = None if ok else f"model '{self.model}' is not pulled"
+        except (OSError, ValueError) as e:
+            ok, error = False, str(e)
+
+        with self._lock:
+            self.last_latency_ms = (time.perf_counter() - start) * 1000
+            self.last_checked = time.time()
+        if ok:
+            self.record_success()
+        else:
+            self.record_failure(error, server_down=True)
+        return ok
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.circuit_open = False
+            self.available = True
+            self.last_error = None
+
+    def record_failure(self, error: str = None, server_down: bool = False):
+        """Count a failed LLM call; server_down=True (a failed probe) opens the circuit at once"""
+        with self._lock:
+            self.consecutive_failures += 1
+            self.last_error = error
+            if server_down or self.consecutive_failures >= self.failure_threshold:
+                self.circuit_open = True
+                self.available = False
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                'available': self.available,
+                'circuit_open': self.circuit_open,
+                'consecutive_failures': self.consecutive_failures,
+                'last_latency_ms': self.last_latency_ms,
+                'last_checked': self.last_checked,
+                'last_error': self.last_error,
+            }
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.open_seconds if self.circuit_open else self.ttl):
+            self.probe()
+
+
+@st.cache_resource
+def get_health_monitor() -> OllamaHealthMonitor:
+    return OllamaHealthMonitor()
+
+
+# Persistent tier for the LLM response cache; set LLM_CACHE_PATH="" to keep it in memory only
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", "llm_cache.db")
+
+
+class LivePrompt(str):
+    """A prompt that embeds per-user live data (cart contents); CachedLLM never caches these"""
+
+
+class CachedLLM:
+    """LRU + TTL response cache in front of an LLM, optionally backed by SQLite.
+
+    Keys hash the model name, generation parameters and the whitespace-normalized prompt.
+    Prompts that embed tool output are content-addressed by that output, so a stock or
+    catalog change produces a new key; LivePrompt instances skip the cache entirely.
+    """
+
+    CACHE_PARAMS = ('temperature', 'top_p', 'top_k', 'num_predict', 'num_ctx', 'seed')
+
+    def __init__(self, llm, max_entries: int = 512, ttl: float = 24 * 3600, persist_path: Optional[str] = None):
+        self.llm = llm
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        if persist_path:
+            self._disk = sqlite3.connect(persist_path, check_same_thread=False)
+            self._disk.execute(
+                'CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            self._disk.commit()
+
+    def cache_key(self, prompt: str, **kwargs) -> str:
+        params = {name: getattr(self.llm, name, None) for name in self.CACHE_PARAMS}
+        payload = json.dumps(
+            [getattr(self.llm, 'model', None), params, kwargs, ' '.join(prompt.split())],
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def invoke(self, prompt: str, **kwargs) -> str:
+        if isinstance(prompt, LivePrompt):
+            return self.llm.invoke(prompt, **kwargs)
+
+        key = self.cache_key(prompt, **kwargs)
+        cached = self._get(key)
+        if cached is not None:
+            record_turn_stat('llm_cache_hits')
+            return cached
+
+        response = self.llm.invoke(prompt, **kwargs)
+        if response and response.strip():
+            self._put(key, response)
+        return response
+
+    def stream(self, prompt: str, **kwargs) -> Iterator[str]:
+        """Stream from the model on a miss (caching the joined text); a hit is one chunk"""
+        if isinstance(prompt, LivePrompt):
+            return self.llm.stream(prompt, **kwargs)
+
+        key = self.cache_key(prompt, **kwargs)
+        cached = self._get(key)
+        if cached is not None:
+            record_turn_stat('llm_cache_hits')
+            return iter([cached])
+        return self._stream_and_store(key, self.llm.stream(prompt, **kwargs))
+
+    def _stream_and_store(self, key: str, chunks: Iterator[str]) -> Iterator[str]:
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        response = ''.join(parts)
+        if response.strip():
+            self._put(key, response)
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                count_cache('llm_response', True)
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+
+            if self._disk is not None:
+                row = self._disk.execute(
+                    'SELECT response, created_at FROM llm_cache WHERE key = ? AND created_at >= ?', (key, now - self.ttl)
+                ).fetchone()
+                if row:
+                    self._remember(key, row[1], row[0])
+                    self.hits += 1
+                    count_cache('llm_response', True)
+                    return row[0]
+
+            self.misses += 1
+            count_cache('llm_response', False)
+            return None
+
+    def _put(self, key: str, response: str):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, response)
+            if self._disk is not None:
+                self._disk.execute('INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)', (key, response, now))
+                self._disk.execute('DELETE FROM llm_cache WHERE created_at < ?', (now - self.ttl,))
+                self._disk.commit()
+
+    def _remember(self, key: str, created_at: float, response: str):
+        self._entries[key] = (created_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._disk is not None:
+                self._disk.execute('DELETE FROM llm_cache')
+                self._disk.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+            }
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+
+@st.cache_resource
+def get_cached_llm() -> CachedLLM:
+    """Process-wide cached LLM, so identical prompts from different sessions share answers"""
+    return CachedLLM(CountingLLM(get_llm_scheduler()), persist_path=LLM_CACHE_PATH or None)
+
+
+# Conversation memory: recent turns verbatim within a token window, older turns folded into
+# a rolling summary, so prompt size (and Ollama latency) stays flat in long sessions
+MEMORY_WINDOW_TOKENS = 600
+MEMORY_SUMMARY_TOKENS = 200
+
+
+class ConversationMemory:
+    """Sliding token window over chat turns with a rolling summary of evicted turns.
+
+    Evicted turns are folded into the summary at once by keeping their user requests. With a
+    summarizer LLM, a background thread then rewrites the summary with one short generation
+    (queued at 'batch' priority), so turns never wait for it; take_usage() reports the calls.
+    """
+
+    def __init__(self, window_tokens: int = MEMORY_WINDOW_TOKENS, summary_tokens: int = MEMORY_SUMMARY_TOKENS,
+                 summarizer=None):
+        self.window_tokens = window_tokens
+        self.summary_tokens = summary_tokens
+        self.summarizer = summarizer
+        self.summary = ""
+        # (user, assistant, tokens) per turn, oldest first
+        self.turns: List[Tuple[str, str, int]] = []
+        self.tokens = 0
+        # Summary written by the summarizer, and evicted turns it hasn't folded in yet
+        self._summarized = ""
+        self._pending: List[Tuple[str, str, int]] = []
+        self._summarizing = False
+        # Bumped by clear(), so a summary started before it is discarded
+        self._generation = 0
+        self._usage: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_turn(self, user: str, assistant: str):
+        text = self._format_turn(user, assistant)
+        with self._lock:
+            self.turns.append((user, assistant, estimate_tokens(text)))
+            self.tokens += self.turns[-1][2]
+            evicted = []
+            # Always keep the latest turn, even if it alone is over the window
+            while self.tokens > self.window_tokens and len(self.turns) > 1:
+                turn = self.turns.pop(0)
+                self.tokens -= turn[2]
+                evicted.append(turn)
+            if not evicted:
+                return
+            self.summary = self._extractive(self.summary, evicted)
+            if self.summarizer is None:
+                return
+            self._pending += evicted
+            if self._summarizing:
+                return
+            self._summarizing = True
+        threading.Thread(target=self._summarize_pending, name="memory-summary", daemon=True).start()
+
+    def _extractive(self, summary: str, evicted: List[Tuple[str, str, int]]) -> str:
+        if not evicted:
+            return summary
+        requests = "; ".join(user for user, _, _ in evicted)
+        return truncate_to_tokens(f"{summary}; {requests}" if summary else requests, self.summary_tokens, keep='tail')
+
+    def _summarize_pending(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._summarizing = False
+                    return
+                evicted, self._pending = self._pending, []
+                base, generation = self._summarized, self._generation
+            usage: Dict = {}
+            with _active_turn(usage), llm_priority('batch'), span('memory.summarize'):
+                summary = self._summarize(base, evicted)
+            with self._lock:
+                for key in ('llm_calls', 'prompt_tokens'):
+                    self._usage[key] = self._usage.get(key, 0) + usage.get(key, 0)
+                if generation != self._generation:
+                    continue
+                self._summarized = summary or self._extractive(base, evicted)
+                # Turns evicted meanwhile stay in their extractive form until the next pass
+                self.summary = self._extractive(self._summarized, self._pending)
+
+    def _summarize(self, summary: str, evicted: List[Tuple[str, str, int]]) -> str:
+        transcript = "\n".join(self._format_turn(user, assistant) for user, assistant, _ in evicted)
+        prompt = f"""
+Summarize this conversation between a shopper and an e-commerce assistant in at most {self.summary_tokens * 3 // 4} words.
+Keep product names, product IDs and cart changes.
+
+Summary so far: {summary or "(none)"}
+
+New turns:
+{truncate_to_tokens(transcript, PROMPT_TOKEN_BUDGET - self.summary_tokens - 100, keep='tail')}
+
+Summary:"""
+        try:
+            summary = self.summarizer.invoke(prompt).strip()
+        except Exception:
+            return ""
+        return truncate_to_tokens(summary, self.summary_tokens) if summary else ""
+
+    def take_usage(self) -> Dict[str, int]:
+        """LLM calls and prompt tokens of background summaries finished since the last call"""
+        with self._lock:
+            usage, self._usage = self._usage, {}
+            return usage
+
+    @staticmethod
+    def _format_turn(user: str, assistant: str) -> str:
+        return f"User: {user}\nAssistant: {assistant}"
+
+    def render(self, max_tokens: Optional[int] = None) -> str:
+        """Summary plus the newest turns that fit in max_tokens (default: the whole window)"""
+        budget = self.window_tokens + self.summary_tokens if max_tokens is None else max_tokens
+        with self._lock:
+            summary, turns = self.summary, list(self.turns)
+        parts = []
+        if summary:
+            summary = truncate_to_tokens(f"Earlier in the conversation: {summary}", budget // 3)
+            parts.append(summary)
+            budget -= estimate_tokens(summary)
+        recent = []
+        for user, assistant, tokens in reversed(turns):
+            if tokens > budget:
+                break
+            recent.append(self._format_turn(user, assistant))
+            budget -= tokens
+        return "\n".join(parts + recent[::-1])
+
+    def clear(self):
+        with self._lock:
+            self.summary = self._summarized = ""
+            self.turns = []
+            self.tokens = 0
+            self._pending = []
+            self._generation += 1
+
+
+def langchain_memory(conversation: ConversationMemory, memory_key: str = "chat_history"):
+    """Expose a ConversationMemory to a LangChain agent as its memory"""
+    from langchain_core.memory import BaseMemory
+
+    class WindowedMemory(BaseMemory):
+        conversation: Any
+        memory_key: str = "chat_history"
+
+        @property
+        def memory_variables(self) -> List[str]:
+            return [self.memory_key]
+
+        def load_memory_variables(self, inputs: Dict) -> Dict:
+            return {self.memory_key: self.conversation.render()}
+
+        def save_context(self, inputs: Dict, outputs: Dict):
+            self.conversation.add_turn(str(inputs.get('input', '')), str(outputs.get('output', '')))
+
+        def clear(self):
+            self.conversation.clear()
+
+    return WindowedMemory(conversation=conversation, memory_key=memory_key)
 
 
 # Initialise AI Agent
+# Tools and agent scaffolding keep no per-user state, so they are built once per process;
+# sessions only hold what is theirs (the conversational agent's memory, chat history).
+@st.cache_resource
+def get_shared_tools(compact: bool = False) -> EcommerceTools:
+    """Tool handler over the shared database; compact=True renders results for LLM prompts"""
+    return EcommerceTools(get_shared_db(), get_semantic_index(), renderer=render_compact if compact else render_human)
+
+
+@st.cache_resource
+def get_agent_tools() -> List:
+    """LangChain tool definitions for the conversational agent"""
+    from langchain.agents import Tool
+
+    tools_handler = get_shared_tools(compact=True)
+    return [
+        Tool(
+            name="SearchProducts",
+            func=tools_handler.search_products_tool,
+            description="Search for products by name, description, or tags. Input should be a search query string, or a JSON object "
+                        "to filter and sort in the database with optional keys query, category, min_price, max_price, min_rating, "
+                        "in_stock and sort (relevance, rating, price_asc or price_desc), e.g. "
+                        "{\"query\": \"laptop\", \"max_price\": 1000, \"in_stock\": true}. Use this to find products for the user."
+        ),
+        Tool(
+            name="AddToCart",
+            func=tools_handler.add_to_cart_tool,
+            description="Add a product to cart. Input should be 'product_id,quantity' or just 'product_id' for quantity 1."
+        ),
+        Tool(
+            name="AddToWishlist",
+            func=tools_handler.add_to_wishlist_tool,
+            description="Add a product to wishlist. Input should be the product_id."
+        ),
+        Tool(
+            name="GetCart",
+            func=tools_handler.get_cart_tool,
+            description="Get current cart contents and total. No input needed, just use empty string."
+        ),
+        Tool(
+            name="GetProductDetails",
+            func=tools_handler.get_product_details_tool,
+            description="Get detailed information about a specific product. Input should be the product_id."
+        ),
+        Tool(
+            name="GetRecommendations",
+            func=tools_handler.get_recommendations_tool,
+            description="Suggest products the user may also like. Input should be a product_id for products similar to it, or an empty string for suggestions based on the user's cart and wishlist."
+        )
+    ]
+
+
 def get_agent():
+    """Conversational agent for this session: shared tools and LLM, per-session memory"""
     if 'agent' not in st.session_state:
-        llm = initialize_llm()
-        tools_handler = EcommerceTools(st.session_state.db)
-        
-        tools = [
-            Tool(
-                name="SearchProducts",
-                func=tools_handler.search_products_tool,
-                description="Search for products by name, description, or tags. Input should be a search query string. Use this to find products for the user."
-            ),
-            Tool(
-                name="AddToCart",
-                func=tools_handler.add_to_cart_tool,
-                description="Add a product to cart. Input should be 'product_id,quantity' or just 'product_id' for quantity 1."
-            ),
-            Tool(
-                name="AddToWishlist",
-                func=tools_handler.add_to_wishlist_tool,
-                description="Add a product to wishlist. Input should be the product_id."
-            ),
-            Tool(
-                name="GetCart",
-                func=tools_handler.get_cart_tool,
-                description="Get current cart contents and total. No input needed, just use empty string."
-            ),
-            Tool(
-                name="GetProductDetails",
-                func=tools_handler.get_product_details_tool,
-                description="Get detailed information about a specific product. Input should be the product_id."
-            )
-        ]
-        
-        from langchain.memory import ConversationBufferMemory
-        
-        memory = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True
-        )
+        from langchain.agents import initialize_agent, AgentType
+
+        # Bounded history: a token window plus a rolling summary, instead of the full transcript
+        memory = langchain_memory(ConversationMemory(summarizer=get_cached_llm()))
         
         st.session_state.agent = initialize_agent(
-            tools=tools,
-            llm=llm,
+            tools=get_agent_tools(),
+            llm=initialize_llm(),
             agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,  
             memory=memory,
             verbose=True,
@@ -400,49 +2444,86 @@ def get_agent():
     return st.session_state.agent
 
 
+@st.cache_resource
 def get_simple_agent():
-    if 'simple_agent' not in st.session_state:
-        llm = initialize_llm()
-        tools_handler = EcommerceTools(st.session_state.db)
-        
-        tools = [
-            Tool(
-                name="SearchProducts",
-                func=tools_handler.search_products_tool,
-                description="Search for products. Input: search query as string"
-            ),
-            Tool(
-                name="AddToCart",
-                func=tools_handler.add_to_cart_tool,
-                description="Add product to cart. Input: product_id"
-            ),
-            Tool(
-                name="GetCart",
-                func=tools_handler.get_cart_tool,
-                description="Show cart contents. Input: empty string"
-            ),
-            Tool(
-                name="GetProductDetails",
-                func=tools_handler.get_product_details_tool,
-                description="Get product details. Input: product_id"
-            )
-        ]
-        
-        
-        st.session_state.simple_agent = initialize_agent(
-            tools=tools,
-            llm=llm,
-            agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-            verbose=False,  
-            max_iterations=1, 
-            handle_parsing_errors=True
+    """Memoryless agent with short tool descriptions; one instance serves every session"""
+    from langchain.agents import Tool, initialize_agent, AgentType
+
+    tools_handler = get_shared_tools(compact=True)
+    tools = [
+        Tool(
+            name="SearchProducts",
+            func=tools_handler.search_products_tool,
+            description="Search for products. Input: search query as string, or JSON like "
+                        "{\"query\": \"shoes\", \"max_price\": 100, \"min_rating\": 4, \"in_stock\": true, \"sort\": \"price_asc\"}"
+        ),
+        Tool(
+            name="AddToCart",
+            func=tools_handler.add_to_cart_tool,
+            description="Add product to cart. Input: product_id"
+        ),
+        Tool(
+            name="GetCart",
+            func=tools_handler.get_cart_tool,
+            description="Show cart contents. Input: empty string"
+        ),
+        Tool(
+            name="GetProductDetails",
+            func=tools_handler.get_product_details_tool,
+            description="Get product details. Input: product_id"
+        ),
+        Tool(
+            name="GetRecommendations",
+            func=tools_handler.get_recommendations_tool,
+            description="Suggest related products. Input: product_id, or empty string for the user's cart"
         )
+    ]
     
-    return st.session_state.simple_agent
+    return initialize_agent(
+        tools=tools,
+        llm=initialize_llm(),
+        agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+        verbose=False,  
+        max_iterations=1, 
+        handle_parsing_errors=True
+    )
 
 
 # Streamlit UI
+
+# Sidebar examples on the chat page
+EXAMPLE_PROMPTS = [
+    "Hi there!",
+    "I'm looking for a laptop",
+    "Show me some smartphones", 
+    "Add the MacBook to my cart",
+    "What's in my cart?",
+]
+
+# Test scenarios with natural language (Agent Testing page)
+TEST_SCENARIOS = [
+    "Hello, how are you?",
+    "I need a new laptop for work",
+    "Show me the best smartphones you have", 
+    "Can you add that MacBook to my shopping cart?",
+    "What do I have in my cart right now?",
+    "Tell me more details about the iPhone",
+    "I'm looking for running shoes",
+    "Add product number 1 to my cart please"
+]
+
+# Products per page on the Product Database page
+PRODUCT_PAGE_SIZE = 20
+
+# Chat messages kept per session (oldest dropped first) and shown per page of history
+MAX_CHAT_HISTORY = 200
+CHAT_PAGE_SIZE = 20
+
+
 def main():
+    if 'db' not in st.session_state:
+        st.session_state.db = get_shared_db()
+
     st.title("E-commerce AI Agents Sandbox by Ronnie")
     st.sidebar.title("Navigation")
     
@@ -479,76 +2560,83 @@ def ai_chat_interface():
             st.success("🟢 AI Online")
         else:
             st.warning("🟡 Pattern Mode")
+        latency = get_health_monitor().status()['last_latency_ms']
+        if latency is not None:
+            st.caption(f"Ollama ping: {latency:.0f} ms")
     
     # Initialise chat history
     if 'chat_history' not in st.session_state:
         st.session_state.chat_history = []
+    if 'chat_visible' not in st.session_state:
+        st.session_state.chat_visible = CHAT_PAGE_SIZE
     
     # clear chat button
     if st.button("Clear Chat"):
         st.session_state.chat_history = []
-        if 'ai_agent' in st.session_state:
-            del st.session_state.ai_agent  # Reset agent
+        st.session_state.chat_visible = CHAT_PAGE_SIZE
+        if 'agent' in st.session_state:
+            del st.session_state.agent
+        if 'chat_session_id' in st.session_state:
+            # The service session holds the history and conversation memory AI turns see;
+            # chat_session_id() starts a fresh one on the next turn
+            get_chat_service().end_session(st.session_state.chat_session_id)
+            del st.session_state.chat_session_id
         st.rerun()
     
     # Show example prompts
     st.sidebar.subheader("Try these examples:")
-    example_prompts = [
-        "Hi there!",
-        "I'm looking for a laptop",
-        "Show me some smartphones", 
-        "Add the MacBook to my cart",
-        "What's in my cart?",
-    ]
-    
-    for prompt in example_prompts:
+    for prompt in EXAMPLE_PROMPTS:
         if st.sidebar.button(prompt, key=f"example_{prompt}"):
-            st.session_state.chat_history.append({"role": "user", "content": prompt})
+            add_chat_message({"role": "user", "content": prompt})
             try:
                 with st.spinner("AI is thinking..."):
-                    if ollama_status:
-                        response = handle_user_query_with_ai(prompt)
-                    else:
-                        response = handle_user_query(prompt)
-                    st.session_state.chat_history.append({"role": "assistant", "content": response})
+                    turn = get_chat_service().chat(chat_session_id(), prompt)
+                    add_chat_message({"role": "assistant", "content": turn['reply'], **turn['stats']})
                 st.rerun()
             except Exception as e:
                 st.sidebar.error(f"Error: {str(e)}")
     
+    # Display the latest page of chat history; older pages on request
+    history = st.session_state.chat_history
+    hidden = max(0, len(history) - st.session_state.chat_visible)
+    if hidden and st.button(f"Show earlier messages ({hidden} hidden)"):
+        st.session_state.chat_visible += CHAT_PAGE_SIZE
+        st.rerun()
+    for message in history[hidden:]:
+        with st.chat_message(message["role"]):
+            st.write(message["content"])
+    
     # Chat input
     user_input = st.chat_input("Type your message naturally...")
     
     if user_input:
         # Add user message to history
-        st.session_state.chat_history.append({"role": "user", "content": user_input})
+        add_chat_message({"role": "user", "content": user_input})
+        with st.chat_message("user"):
+            st.write(user_input)
         
-        # Get AI response
-        try:
-            with st.spinner("AI is thinking..."):
-                if ollama_status:
-                    response = handle_user_query_with_ai(user_input)
-                else:
-                    response = handle_user_query(user_input)
-                st.session_state.chat_history.append({"role": "assistant", "content": response})
-        except Exception as e:
-            st.session_state.chat_history.append({
-                "role": "assistant", 
-                "content": f"I encountered an issue: {str(e)}. Please try rephrasing your request."
-            })
-    
-    # Display chat history
-    for message in st.session_state.chat_history:
-        with st.chat_message(message["role"]):
-            st.write(message["content"])
+        # Get AI response, streaming the final answer as it is generated
+        with st.chat_message("assistant"):
+            try:
+                turn_stats = {}
+                response = st.write_stream(get_chat_service().stream_chat(chat_session_id(), user_input, turn_stats))
+                add_chat_message({"role": "assistant", "content": response, **turn_stats})
+            except Exception as e:
+                response = f"I encountered an issue: {str(e)}. Please try rephrasing your request."
+                st.write(response)
+                add_chat_message({"role": "assistant", "content": response})
+
+
+def add_chat_message(message: Dict):
+    """Append to the session's chat history, dropping the oldest messages past MAX_CHAT_HISTORY"""
+    history = st.session_state.chat_history
+    history.append(message)
+    if len(history) > MAX_CHAT_HISTORY:
+        del history[:len(history) - MAX_CHAT_HISTORY]
 
 def check_ollama_status():
-    """Check if Ollama is running and responsive"""
-    try:
-        llm = initialize_llm()
-        test_response = llm.invoke("Hi")
-        return bool(test_response and len(test_response.strip()) > 0)
-    except Exception:
-        return False
+    """Check if Ollama is running and responsive (cached, refreshed in the background)"""
+    return get_health_monitor().is_available()
 
 def product_database_view():
     st.header("Product Database")
@@ -558,15 +2646,23 @@ def product_database_view():
     with col1:
         search_query = st.text_input("Search products...")
     with col2:
-        category = st.selectbox("Category", ["All"] + st.session_state.db.get_categories())
+        facets = st.session_state.db.category_facets(search_query)
+        category = st.selectbox(
+            "Category", ["All"] + st.session_state.db.get_categories(),
+            format_func=lambda c: f"{c} ({sum(facets.values()) if c == 'All' else facets.get(c, 0)})"
+        )
     
-    # Display products
-    if search_query:
-        cat_filter = None if category == "All" else category
-        products = st.session_state.db.search_products(search_query, cat_filter)
-    else:
-        # Show all products
-        products = st.session_state.db.search_products("", None)
+    # Display one page of products; the cursors of visited pages are kept so Previous works
+    cat_filter = None if category == "All" else category
+    page_key = (search_query, cat_filter)
+    if st.session_state.get('product_page_key') != page_key:
+        st.session_state.product_page_key = page_key
+        st.session_state.product_page_cursors = [None]
+    cursors = st.session_state.product_page_cursors
+
+    products, next_cursor = st.session_state.db.search_products_page(
+        search_query, cat_filter, limit=PRODUCT_PAGE_SIZE, after=cursors[-1]
+    )
     
     if products:
         for product in products:
@@ -585,6 +2681,16 @@ def product_database_view():
                     if st.button(f"Add to Wishlist", key=f"wish_{product['id']}"):
                         st.session_state.db.add_to_wishlist("user1", product['id'])
                         st.success("Added to wishlist!")
+    else:
+        st.info("No products found.")
+
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        st.button("← Previous", disabled=len(cursors) == 1, on_click=cursors.pop)
+    with col2:
+        st.caption(f"Page {len(cursors)}")
+    with col3:
+        st.button("Next →", disabled=next_cursor is None, on_click=cursors.append, args=(next_cursor,))
 
 
 def cart_wishlist_view():
@@ -617,7 +2723,38 @@ def cart_wishlist_view():
     
     with tab2:
         st.subheader("Wishlist")
-        st.info("Wishlist functionality will show saved items here")
+        wishlist = st.session_state.db.get_user_wishlist("user1")
+        
+        if wishlist:
+            for item in wishlist:
+                col1, col2 = st.columns([3, 1])
+                with col1:
+                    st.write(f"**{item['product']['name']}**")
+                    st.write(f"${item['product']['price']:.2f} - {item['product']['stock']} in stock")
+                with col2:
+                    if st.button("Move to Cart", key=f"wish_to_cart_{item['product']['id']}"):
+                        st.session_state.db.add_to_cart("user1", item['product']['id'])
+                        st.success("Added to cart!")
+                st.divider()
+        else:
+            st.info("Your wishlist is empty")
+
+    # Precomputed neighbours of everything in the cart and wishlist
+    recommendations = st.session_state.db.get_user_recommendations("user1", limit=4)
+    if recommendations:
+        st.subheader("You may also like")
+        columns = st.columns(len(recommendations))
+        for column, product in zip(columns, recommendations):
+            with column:
+                st.write(f"**{product['name']}**")
+                st.write(f"${product['price']:.2f} - {product['rating']}/5 ⭐")
+                if st.button("Add to Cart", key=f"rec_to_cart_{product['id']}"):
+                    st.session_state.db.add_to_cart("user1", product['id'])
+                    st.success("Added to cart!")
+
+
+# Session state key of the Agent Testing page's chat service session (see chat_session_id)
+TESTING_SESSION_KEY = 'testing_session_id'
 
 
 def agent_testing_interface():
@@ -632,27 +2769,12 @@ def agent_testing_interface():
     else:
         st.warning("🟡 Ollama not available - using pattern matching fallback")
     
-    # Test scenarios with natural language
-    test_scenarios = [
-        "Hello, how are you?",
-        "I need a new laptop for work",
-        "Show me the best smartphones you have", 
-        "Can you add that MacBook to my shopping cart?",
-        "What do I have in my cart right now?",
-        "Tell me more details about the iPhone",
-        "I'm looking for running shoes",
-        "Add product number 1 to my cart please"
-    ]
-    
     st.subheader("Natural Language Test Scenarios")
-    for scenario in test_scenarios:
+    for scenario in TEST_SCENARIOS:
         if st.button(scenario, key=f"test_{scenario}"):
             try:
-                with st.spinner("AI Processing..."):
-                    if ollama_status:
-                        response = handle_user_query_with_ai(scenario)
-                    else:
-                        response = handle_user_query(scenario)
+                with st.spinner("AI Processing..."), llm_priority('testing'):
+                    response = get_chat_service().chat(chat_session_id(TESTING_SESSION_KEY), scenario)['reply']
                 st.success("AI Response:")
                 st.write(response)
                 st.divider()
@@ -664,36 +2786,95 @@ def agent_testing_interface():
     custom_test = st.text_area("Enter any natural language request:")
     if st.button("Test with AI") and custom_test:
         try:
-            with st.spinner("AI Processing..."):
-                if ollama_status:
-                    response = handle_user_query_with_ai(custom_test)
-                else:
-                    response = handle_user_query(custom_test)
+            with st.spinner("AI Processing..."), llm_priority('testing'):
+                response = get_chat_service().chat(chat_session_id(TESTING_SESSION_KEY), custom_test)['reply']
             st.success("AI Response:")
             st.write(response)
         except Exception as e:
             st.error(f"Error: {str(e)}")
 
+    if st.button("Clear Test Session"):
+        # Test turns build up their own conversation memory; start the next test from scratch
+        if TESTING_SESSION_KEY in st.session_state:
+            get_chat_service().end_session(st.session_state[TESTING_SESSION_KEY])
+            del st.session_state[TESTING_SESSION_KEY]
+        st.rerun()
+
 
 def system_logs_view():
+    import pandas as pd
+
     st.header("System Logs & Analytics")
     
     # Database stats
     st.subheader("Database Statistics")
-    col1, col2, col3 = st.columns(3)
+    catalog_stats = st.session_state.db.get_catalog_stats()
+    col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        total_products = len(st.session_state.db.search_products("", None))
-        st.metric("Total Products", total_products)
+        st.metric("Total Products", catalog_stats['total_products'])
     
     with col2:
-        categories = st.session_state.db.get_categories()
-        st.metric("Categories", len(categories))
+        st.metric("Categories", len(catalog_stats['categories']))
     
     with col3:
+        st.metric("Units in Stock", catalog_stats['total_stock'])
+    
+    with col4:
         cart_items = st.session_state.db.get_user_cart("user1")
         st.metric("Cart Items", len(cart_items))
     
+    if catalog_stats['categories']:
+        st.dataframe(pd.DataFrame.from_dict(catalog_stats['categories'], orient='index'))
+        col1, col2 = st.columns(2)
+        with col1:
+            st.caption("Products by price")
+            st.bar_chart(pd.Series(catalog_stats['price_histogram']))
+        with col2:
+            st.caption("Products by rating")
+            st.bar_chart(pd.Series(catalog_stats['rating_histogram']))
+    
+    # LLM response cache
+    cache_stats = get_cached_llm().stats()
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("LLM Cache Hit Rate", f"{cache_stats['hit_rate']:.0%}")
+    with col2:
+        st.metric("Cache Hits / Misses", f"{cache_stats['hits']} / {cache_stats['misses']}")
+    with col3:
+        st.metric("Cached Responses", cache_stats['entries'])
+
+    # Ollama dispatch queue (LLMScheduler)
+    scheduler_stats = get_llm_scheduler().stats()
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("LLM Generations Running",
+                  f"{scheduler_stats['running']} / {scheduler_stats['max_concurrency']}")
+    with col2:
+        st.metric("Queued (max)", f"{scheduler_stats['queued']} ({scheduler_stats['max_queued']})")
+    with col3:
+        st.metric("Coalesced / Generated", f"{scheduler_stats['coalesced']} / {scheduler_stats['generations']}")
+    
+    # Per-step latency (instrumentation.METRICS, shared by every session in this process)
+    st.subheader("Latency by Step")
+    steps = METRICS.snapshot()
+    if steps:
+        st.dataframe(pd.DataFrame(steps).set_index('step').round(2))
+        caches = METRICS.cache_rates()
+        if caches:
+            st.caption("Cache hit rates")
+            st.dataframe(pd.DataFrame(caches).set_index('cache'))
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button("Export spans (JSONL)", data=METRICS.spans_jsonl(),
+                               file_name="spans.jsonl", mime="application/jsonl")
+        with col2:
+            if st.button("Reset metrics"):
+                METRICS.reset()
+                st.rerun()
+    else:
+        st.info("No timings recorded yet")
+    
     # Agent interaction logs
     st.subheader("Recent Interactions")
     if 'chat_history' in st.session_state:
@@ -703,81 +2884,200 @@ def system_logs_view():
     else:
         st.info("No interactions logged yet")
 
-def handle_user_query(user_input: str) -> str:
-    """Handle user queries directly without complex agent"""
+# Pattern-matching router used when Ollama is unavailable.
+#
+# Rules are checked in priority order (lowest first) and the first match wins:
+#   any  - at least one of these keywords/phrases appears (as whole words)
+#   all  - every one of these appears
+#   none - none of these appear
+# and the action is one of:
+#   reply  - canned text
+#   search - run search_products_tool with this query, prefixed by `title`
+#   tool   - 'view_cart', 'add_to_cart' or 'product_details'
+# Extra rules (and an optional "stop_words" list) can be supplied as JSON through
+# INTENT_RULES_PATH without touching this file; see load_intent_rules.
+DEFAULT_INTENT_RULES = [
+    {"intent": "greeting", "priority": 10,
+     "any": ["hi", "hello", "hey", "good morning", "good afternoon"],
+     "reply": "Hello! Welcome to our AI Shopping Assistant! 🛒\n\nI can help you:\n- Search for products\n- Add items to your cart\n- View your cart\n- Get product details\n\nWhat would you like to find today?"},
+    {"intent": "positive", "priority": 20,
+     "any": ["doing great", "good", "fine", "excellent"],
+     "reply": "That's wonderful to hear! How can I help you with your shopping today? You can ask me to find products, check your cart, or get details about any item."},
+    {"intent": "laptop_search", "priority": 30,
+     "any": ["macbook", "macbooks", "laptop", "laptops", "mac book"],
+     "search": "macbook", "title": "Here are the MacBook laptops I found:"},
+    {"intent": "electronics_search", "priority": 40,
+     "any": ["electronics", "gadget", "gadgets"],
+     "search": "electronics", "title": "Here are some electronics I found:"},
+    {"intent": "phone_search", "priority": 50,
+     "any": ["phone", "phones", "smartphone", "smartphones", "iphone", "iphones", "samsung"],
+     "search": "phone", "title": "Here are the phones I found:"},
+    {"intent": "view_cart", "priority": 60,
+     "all": ["cart"], "any": ["show", "view", "my", "check"], "none": ["add"],
+     "tool": "view_cart"},
+    {"intent": "add_to_cart", "priority": 70,
+     "all": ["add", "cart"],
+     "tool": "add_to_cart"},
+    {"intent": "product_details", "priority": 80,
+     "any": ["details", "detail", "info", "information"],
+     "tool": "product_details"},
+]
+
+# Words dropped from a message before it is used as a free-text search
+DEFAULT_STOP_WORDS = [
+    "search", "find", "looking", "for", "show", "me", "i", "i'm", "im", "need", "want", "help", "with",
+    "a", "an", "the", "some", "any", "please", "can", "you", "could", "would", "to", "my", "do", "have",
+]
+
+INTENT_RULES_PATH = os.environ.get("INTENT_RULES_PATH", "")
+
+PRODUCT_ID_PATTERN = re.compile(r'(?:id|product)\s*(\d+)')
+WORD_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
+class IntentRouter:
+    """Keyword router compiled from a rule table.
+
+    Every keyword of every rule goes into one word-boundary regex, so a message is scanned
+    once; rules are then tested in priority order against the set of keywords found.
+    """
+
+    def __init__(self, rules: List[Dict], stop_words: Iterable[str] = DEFAULT_STOP_WORDS):
+        # sorted() is stable, so rules with equal priority keep their file order
+        self.rules = sorted(rules, key=lambda rule: rule.get("priority", 100))
+        self._conditions = [
+            (frozenset(self._normalize(k) for k in rule.get("any", [])),
+             frozenset(self._normalize(k) for k in rule.get("all", [])),
+             frozenset(self._normalize(k) for k in rule.get("none", [])))
+            for rule in self.rules
+        ]
+        keywords = {keyword for conditions in self._conditions for group in conditions for keyword in group}
+        # Longest first, so 'good morning' wins over 'good'; spaces in phrases match any whitespace
+        alternation = "|".join(
+            re.escape(keyword).replace(r"\ ", r"\s+") for keyword in sorted(keywords, key=len, reverse=True)
+        )
+        self._keyword_pattern = re.compile(rf"\b(?:{alternation})\b") if keywords else None
+        self.stop_words = frozenset(stop_words)
+
+    @staticmethod
+    def _normalize(keyword: str) -> str:
+        return " ".join(keyword.lower().split())
+
+    def route(self, text: str) -> Optional[Dict]:
+        """Return the highest-priority rule matching text (already lower-cased), or None"""
+        if self._keyword_pattern is None:
+            return None
+        found = {self._normalize(match) for match in self._keyword_pattern.findall(text)}
+        if not found:
+            return None
+        for rule, (any_of, all_of, none_of) in zip(self.rules, self._conditions):
+            if any_of and found.isdisjoint(any_of):
+                continue
+            if not all_of <= found or not found.isdisjoint(none_of):
+                continue
+            return rule
+        return None
+
+    def search_terms(self, text: str) -> str:
+        """Message minus stop words, for the free-text fallback search"""
+        return " ".join(word for word in WORD_PATTERN.findall(text) if word not in self.stop_words)
+
+
+def load_intent_rules(path: str = INTENT_RULES_PATH) -> IntentRouter:
+    """Build the router from the default rules plus any rules in the JSON file at path.
+
+    The file holds either a list of rules or {"rules": [...], "stop_words": [...]}; rules
+    without a priority run after the built-in ones (priority 100).
+    """
+    rules = list(DEFAULT_INTENT_RULES)
+    stop_words = DEFAULT_STOP_WORDS
+    if path:
+        with open(path) as f:
+            config = json.load(f)
+        if isinstance(config, list):
+            config = {"rules": config}
+        rules += config.get("rules", [])
+        stop_words = config.get("stop_words", stop_words)
+    return IntentRouter(rules, stop_words)
+
+
+INTENT_ROUTER = load_intent_rules()
+
+
+@instrument('turn.pattern')
+def handle_user_query(user_input: str, tools_handler: Optional[EcommerceTools] = None,
+                      stats: Optional[Dict] = None) -> str:
+    """Handle user queries directly without complex agent
+
+    When a dict is passed as stats, the matched intent is recorded in stats['pattern_intent']
+    and the tools called in stats['tools'].
+    """
+    if tools_handler is None:
+        tools_handler = get_shared_tools()
+    if stats is None:
+        stats = {}
+    with _active_turn(stats):
+        return _answer_with_patterns(user_input, tools_handler, stats)
+
+
+def _answer_with_patterns(user_input: str, tools_handler: EcommerceTools, stats: Dict) -> str:
     user_input_lower = user_input.lower()
-    tools_handler = EcommerceTools(st.session_state.db)
-    
-    # Greetings
-    if any(greeting in user_input_lower for greeting in ['hi', 'hello', 'hey', 'good morning', 'good afternoon']):
-        return "Hello! Welcome to our AI Shopping Assistant! 🛒\n\nI can help you:\n- Search for products\n- Add items to your cart\n- View your cart\n- Get product details\n\nWhat would you like to find today?"
-    
-    # Positive responses
-    if any(phrase in user_input_lower for phrase in ['doing great', 'good', 'fine', 'excellent']):
-        return "That's wonderful to hear! How can I help you with your shopping today? You can ask me to find products, check your cart, or get details about any item."
-    
-    # MacBook/laptop searches
-    if any(term in user_input_lower for term in ['macbook', 'laptop', 'mac book']):
-        result = tools_handler.search_products_tool("macbook")
-        return f"Here are the MacBook laptops I found:\n\n{result}"
-    
-    # Electronics searches
-    if 'electronics' in user_input_lower or 'gadget' in user_input_lower:
-        result = tools_handler.search_products_tool("electronics")
-        return f"Here are some electronics I found:\n\n{result}"
-    
-    # Phone/smartphone searches
-    if any(term in user_input_lower for term in ['phone', 'smartphone', 'iphone', 'samsung']):
-        result = tools_handler.search_products_tool("phone")
-        return f"Here are the phones I found:\n\n{result}"
-    
-    # Cart operations
-    if 'cart' in user_input_lower and any(word in user_input_lower for word in ['show', 'view', 'my', 'check']):
-        return tools_handler.get_cart_tool("")
-    
-    # Add to cart (extract product ID)
-    if 'add' in user_input_lower and 'cart' in user_input_lower:
-        # Try to extract product ID
-        import re
-        id_match = re.search(r'(?:id|product)\s*(\d+)', user_input_lower)
-        if id_match:
-            product_id = id_match.group(1)
-            return tools_handler.add_to_cart_tool(product_id)
-        else:
+    rule = INTENT_ROUTER.route(user_input_lower)
+    if rule is not None:
+        stats['pattern_intent'] = rule["intent"]
+
+        if "reply" in rule:
+            return rule["reply"]
+
+        if "search" in rule:
+            result = tools_handler.search_products_tool(rule["search"])
+            return f"{rule.get('title', 'Here is what I found:')}\n\n{result}"
+
+        if rule.get("tool") == "view_cart":
+            return tools_handler.get_cart_tool("")
+
+        if rule.get("tool") == "add_to_cart":
+            id_match = PRODUCT_ID_PATTERN.search(user_input_lower)
+            if id_match:
+                return tools_handler.add_to_cart_tool(id_match.group(1))
             return "Please specify the product ID you want to add to cart. For example: 'add product ID 3 to cart'"
-    
-    # Product details
-    if 'details' in user_input_lower or 'info' in user_input_lower:
-        import re
-        id_match = re.search(r'(?:id|product)\s*(\d+)', user_input_lower)
-        if id_match:
-            product_id = id_match.group(1)
-            return tools_handler.get_product_details_tool(product_id)
-        else:
+
+        if rule.get("tool") == "product_details":
+            id_match = PRODUCT_ID_PATTERN.search(user_input_lower)
+            if id_match:
+                return tools_handler.get_product_details_tool(id_match.group(1))
             return "Please specify the product ID you want details for. For example: 'show details for product ID 3'"
     
     # General search
-    # Extract search terms (remove common words)
-    search_terms = user_input_lower
-    for word in ['search', 'find', 'looking', 'for', 'show', 'me', 'i', 'need', 'want', 'help', 'with']:
-        search_terms = search_terms.replace(word, '')
-    search_terms = search_terms.strip()
+    search_terms = INTENT_ROUTER.search_terms(user_input_lower)
     
     if search_terms:
+        stats['pattern_intent'] = "search"
         result = tools_handler.search_products_tool(search_terms)
         return f"Here's what I found for '{search_terms}':\n\n{result}"
     
     # Default response
+    stats['pattern_intent'] = "help"
     return "I'd be happy to help you find products! You can ask me to:\n- Search for specific items (e.g., 'find smartphones')\n- Show your cart\n- Add items to cart using product ID\n- Get product details\n\nWhat would you like to do?"
 
+@st.cache_resource
 def create_ai_agent():
-    """Create a simple but effective AI agent using Ollama"""
-    if 'ai_agent' not in st.session_state:
-        llm = initialize_llm()
-        tools_handler = EcommerceTools(st.session_state.db)
-        
-        # Create a simple prompt template for the AI
-        prompt_template = """
+    """Create a simple but effective AI agent using Ollama (stateless, so shared by every session)"""
+    return build_ai_agent(get_cached_llm(), get_shared_db(), get_semantic_index())
+
+def build_ai_agent(llm, db: EcommerceDB, semantic_index: Optional['SemanticIndex'] = None, user_id: str = "user1",
+                   health_monitor: Optional['OllamaHealthMonitor'] = None,
+                   memory: Optional[ConversationMemory] = None) -> Dict:
+    """Bundle an LLM with tools over db; pass the result as `agent` to run turns outside a session
+
+    With a health_monitor, LLM errors during a turn count towards its circuit breaker. With a
+    memory, its rendered history goes into the structured parsing prompt, so follow-ups
+    such as "add it to my cart" can be resolved.
+    """
+    tools_handler = EcommerceTools(db, semantic_index, user_id=user_id)
+    
+    # Create a simple prompt template for the AI
+    prompt_template = """
 You are a helpful e-commerce shopping assistant. You can help users:
 1. Search for products
 2. Add items to cart
@@ -796,30 +3096,369 @@ Based on the user's message, determine what they want to do and respond naturall
 
 Response:"""
 
-        st.session_state.ai_agent = {
-            'llm': llm,
-            'tools': tools_handler,
-            'prompt': prompt_template
-        }
-    
-    return st.session_state.ai_agent
+    return {
+        'llm': llm,
+        'tools': tools_handler,
+        'prompt': prompt_template,
+        'health_monitor': health_monitor,
+        'memory': memory
+    }
+
+# Answer the whole turn from one structured LLM call (falls back to the multi-prompt path)
+AI_STRUCTURED_MODE = True
+
+AI_INTENTS = ("SEARCH", "ADD_TO_CART", "VIEW_CART", "PRODUCT_DETAILS", "GREETING", "OTHER")
+
+
+@instrument('turn.ai')
+def handle_user_query_with_ai(user_input: str, stats: Optional[Dict] = None, structured: bool = AI_STRUCTURED_MODE,
+                              agent: Optional[Dict] = None) -> str:
+    """Handle user queries using actual AI with natural language understanding
+
+    With structured=True a single prompt returns the intent and its arguments as JSON, the
+    matching tool runs, and one more call writes the reply. If that JSON can't be parsed the
+    turn falls back to the step-by-step prompts. Pass a dict as stats to receive per-turn
+    counters such as 'llm_calls', 'mode', 'intent', 'tools', 'ttft_ms' and 'latency_ms'.
+
+    agent (see build_ai_agent) replaces the session's Ollama agent, e.g. with a stand-in LLM;
+    the Ollama health check is skipped in that case.
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault('llm_calls', 0)
+    started = time.perf_counter()
+    with _active_turn(stats):
+        try:
+            llm, response_prompt = _plan_ai_turn(user_input, stats, structured, agent)
+            if llm is not None:
+                with span('turn.generate'):
+                    response = llm.invoke(response_prompt)
+            else:
+                response = response_prompt
+        except Exception as e:
+            response = _fall_back_to_patterns(user_input, stats, e, agent)
+    stats['ttft_ms'] = stats['latency_ms'] = (time.perf_counter() - started) * 1000
+    return response
+
+
+@instrument('turn.ai')
+def stream_user_query_with_ai(user_input: str, stats: Optional[Dict] = None, structured: bool = AI_STRUCTURED_MODE,
+                              agent: Optional[Dict] = None) -> Iterator[str]:
+    """Like handle_user_query_with_ai, but yields the final reply as Ollama generates it.
+
+    Intent parsing and tool calls still run to completion first; only the last generation
+    streams. Time to first token and total latency are recorded as 'ttft_ms' / 'latency_ms'.
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault('llm_calls', 0)
+    started = time.perf_counter()
+    emitted = False
+    # The turn stays active while chunks are generated, so LLM calls made during streaming count
+    with _active_turn(stats):
+        try:
+            llm, response_prompt = _plan_ai_turn(user_input, stats, structured, agent)
+            chunks = timed_iter('turn.generate', llm.stream(response_prompt)) if llm is not None else iter([response_prompt])
+            for chunk in chunks:
+                if not emitted:
+                    stats['ttft_ms'] = (time.perf_counter() - started) * 1000
+                    emitted = True
+                yield chunk
+        except Exception as e:
+            if emitted:
+                # Same monitor _fall_back_to_patterns would report to
+                health_monitor = agent.get('health_monitor') if agent is not None else get_health_monitor()
+                if health_monitor is not None:
+                    health_monitor.record_failure(str(e))
+                yield f"\n\n(The response was interrupted: {str(e)})"
+            else:
+                fallback = _fall_back_to_patterns(user_input, stats, e, agent)
+                stats['ttft_ms'] = (time.perf_counter() - started) * 1000
+                yield fallback
+    stats['latency_ms'] = (time.perf_counter() - started) * 1000
+
+
+# Latency budget of hybrid turns: the LLM's answer (or, when streaming, its first chunk) is
+# used if it arrives within this many seconds, the pattern router's otherwise
+HYBRID_DEADLINE_SECONDS = float(os.environ.get("HYBRID_DEADLINE_SECONDS", "3"))
+
+
+class _HybridRace:
+    """One hybrid turn: its SideEffectLedger, the AI path's thread and the time-saved span"""
 
-def handle_user_query_with_ai(user_input: str) -> str:
-    """Handle user queries using actual AI with natural language understanding"""
+    def __init__(self):
+        self.ledger = SideEffectLedger()
+        self.started = time.perf_counter()
+        self.answered_at: Optional[float] = None
+        self._answered = threading.Event()
+
+    def start_ai_path(self, run):
+        """Call run() on its own thread as the 'ai' path; the copied context carries the turn's span"""
+        def target():
+            _race_path.set((self.ledger, 'ai'))
+            try:
+                run()
+            finally:
+                if self.ledger.winner == 'pattern':
+                    # The turn has returned by now, so this goes to the metrics, under the turn's span
+                    self._answered.wait()
+                    if self.answered_at is not None:
+                        record_duration('turn.hybrid.time_saved',
+                                        max(0.0, (time.perf_counter() - self.answered_at) * 1000))
+        threading.Thread(target=copy_context().run, args=(target,), name="hybrid-llm", daemon=True).start()
+
+    def finish(self, stats: Dict, deadline: float):
+        stats['race_winner'] = self.ledger.winner
+        stats['deadline_ms'] = deadline * 1000
+        stats['latency_ms'] = (time.perf_counter() - self.started) * 1000
+        self.answered_at = time.perf_counter()
+        record_duration(f'turn.hybrid.{self.ledger.winner}_won', stats['latency_ms'])
+
+    def close(self):
+        self._answered.set()
+
+
+@instrument('turn.hybrid')
+def handle_user_query_hybrid(user_input: str, stats: Optional[Dict] = None, deadline: float = HYBRID_DEADLINE_SECONDS,
+                             agent: Optional[Dict] = None, structured: bool = AI_STRUCTURED_MODE) -> str:
+    """Race the LLM against a deadline, answering from the pattern router if it misses it.
+
+    The AI path (handle_user_query_with_ai) runs on its own thread. If it answers within
+    `deadline` seconds that answer is used; otherwise the pattern path answers and the AI
+    path is cancelled at its next LLM call or side effect. Cart and wishlist writes go through a
+    SideEffectLedger, so each runs exactly once whichever path wins: a write the LLM made
+    before the deadline is reused by the pattern path, or reported in its reply.
+
+    stats receives the winning path's stats plus 'race_winner', 'deadline_ms' and 'latency_ms'.
+    When patterns win, how much longer the LLM path ran is recorded as a 'turn.hybrid.time_saved'
+    span once it ends.
+    """
+    stats = stats if stats is not None else {}
+    race = _HybridRace()
+    ai_stats: Dict = {}
+    outcome: Future = Future()
+
+    def run_ai_path():
+        try:
+            outcome.set_result(handle_user_query_with_ai(user_input, ai_stats, structured, agent))
+        except BaseException as e:
+            outcome.set_exception(e)
+
+    race.start_ai_path(run_ai_path)
     try:
-        # First, check if Ollama is working
-        agent = create_ai_agent()
-        llm = agent['llm']
-        tools = agent['tools']
-        
-        # Test Ollama connection first
-        test_response = llm.invoke("Hello")
-        if not test_response:
+        try:
+            reply = outcome.result(timeout=deadline)
+            race.ledger.decide('ai')
+            stats.update(ai_stats)
+        except Exception:
+            # Deadline missed (TimeoutError), or the AI path failed outright
+            race.ledger.decide('pattern')
+            reply = _answer_hybrid_with_patterns(user_input, stats, race.ledger, agent)
+        race.finish(stats, deadline)
+    finally:
+        race.close()
+    return reply
+
+
+@instrument('turn.hybrid')
+def stream_user_query_hybrid(user_input: str, stats: Optional[Dict] = None, deadline: float = HYBRID_DEADLINE_SECONDS,
+                             agent: Optional[Dict] = None, structured: bool = AI_STRUCTURED_MODE) -> Iterator[str]:
+    """Like handle_user_query_hybrid, but streams the LLM's reply (stream_user_query_with_ai).
+
+    The deadline applies to the first chunk, which comes after intent parsing and tool calls;
+    if it is late the pattern answer is yielded as one chunk instead.
+    """
+    stats = stats if stats is not None else {}
+    race = _HybridRace()
+    ai_stats: Dict = {}
+    # Chunks of the AI path, then an exception it raised (if any), then None
+    chunks: queue.Queue = queue.Queue()
+
+    def run_ai_path():
+        try:
+            for chunk in stream_user_query_with_ai(user_input, ai_stats, structured, agent):
+                chunks.put(chunk)
+                if race.ledger.lost('ai'):
+                    break
+        except BaseException as e:
+            chunks.put(e)
+        chunks.put(None)
+
+    race.start_ai_path(run_ai_path)
+    try:
+        try:
+            first = chunks.get(timeout=deadline)
+        except queue.Empty:
+            first = None
+        if isinstance(first, str) and race.ledger.decide('ai'):
+            yield first
+            for chunk in iter(chunks.get, None):
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield chunk
+            stats.update(ai_stats)
+        else:
+            race.ledger.decide('pattern')
+            reply = _answer_hybrid_with_patterns(user_input, stats, race.ledger, agent)
+            stats['ttft_ms'] = (time.perf_counter() - race.started) * 1000
+            yield reply
+        race.finish(stats, deadline)
+    finally:
+        race.close()
+
+
+def _answer_hybrid_with_patterns(user_input: str, stats: Dict, ledger: SideEffectLedger, agent: Optional[Dict]) -> str:
+    token = _race_path.set((ledger, 'pattern'))
+    try:
+        stats['mode'] = 'pattern'
+        reply = handle_user_query(user_input, agent['tools'] if agent is not None else None, stats)
+    finally:
+        _race_path.reset(token)
+    # Writes the LLM made before the deadline that this reply doesn't already mention
+    done_by_ai = ledger.unshared_results('ai')
+    if done_by_ai:
+        reply += "\n\n" + "\n".join(str(result) for result in done_by_ai)
+    return reply
+
+
+def _plan_ai_turn(user_input: str, stats: Dict, structured: bool, agent: Optional[Dict]) -> Tuple[Optional[object], str]:
+    """Run everything up to the final generation.
+
+    Returns (llm, reply prompt), or (None, reply) when the answer needs no generation.
+    """
+    if agent is None:
+        with span('turn.health_check'):
+            available = check_ollama_status()
+        if not available:
             # Fallback to pattern matching if Ollama is not responding
-            return handle_user_query(user_input)
-        
-        # First, let the AI understand what the user wants
-        understanding_prompt = f"""
+            stats['mode'] = 'pattern'
+            return None, handle_user_query(user_input, stats=stats)
+        agent = create_ai_agent()
+
+    llm = agent['llm']
+    tools = agent['tools']
+    memory = agent.get('memory')
+    history = memory.render() if memory is not None else ""
+
+    response_prompt = None
+    if structured:
+        response_prompt = _plan_structured_turn(user_input, llm, tools, history)
+
+    if response_prompt is None:
+        stats['mode'] = 'multi_prompt'
+        response_prompt = _plan_multi_prompt_turn(user_input, llm, tools)
+
+    return llm, response_prompt
+
+
+def _fall_back_to_patterns(user_input: str, stats: Dict, error: Exception, agent: Optional[Dict]) -> str:
+    st.error(f"AI Error: {str(error)}")
+    stats['mode'] = 'pattern'
+    if agent is not None:
+        if agent.get('health_monitor') is not None:
+            agent['health_monitor'].record_failure(str(error))
+        return handle_user_query(user_input, agent['tools'], stats)
+    # Count towards the health circuit so later turns skip straight to pattern mode
+    get_health_monitor().record_failure(str(error))
+    # Fallback to pattern matching if AI fails
+    return handle_user_query(user_input, stats=stats)
+
+
+def _parse_structured_intent(text: str) -> Optional[Dict]:
+    """Pull the JSON object out of the model's reply; None if it is missing or malformed"""
+    start, end = text.find('{'), text.rfind('}')
+    if start == -1 or end <= start:
+        return None
+    try:
+        parsed = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(parsed, dict) or str(parsed.get('intent', '')).upper() not in AI_INTENTS:
+        return None
+    parsed['intent'] = parsed['intent'].upper()
+    return parsed
+
+
+def _plan_structured_turn(user_input: str, llm, tools: EcommerceTools, history: str = "") -> Optional[str]:
+    """Classify and extract in one call, run the tool, and return the prompt for the reply"""
+    # Earlier turns let the parser resolve "it" or "the cheaper one"
+    context = f"Conversation so far:\n{history}\n\n" if history else ""
+    structured_prompt = f"""
+You are the request parser for an e-commerce shopping assistant.
+Read the user message and reply with ONLY a JSON object using these keys:
+- "intent": one of SEARCH, ADD_TO_CART, VIEW_CART, PRODUCT_DETAILS, GREETING, OTHER
+- "search_terms": the product or category they are looking for, or ""
+- "product_id": the product ID number if they mention one, or ""
+- "product_name": the product name if they mention one, or ""
+- "quantity": how many items (default 1)
+- "max_price" / "min_price": price limits in dollars if they give any, or null
+- "min_rating": the lowest star rating they accept, or null
+- "in_stock": true if they only want items in stock
+- "sort": "price_asc" for cheapest first, "price_desc" for most expensive, "rating" for best rated, or "relevance"
+
+Examples:
+"I need a macbook" -> {{"intent": "SEARCH", "search_terms": "macbook", "product_id": "", "product_name": "", "quantity": 1}}
+"best rated shoes under $100 in stock" -> {{"intent": "SEARCH", "search_terms": "shoes", "product_id": "", "product_name": "", "quantity": 1, "max_price": 100, "in_stock": true, "sort": "rating"}}
+"add product ID 3 to cart" -> {{"intent": "ADD_TO_CART", "search_terms": "", "product_id": "3", "product_name": "", "quantity": 1}}
+"add two iPhones to my cart" -> {{"intent": "ADD_TO_CART", "search_terms": "", "product_id": "", "product_name": "iPhone", "quantity": 2}}
+"what's in my cart?" -> {{"intent": "VIEW_CART", "search_terms": "", "product_id": "", "product_name": "", "quantity": 1}}
+
+{context}User message: "{user_input}"
+
+JSON:"""
+
+    with span('turn.classify_extract'):
+        parsed = _parse_structured_intent(llm.invoke(structured_prompt))
+    if parsed is None:
+        return None
+
+    set_turn_stat('mode', 'structured')
+    set_turn_stat('intent', parsed['intent'])
+
+    intent = parsed['intent']
+    search_terms = str(parsed.get('search_terms') or '').strip()
+    product_id = str(parsed.get('product_id') or '').strip()
+    product_name = str(parsed.get('product_name') or '').strip()
+    try:
+        quantity = max(1, int(parsed.get('quantity') or 1))
+    except (TypeError, ValueError):
+        quantity = 1
+
+    if intent == "SEARCH":
+        search_terms = search_terms or product_name or user_input
+        # Price / rating / stock limits go to the database as structured arguments
+        arguments = {key: parsed[key] for key in SEARCH_ARGUMENTS if parsed.get(key) not in (None, '', False)}
+        if arguments:
+            arguments['query'] = search_terms
+            result = tools.search_products_result(json.dumps(arguments))
+        else:
+            result = tools.search_products_result(search_terms)
+        return _search_response_prompt(search_terms, _prompt_tool_output(result))
+
+    if intent == "ADD_TO_CART":
+        product_info = product_id or product_name or search_terms
+        return _cart_response_prompt(_add_to_cart_by_identifier(tools, product_info, quantity))
+
+    if intent == "VIEW_CART":
+        return _view_cart_response_prompt(_prompt_tool_output(tools.cart_result()))
+
+    if intent == "PRODUCT_DETAILS":
+        if not product_id.isdigit() and (product_name or search_terms):
+            product_id = _first_product_id(tools.search_products_result(product_name or search_terms)) or ""
+        if product_id.isdigit():
+            result = tools.product_details_result(product_id)
+        else:
+            result = ToolResult('message', "Please specify the product ID you want details for.")
+        return _details_response_prompt(_prompt_tool_output(result))
+
+    if intent == "GREETING":
+        return _greeting_prompt(user_input)
+
+    return _general_prompt(user_input)
+
+
+def _plan_multi_prompt_turn(user_input: str, llm, tools: EcommerceTools) -> str:
+    """Classify, then extract, with separate LLM calls; returns the prompt for the reply"""
+    # First, let the AI understand what the user wants
+    understanding_prompt = f"""
 Analyze this user message and determine their intent: "{user_input}"
 
 What does the user want to do? Reply with just one of these actions:
@@ -831,14 +3470,16 @@ What does the user want to do? Reply with just one of these actions:
 - OTHER: if it's something else
 
 Intent:"""
-        
+    
+    with span('turn.classify'):
         intent_response = llm.invoke(understanding_prompt)
-        intent = intent_response.strip().upper()
-        
-        # Based on intent, extract relevant information and take action
-        if "SEARCH" in intent:
-            # Extract what they're searching for
-            search_prompt = f"""
+    intent = intent_response.strip().upper()
+    
+    # Based on intent, extract relevant information and take action
+    if "SEARCH" in intent:
+        set_turn_stat('intent', "SEARCH")
+        # Extract what they're searching for
+        search_prompt = f"""
 Extract the search terms from this message: "{user_input}"
 What product or category are they looking for? Reply with just the search terms.
 Examples:
@@ -847,24 +3488,16 @@ Examples:
 - "looking for running shoes" -> "running shoes"
 
 Search terms:"""
-            
+        
+        with span('turn.extract'):
             search_terms = llm.invoke(search_prompt).strip()
-            results = tools.search_products_tool(search_terms)
-            
-            # Generate natural response
-            response_prompt = f"""
-The user searched for "{search_terms}" and here are the results:
-{results}
-
-Write a natural, helpful response to the user about these search results. Be conversational and friendly.
-
-Response:"""
-            
-            return llm.invoke(response_prompt)
-            
-        elif "ADD_TO_CART" in intent:
-            # Extract product information
-            extract_prompt = f"""
+        results = tools.search_products_result(search_terms)
+        return _search_response_prompt(search_terms, _prompt_tool_output(results))
+        
+    elif "ADD_TO_CART" in intent:
+        set_turn_stat('intent', "ADD_TO_CART")
+        # Extract product information
+        extract_prompt = f"""
 The user wants to add something to cart: "{user_input}"
 Extract the product ID if mentioned, or the product name they want to add.
 If they mentioned a specific product from a previous search, try to identify it.
@@ -875,102 +3508,353 @@ Examples:
 - "add the iPhone to my cart" -> "iPhone"
 
 Product identifier:"""
-            
+        
+        with span('turn.extract'):
             product_info = llm.invoke(extract_prompt).strip()
-            
-            # Try to add to cart
-            if product_info.isdigit():
-                # It's a product ID
-                result = tools.add_to_cart_tool(product_info)
-            else:
-                # It's a product name, need to search first
-                search_results = tools.search_products_tool(product_info)
-                if "Found products:" in search_results:
-                    # Extract first product ID from search results
-                    import re
-                    id_match = re.search(r'ID: (\d+)', search_results)
-                    if id_match:
-                        product_id = id_match.group(1)
-                        result = tools.add_to_cart_tool(product_id)
-                    else:
-                        result = f"I found some products for '{product_info}' but couldn't determine which one you want. Please specify the product ID."
-                else:
-                    result = f"Sorry, I couldn't find any products matching '{product_info}'"
-            
-            # Generate natural response
-            response_prompt = f"""
+        return _cart_response_prompt(_add_to_cart_by_identifier(tools, product_info))
+        
+    elif "VIEW_CART" in intent:
+        set_turn_stat('intent', "VIEW_CART")
+        return _view_cart_response_prompt(_prompt_tool_output(tools.cart_result()))
+        
+    elif "PRODUCT_DETAILS" in intent:
+        set_turn_stat('intent', "PRODUCT_DETAILS")
+        # Extract product ID or name
+        extract_prompt = f"""
+Extract the product identifier from: "{user_input}"
+Look for product ID numbers or product names they want details about.
+
+Product identifier:"""
+        
+        with span('turn.extract'):
+            product_info = llm.invoke(extract_prompt).strip()
+        
+        if product_info.isdigit():
+            result = tools.product_details_result(product_info)
+        else:
+            result = ToolResult('message', "Please specify the product ID you want details for.")
+        return _details_response_prompt(_prompt_tool_output(result))
+        
+    elif "GREETING" in intent:
+        set_turn_stat('intent', "GREETING")
+        return _greeting_prompt(user_input)
+        
+    else:
+        set_turn_stat('intent', "OTHER")
+        return _general_prompt(user_input)
+
+
+def _first_product_id(search_results: ToolResult) -> Optional[str]:
+    return search_results.records[0]['id'] if search_results.kind == 'products' else None
+
+
+def _prompt_tool_output(result: ToolResult) -> str:
+    """Compact rendering of a tool result for a reply prompt; adds the tokens this saves
+    over the human-friendly text to the turn's 'prompt_tokens_saved'"""
+    compact = render_compact(result)
+    record_turn_stat('prompt_tokens_saved', max(0, estimate_tokens(render_human(result)) - estimate_tokens(compact)))
+    return compact
+
+
+def _add_to_cart_by_identifier(tools: EcommerceTools, product_info: str, quantity: int = 1) -> str:
+    """Add by product ID, or by the best search match when given a product name"""
+    if product_info.isdigit():
+        # It's a product ID
+        return tools.add_to_cart_tool(product_info, str(quantity))
+
+    # It's a product name, need to search first
+    product_id = _first_product_id(tools.search_products_result(product_info))
+    if product_id:
+        return tools.add_to_cart_tool(product_id, str(quantity))
+    return f"Sorry, I couldn't find any products matching '{product_info}'"
+
+
+def _search_response_prompt(search_terms: str, results: str) -> str:
+    return f"""
+The user searched for "{search_terms}" and here are the results:
+{results}
+
+Write a natural, helpful response to the user about these search results. Be conversational and friendly.
+
+Response:"""
+
+
+def _cart_response_prompt(result: str) -> str:
+    return LivePrompt(f"""
 The user tried to add something to cart and here's what happened:
 {result}
 
 Write a natural, conversational response about this cart operation.
 
-Response:"""
-            
-            return llm.invoke(response_prompt)
-            
-        elif "VIEW_CART" in intent:
-            cart_contents = tools.get_cart_tool("")
-            
-            response_prompt = f"""
+Response:""")
+
+
+def _view_cart_response_prompt(cart_contents: str) -> str:
+    return LivePrompt(f"""
 The user wants to see their cart. Here's what's in it:
 {cart_contents}
 
 Write a natural, friendly response showing their cart contents.
 
-Response:"""
-            
-            return llm.invoke(response_prompt)
-            
-        elif "PRODUCT_DETAILS" in intent:
-            # Extract product ID or name
-            extract_prompt = f"""
-Extract the product identifier from: "{user_input}"
-Look for product ID numbers or product names they want details about.
+Response:""")
 
-Product identifier:"""
-            
-            product_info = llm.invoke(extract_prompt).strip()
-            
-            if product_info.isdigit():
-                result = tools.get_product_details_tool(product_info)
-            else:
-                result = "Please specify the product ID you want details for."
-            
-            response_prompt = f"""
+
+def _details_response_prompt(result: str) -> str:
+    return f"""
 The user requested product details and here's the information:
 {result}
 
 Write a natural, helpful response presenting this product information.
 
 Response:"""
-            
-            return llm.invoke(response_prompt)
-            
-        elif "GREETING" in intent:
-            greeting_prompt = f"""
+
+
+def _greeting_prompt(user_input: str) -> str:
+    return f"""
 The user said: "{user_input}"
 Write a warm, friendly greeting response as an e-commerce shopping assistant. 
 Briefly mention what you can help with.
 
 Response:"""
-            
-            return llm.invoke(greeting_prompt)
-            
-        else:
-            # Handle other cases
-            general_prompt = f"""
+
+
+def _general_prompt(user_input: str) -> str:
+    return f"""
 The user said: "{user_input}"
 As an e-commerce shopping assistant, provide a helpful response. If you're not sure what they want, 
 ask for clarification and mention what you can help with.
 
 Response:"""
-            
-            return llm.invoke(general_prompt)
-            
-    except Exception as e:
-        st.error(f"AI Error: {str(e)}")
-        # Fallback to pattern matching if AI fails
-        return handle_user_query(user_input)
+    
+
+# Chat service: session-aware entry point shared by the Streamlit UI and api_server.py
+
+# Idle chat sessions expire after this many seconds; beyond MAX_CHAT_SESSIONS the least
+# recently used ones are dropped
+CHAT_SESSION_TTL = 30 * 60
+MAX_CHAT_SESSIONS = 10000
+
+# Tool operations exposed by ChatService.call_tool: name -> (EcommerceTools method, argument names)
+SERVICE_TOOLS = {
+    'search_products': ('search_products_result', ('query',)),
+    'product_details': ('product_details_result', ('product_id',)),
+    'cart': ('cart_result', ()),
+    'recommendations': ('recommendations_result', ('product_id',)),
+    'add_to_cart': ('add_to_cart_tool', ('product_id', 'quantity')),
+    'add_to_wishlist': ('add_to_wishlist_tool', ('product_id',)),
+}
+
+
+class ChatSessionNotFound(KeyError):
+    pass
+
+
+@dataclass
+class ChatSession:
+    session_id: str
+    user_id: str
+    tools: EcommerceTools
+    agent: Optional[Dict] = None
+    history: List[Dict] = field(default_factory=list)
+    # What AI turns see of earlier turns (history is what the client sees)
+    memory: ConversationMemory = field(default_factory=ConversationMemory)
+    last_active: float = field(default_factory=time.time)
+    # Serializes turns within one session, so its history stays in order
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+class ChatService:
+    """Chat turns and tool calls for many concurrent sessions over one EcommerceDB.
+
+    Each session has its own user (cart, wishlist), tools and bounded history. With an llm
+    (e.g. fake_llm.StandInLLM) AI turns always use it; without one they use Ollama through
+    the shared cached LLM while the health monitor reports it up, and pattern matching
+    otherwise. Every method is blocking and thread-safe; api_server.py runs them in a pool.
+    """
+
+    def __init__(self, db: EcommerceDB, semantic_index: Optional['SemanticIndex'] = None, llm=None,
+                 health_monitor: Optional['OllamaHealthMonitor'] = None, session_ttl: float = CHAT_SESSION_TTL,
+                 max_sessions: int = MAX_CHAT_SESSIONS, hybrid_deadline: Optional[float] = None):
+        self.db = db
+        self.semantic_index = semantic_index
+        self.llm = llm
+        self.health_monitor = health_monitor
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
+        # When set, 'auto' turns race the LLM against this many seconds (see handle_user_query_hybrid)
+        self.hybrid_deadline = hybrid_deadline
+        self._sessions: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create_session(self, user_id: str = "user1", session_id: Optional[str] = None) -> ChatSession:
+        """Start a session for user_id (registered on first use)"""
+        self.db.add_user(user_id, user_id)
+        session = ChatSession(session_id or os.urandom(16).hex(), user_id,
+                              EcommerceTools(self.db, self.semantic_index, user_id=user_id))
+        with self._lock:
+            self._expire(time.time())
+            self._sessions[session.session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session
+
+    def get_session(self, session_id: str) -> ChatSession:
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                raise ChatSessionNotFound(session_id)
+            self._sessions.move_to_end(session_id)
+            session.last_active = now
+            return session
+
+    def end_session(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def session_count(self) -> int:
+        with self._lock:
+            self._expire(time.time())
+            return len(self._sessions)
+
+    def _expire(self, now: float):
+        # Sessions are ordered by last use, so expired ones are at the front
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_active <= self.session_ttl:
+                break
+            self._sessions.popitem(last=False)
+
+    def ai_available(self) -> bool:
+        """Whether 'auto' turns would use an LLM right now (may probe Ollama on first call)"""
+        return self.llm is not None or (self.health_monitor or get_health_monitor()).is_available()
+
+    def _ai_agent(self, session: ChatSession) -> Optional[Dict]:
+        """The session's AI agent, or None when turns should use pattern matching"""
+        if self.llm is None:
+            monitor = self.health_monitor or get_health_monitor()
+            with span('turn.health_check'):
+                if not monitor.is_available():
+                    return None
+        if session.agent is None:
+            if self.llm is not None:
+                session.agent = build_ai_agent(self.llm, self.db, self.semantic_index, session.user_id,
+                                               memory=session.memory)
+            else:
+                session.agent = build_ai_agent(get_cached_llm(), self.db, self.semantic_index, session.user_id,
+                                               health_monitor=self.health_monitor or get_health_monitor(),
+                                               memory=session.memory)
+            # Evicted turns are summarized by the same LLM
+            session.memory.summarizer = session.agent['llm']
+        return session.agent
+
+    def chat(self, session_id: str, message: str, mode: str = 'auto') -> Dict:
+        """One turn: mode 'pattern' (handle_user_query), 'ai' (handle_user_query_with_ai),
+        'hybrid' (handle_user_query_hybrid) or 'auto' (hybrid when hybrid_deadline is set, else ai).
+
+        Returns the reply with the turn's stats; 'ai' and 'hybrid' fall back to patterns when no LLM is up.
+        """
+        session = self.get_session(session_id)
+        with session.lock:
+            stats = {}
+            agent = self._ai_agent(session) if mode != 'pattern' else None
+            race = mode == 'hybrid' or (mode == 'auto' and self.hybrid_deadline is not None)
+            if agent is not None and race:
+                deadline = self.hybrid_deadline if self.hybrid_deadline is not None else HYBRID_DEADLINE_SECONDS
+                reply = handle_user_query_hybrid(message, stats, deadline, agent)
+            elif agent is not None:
+                reply = handle_user_query_with_ai(message, stats, agent=agent)
+            else:
+                stats['mode'] = 'pattern'
+                reply = handle_user_query(message, session.tools, stats)
+            self._remember(session, message, reply, stats)
+        return {'session_id': session_id, 'reply': reply, 'stats': stats}
+
+    def stream_chat(self, session_id: str, message: str, stats: Optional[Dict] = None) -> Iterator[str]:
+        """Like chat(mode='auto'), yielding the reply as it is generated"""
+        stats = stats if stats is not None else {}
+        session = self.get_session(session_id)
+        with session.lock:
+            agent = self._ai_agent(session)
+            if agent is not None:
+                if self.hybrid_deadline is not None:
+                    chunks = stream_user_query_hybrid(message, stats, self.hybrid_deadline, agent)
+                else:
+                    chunks = stream_user_query_with_ai(message, stats, agent=agent)
+                parts = []
+                for chunk in chunks:
+                    parts.append(chunk)
+                    yield chunk
+                reply = ''.join(parts)
+            else:
+                stats['mode'] = 'pattern'
+                reply = handle_user_query(message, session.tools, stats)
+                yield reply
+            self._remember(session, message, reply, stats)
+
+    @staticmethod
+    def _remember(session: ChatSession, message: str, reply: str, stats: Dict):
+        # Background summaries of evicted turns that finished since the previous turn
+        for key, value in session.memory.take_usage().items():
+            stats[f'memory_{key}'] = value
+        session.history.append({"role": "user", "content": message})
+        session.history.append({"role": "assistant", "content": reply, **stats})
+        if len(session.history) > MAX_CHAT_HISTORY:
+            del session.history[:len(session.history) - MAX_CHAT_HISTORY]
+        session.memory.add_turn(message, reply)
+
+    def history(self, session_id: str) -> List[Dict]:
+        session = self.get_session(session_id)
+        with session.lock:
+            return list(session.history)
+
+    def call_tool(self, session_id: str, name: str, arguments: Dict) -> Dict:
+        """Run one of SERVICE_TOOLS for the session's user.
+
+        Returns {'text': human-readable output} plus the structured 'result' for tools that
+        produce a ToolResult. Search arguments may include any of SEARCH_ARGUMENTS.
+        """
+        if name not in SERVICE_TOOLS:
+            raise ValueError(f"unknown tool '{name}'; use one of {', '.join(SERVICE_TOOLS)}")
+        method, argument_names = SERVICE_TOOLS[name]
+        session = self.get_session(session_id)
+        if name == 'search_products':
+            unknown = set(arguments) - set(SEARCH_ARGUMENTS)
+            if unknown:
+                raise ValueError(f"unknown arguments {', '.join(sorted(unknown))}")
+            # Filters go through the tool's JSON form
+            args = [json.dumps(arguments) if set(arguments) - {'query'} else str(arguments.get('query', ''))]
+        else:
+            unknown = set(arguments) - set(argument_names)
+            if unknown:
+                raise ValueError(f"unknown arguments {', '.join(sorted(unknown))}")
+            args = [str(arguments[key]) for key in argument_names if key in arguments]
+        output = getattr(session.tools, method)(*args)
+        if isinstance(output, ToolResult):
+            return {'text': render_human(output), 'result': asdict(output)}
+        return {'text': output}
+
+
+@st.cache_resource
+def get_chat_service() -> ChatService:
+    """Process-wide chat service used by the Streamlit pages (hybrid turns, so a slow LLM can't stall them)"""
+    return ChatService(get_shared_db(), get_semantic_index(), hybrid_deadline=HYBRID_DEADLINE_SECONDS)
+
+
+def chat_session_id(key: str = 'chat_session_id') -> str:
+    """This browser session's chat service session (the demo shopper, user1).
+
+    Each page keeps its own under `key`, so turns from the Agent Testing page never reach the
+    shopping chat's history or conversation memory.
+    """
+    service = get_chat_service()
+    session_id = st.session_state.get(key)
+    try:
+        service.get_session(session_id)
+    except ChatSessionNotFound:
+        session_id = st.session_state[key] = service.create_session("user1").session_id
+    return session_id
     
 
 if __name__ == "__main__":
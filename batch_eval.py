@@ -0,0 +1,267 @@
+"""Batch evaluation: replay a log of utterances through the assistant.
+
+Streams a JSONL file of utterances through handle_user_query (pattern path, spread over
+a process pool) or handle_user_query_with_ai (LLM path, a bounded pool of threads, since
+those turns mostly wait on the model) and writes one JSONL result per utterance, in input
+order, with the intent, the tools called, the response and the latency:
+
+    python batch_eval.py utterances.jsonl --mode pattern --workers 8 --output eval_results.jsonl
+    python batch_eval.py utterances.jsonl --mode ai --concurrency 4 --stand-in-llm
+    python batch_eval.py utterances.jsonl --resume         # continue an interrupted run
+
+Each input line is a JSON object with an "utterance" (other fields, such as an id or an
+expected intent, are copied to the result) or a bare JSON string. Turns run against --db;
+cart and wishlist writes land there, so point it at a copy of a real catalog. The default
+':memory:' gives every worker its own sample catalog.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from app import (HYBRID_DEADLINE_SECONDS, CachedLLM, CountingLLM, EcommerceDB, EcommerceTools, LLMScheduler,
+                 build_ai_agent, handle_user_query, handle_user_query_hybrid, handle_user_query_with_ai,
+                 initialize_llm, llm_priority)
+from benchmark import percentiles
+
+MODES = ['pattern', 'ai', 'ai_multi_prompt', 'hybrid']
+
+# Pattern turns sent to a worker process at a time, so pickling doesn't dominate
+PATTERN_CHUNK_SIZE = 64
+
+# Seconds between progress lines on stderr
+PROGRESS_INTERVAL = 5.0
+
+# Tools (and agent, for LLM turns) of this process; set by _init_worker
+_worker_state: Dict = {}
+
+
+def read_utterances(path: str, offset: int = 0) -> Iterator[Dict]:
+    """Input records from line `offset` on (0-based, blank lines included), each tagged with its offset"""
+    with open(path, encoding='utf-8') as f:
+        for index, line in enumerate(itertools.islice(f, offset, None), start=offset):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = {'error': "invalid JSON"}
+            else:
+                if isinstance(record, str):
+                    record = {'utterance': record}
+                elif not isinstance(record, dict) or not isinstance(record.get('utterance'), str):
+                    record = {'error': "expected a JSON string or an object with an 'utterance'"}
+            record['offset'] = index
+            yield record
+
+
+def _init_worker(mode: str, db_path: str, semantic: bool, stand_in_llm: bool, llm_latency: float):
+    """Build this process's database, tools and (for LLM modes) agent"""
+    db = EcommerceDB(db_path)
+    db.add_user("user1", "Batch Evaluation")
+    semantic_index = None
+    if semantic:
+        from semantic_index import SemanticIndex
+        semantic_index = SemanticIndex.build(db)
+    _worker_state['tools'] = EcommerceTools(db, semantic_index)
+    if mode != 'pattern':
+        if stand_in_llm:
+            from fake_llm import StandInLLM
+            llm = CachedLLM(CountingLLM(StandInLLM(latency=llm_latency)))
+        else:
+            llm = CachedLLM(CountingLLM(LLMScheduler(initialize_llm())))
+        _worker_state['agent'] = build_ai_agent(llm, db, semantic_index)
+
+
+def evaluate(record: Dict, mode: str, deadline: float = HYBRID_DEADLINE_SECONDS) -> Dict:
+    """Run one input record through the assistant; the result record to write"""
+    if 'error' in record:
+        return record
+    stats: Dict = {}
+    started = time.perf_counter()
+    try:
+        # Behind interactive chat in the Ollama queue
+        with llm_priority('batch'):
+            if mode == 'pattern':
+                response = handle_user_query(record['utterance'], _worker_state['tools'], stats)
+            elif mode == 'hybrid':
+                response = handle_user_query_hybrid(record['utterance'], stats, deadline, _worker_state['agent'])
+            else:
+                response = handle_user_query_with_ai(record['utterance'], stats, structured=(mode == 'ai'),
+                                                     agent=_worker_state['agent'])
+        error = None
+    except Exception as e:
+        response, error = None, f"{type(e).__name__}: {e}"
+    result = dict(record)
+    result.update({
+        'mode': stats.get('mode', mode),
+        'intent': stats.get('intent') or stats.get('pattern_intent'),
+        'tools': stats.get('tools', []),
+        'response': response,
+        'latency_ms': round((time.perf_counter() - started) * 1000, 3),
+        'llm_calls': stats.get('llm_calls', 0),
+    })
+    if 'race_winner' in stats:
+        result['race_winner'] = stats['race_winner']
+    if error:
+        result['error'] = error
+    return result
+
+
+def _evaluate_pattern_chunk(records: List[Dict]) -> List[Dict]:
+    return [evaluate(record, 'pattern') for record in records]
+
+
+def _chunks(records: Iterable[Dict], size: int) -> Iterator[List[Dict]]:
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ordered_map(executor: Executor, func, items: Iterable, window: int) -> Iterator:
+    """executor.map that keeps at most `window` items in flight, so a huge input streams in bounded memory"""
+    pending: deque = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def run_batch(input_path: str, output, mode: str = 'pattern', offset: int = 0, workers: int = 0,
+              concurrency: int = 4, db_path: str = ':memory:', semantic: bool = False,
+              stand_in_llm: bool = False, llm_latency: float = 0.0, limit: Optional[int] = None,
+              deadline: float = HYBRID_DEADLINE_SECONDS, progress=sys.stderr) -> Dict:
+    """Evaluate input_path from line `offset`, writing results to the open file `output`; returns the summary"""
+    records = read_utterances(input_path, offset)
+    if limit is not None:
+        records = itertools.islice(records, limit)
+    worker_args = (mode, db_path, semantic, stand_in_llm, llm_latency)
+
+    if mode == 'pattern':
+        workers = workers or os.cpu_count() or 1
+        executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=worker_args)
+        batches = ordered_map(executor, _evaluate_pattern_chunk, _chunks(records, PATTERN_CHUNK_SIZE), workers * 2)
+        results = itertools.chain.from_iterable(batches)
+    else:
+        # One agent shared by the threads; turn stats are per thread (see _active_turn in app.py)
+        _init_worker(*worker_args)
+        executor = ThreadPoolExecutor(concurrency, thread_name_prefix="eval")
+        results = ordered_map(executor, lambda record: evaluate(record, mode, deadline), records, concurrency * 2)
+
+    latencies: List[float] = []
+    intents: Counter = Counter()
+    winners: Counter = Counter()
+    processed = errors = 0
+    last_offset = None
+    started = last_report = time.perf_counter()
+    with executor:
+        for result in results:
+            output.write(json.dumps(result) + '\n')
+            last_offset = result['offset']
+            processed += 1
+            if 'error' in result:
+                errors += 1
+            if 'latency_ms' in result:
+                latencies.append(result['latency_ms'])
+                intents[result['intent'] or 'none'] += 1
+            if 'race_winner' in result:
+                winners[result['race_winner']] += 1
+
+            now = time.perf_counter()
+            if progress is not None and now - last_report >= PROGRESS_INTERVAL:
+                output.flush()
+                last_report = now
+                print(f"  {processed} done (through line {last_offset}), {processed / (now - started):.1f}/s",
+                      file=progress)
+    output.flush()
+    wall_seconds = time.perf_counter() - started
+
+    return {
+        'mode': mode,
+        'workers': workers if mode == 'pattern' else concurrency,
+        'start_offset': offset,
+        'next_offset': last_offset + 1 if last_offset is not None else offset,
+        'processed': processed,
+        'errors': errors,
+        'wall_seconds': wall_seconds,
+        'throughput_per_second': processed / wall_seconds if wall_seconds else None,
+        'latency_ms': percentiles(latencies) if latencies else None,
+        'intents': dict(intents.most_common()),
+        'race_winners': dict(winners),
+    }
+
+
+def resume_offset(output_path: str) -> int:
+    """Input offset after the last complete result in output_path (a partly written last line is dropped)"""
+    if not os.path.exists(output_path):
+        return 0
+    with open(output_path, 'rb+') as f:
+        data = f.read()
+        complete = data[:data.rfind(b'\n') + 1]
+        if len(complete) < len(data):
+            f.truncate(len(complete))
+    lines = complete.splitlines()
+    return json.loads(lines[-1])['offset'] + 1 if lines else 0
+
+
+def format_summary(summary: Dict) -> str:
+    lines = [
+        f"{summary['mode']} x{summary['workers']}: {summary['processed']} utterances "
+        f"(lines {summary['start_offset']}-{summary['next_offset'] - 1}) in {summary['wall_seconds']:.1f}s, "
+        f"{summary['throughput_per_second'] or 0:.1f}/s, {summary['errors']} errors"
+    ]
+    if summary['latency_ms']:
+        latency = summary['latency_ms']
+        lines.append(f"    latency p50={latency['p50']:.3f}ms p95={latency['p95']:.3f}ms "
+                     f"p99={latency['p99']:.3f}ms max={latency['max']:.3f}ms")
+    if summary['race_winners']:
+        lines.append("    answered by: " + ", ".join(f"{path} {count}" for path, count in summary['race_winners'].items()))
+    for intent, count in summary['intents'].items():
+        lines.append(f"    {intent:<16} {count}")
+    lines.append(f"Resume with --offset {summary['next_offset']} (or --resume)")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help="JSONL file of utterances")
+    parser.add_argument('--output', default='eval_results.jsonl', help="JSONL results file")
+    parser.add_argument('--mode', default='pattern', choices=MODES)
+    parser.add_argument('--offset', type=int, default=0, help="first input line to evaluate (0-based)")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue after the last result already in --output, appending to it")
+    parser.add_argument('--limit', type=int, help="evaluate at most this many utterances")
+    parser.add_argument('--workers', type=int, default=0, help="pattern-mode processes (default: one per CPU)")
+    parser.add_argument('--concurrency', type=int, default=4, help="LLM turns in flight at once in the AI modes")
+    parser.add_argument('--db', default=':memory:', help="catalog database each worker opens")
+    parser.add_argument('--semantic', action='store_true', help="blend semantic matches into product search")
+    parser.add_argument('--stand-in-llm', action='store_true', help="answer with fake_llm.StandInLLM instead of Ollama")
+    parser.add_argument('--llm-latency', type=float, default=0.0, help="stand-in LLM seconds per call")
+    parser.add_argument('--deadline', type=float, default=HYBRID_DEADLINE_SECONDS,
+                        help="hybrid mode: seconds to wait for the LLM before answering from patterns")
+    parser.add_argument('--summary-output', help="also write the summary as JSON here")
+    args = parser.parse_args()
+
+    offset = resume_offset(args.output) if args.resume else args.offset
+    with open(args.output, 'a' if args.resume else 'w', encoding='utf-8') as output:
+        summary = run_batch(args.input, output, args.mode, offset, args.workers, args.concurrency, args.db,
+                            args.semantic, args.stand_in_llm, args.llm_latency, args.limit, args.deadline)
+    print(format_summary(summary))
+    if args.summary_output:
+        with open(args.summary_output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
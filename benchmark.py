@@ -0,0 +1,237 @@
+"""Offline benchmark for the chat pipeline.
+
+Replays a scripted shopper corpus (the chat page's example prompts, the Agent Testing
+scenarios and templated variants) through handle_user_query and
+handle_user_query_with_ai against synthetic catalogs of any size, using the stand-in
+LLM from fake_llm.py, so no network or Ollama is needed:
+
+    python benchmark.py --products 10 1000 100000 --turns 500 --output bench_results.json
+
+Each run reports per-intent p50/p95/p99 latency, LLM calls, SQL statements and prompt
+tokens per turn, and throughput. Results are written as JSON so two runs can be diffed.
+"""
+import argparse
+import json
+import math
+import platform
+import random
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
+
+from app import (EXAMPLE_PROMPTS, SAMPLE_PRODUCTS, TEST_SCENARIOS, CachedLLM, CountingLLM, EcommerceDB,
+                 EcommerceTools, Product, build_ai_agent, handle_user_query, handle_user_query_with_ai)
+from fake_llm import StandInLLM
+from semantic_index import SemanticIndex
+
+
+# Expected intent of every scripted utterance (labels use the AI path's intent names)
+CORPUS_LABELS = {
+    "Hi there!": "GREETING",
+    "I'm looking for a laptop": "SEARCH",
+    "Show me some smartphones": "SEARCH",
+    "Add the MacBook to my cart": "ADD_TO_CART",
+    "What's in my cart?": "VIEW_CART",
+    "Hello, how are you?": "GREETING",
+    "I need a new laptop for work": "SEARCH",
+    "Show me the best smartphones you have": "SEARCH",
+    "Can you add that MacBook to my shopping cart?": "ADD_TO_CART",
+    "What do I have in my cart right now?": "VIEW_CART",
+    "Tell me more details about the iPhone": "PRODUCT_DETAILS",
+    "I'm looking for running shoes": "SEARCH",
+    "Add product number 1 to my cart please": "ADD_TO_CART",
+}
+
+TEMPLATES = [
+    ("I'm looking for {noun}", "SEARCH"),
+    ("find me a {adjective} {noun}", "SEARCH"),
+    ("show details for product ID {product_id}", "PRODUCT_DETAILS"),
+    ("add product ID {product_id} to cart", "ADD_TO_CART"),
+    ("show my cart", "VIEW_CART"),
+]
+
+# Vocabulary for synthetic products: category -> (nouns, brands)
+CATALOG_VOCABULARY = {
+    "Electronics": (["laptop", "smartphone", "tablet", "headphones", "camera", "monitor", "console", "earbuds"],
+                    ["Apple", "Samsung", "Sony", "Dell", "Lenovo", "Bose", "Canon", "LG"]),
+    "Fashion": (["shoes", "jeans", "jacket", "sneakers", "dress", "backpack", "watch", "hoodie"],
+                ["Nike", "Levi's", "Adidas", "Zara", "Puma", "Uniqlo", "Casio", "H&M"]),
+    "Books": (["novel", "cookbook", "biography", "thriller", "atlas", "poetry", "textbook", "memoir"],
+              ["Penguin", "Vintage", "Harper", "Scholastic", "Oxford", "Tor", "Knopf", "Orbit"]),
+    "Home & Kitchen": (["vacuum", "blender", "kettle", "toaster", "air fryer", "lamp", "cookware", "mixer"],
+                       ["Dyson", "Instant Pot", "Philips", "KitchenAid", "Ninja", "Breville", "Tefal", "Shark"]),
+    "Sports": (["yoga mat", "dumbbells", "tennis racket", "bike helmet", "football", "treadmill", "tent", "bottle"],
+               ["Wilson", "Decathlon", "Garmin", "Coleman", "Yeti", "Bowflex", "Spalding", "Giro"]),
+}
+
+ADJECTIVES = ["lightweight", "wireless", "classic", "premium", "compact", "durable", "portable", "waterproof"]
+
+
+def generate_catalog(size: int, seed: int = 0) -> Iterator[Product]:
+    """Deterministic synthetic catalog: the sample products first, then generated ones (ids 11..size)"""
+    rng = random.Random(seed)
+    categories = list(CATALOG_VOCABULARY)
+    for product in SAMPLE_PRODUCTS[:size]:
+        yield product
+    for index in range(len(SAMPLE_PRODUCTS) + 1, size + 1):
+        category = categories[index % len(categories)]
+        nouns, brands = CATALOG_VOCABULARY[category]
+        noun, brand, adjective = rng.choice(nouns), rng.choice(brands), rng.choice(ADJECTIVES)
+        yield Product(
+            str(index),
+            f"{brand} {noun.title()} {rng.randint(100, 999)}",
+            category,
+            round(rng.uniform(5, 2500), 2),
+            f"{adjective.capitalize()} {noun} from {brand}",
+            rng.randint(0, 500),
+            round(rng.uniform(3.0, 5.0), 1),
+            [noun, brand.lower(), adjective],
+        )
+
+
+def build_catalog_db(size: int, seed: int = 0) -> Tuple[EcommerceDB, float]:
+    started = time.perf_counter()
+    db = EcommerceDB(sample_data=False)
+    with db.bulk_load():
+        db.add_products(generate_catalog(size, seed))
+    db.add_user("user1", "Benchmark Shopper")
+    return db, time.perf_counter() - started
+
+
+def build_corpus(catalog_size: int, seed: int = 0) -> List[Tuple[str, str]]:
+    """(utterance, expected intent) pairs: the scripted prompts plus templated variants"""
+    rng = random.Random(seed)
+    corpus = [(utterance, CORPUS_LABELS.get(utterance, "OTHER")) for utterance in EXAMPLE_PROMPTS + TEST_SCENARIOS]
+    nouns = [noun for nouns, _ in CATALOG_VOCABULARY.values() for noun in nouns]
+    for _ in range(len(corpus)):
+        template, intent = rng.choice(TEMPLATES)
+        corpus.append((template.format(noun=rng.choice(nouns), adjective=rng.choice(ADJECTIVES),
+                                       product_id=rng.randint(1, max(catalog_size, 1))), intent))
+    return corpus
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        # Nearest-rank percentile
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': rank(50),
+        'p95': rank(95),
+        'p99': rank(99),
+        'max': ordered[-1],
+    }
+
+
+def run_benchmark(mode: str, catalog_size: int, turns: int, llm_latency: float = 0.0,
+                  token_latency: float = 0.0, llm_cache: bool = False, seed: int = 0,
+                  semantic: bool = False) -> Dict:
+    """Replay `turns` utterances in one mode: 'pattern', 'ai' (structured) or 'ai_multi_prompt'"""
+    db, load_seconds = build_catalog_db(catalog_size, seed)
+    corpus = build_corpus(catalog_size, seed)
+    semantic_index = SemanticIndex.build(db) if semantic else None
+    tools = EcommerceTools(db, semantic_index)
+
+    stand_in = StandInLLM(latency=llm_latency, token_latency=token_latency)
+    llm = CountingLLM(stand_in)
+    if llm_cache:
+        llm = CachedLLM(llm)
+    agent = build_ai_agent(llm, db, semantic_index)
+
+    latencies: Dict[str, List[float]] = {}
+    llm_calls = 0
+    sql_statements = 0
+    prompt_tokens = 0
+    prompt_tokens_saved = 0
+    started = time.perf_counter()
+    for turn in range(turns):
+        utterance, intent = corpus[turn % len(corpus)]
+        stats: Dict = {}
+        queries_before = db.query_count
+        turn_started = time.perf_counter()
+        if mode == 'pattern':
+            handle_user_query(utterance, tools, stats)
+        else:
+            handle_user_query_with_ai(utterance, stats, structured=(mode == 'ai'), agent=agent)
+        elapsed_ms = (time.perf_counter() - turn_started) * 1000
+
+        sql_statements += db.query_count - queries_before
+        llm_calls += stats.get('llm_calls', 0)
+        prompt_tokens += stats.get('prompt_tokens', 0)
+        prompt_tokens_saved += stats.get('prompt_tokens_saved', 0)
+        latencies.setdefault(intent, []).append(elapsed_ms)
+        latencies.setdefault('ALL', []).append(elapsed_ms)
+    wall_seconds = time.perf_counter() - started
+
+    return {
+        'mode': mode,
+        'products': catalog_size,
+        'semantic': semantic,
+        'turns': turns,
+        'load_seconds': load_seconds,
+        'throughput_turns_per_second': turns / wall_seconds if wall_seconds else None,
+        'llm_calls_per_turn': llm_calls / turns,
+        'sql_statements_per_turn': sql_statements / turns,
+        'prompt_tokens_per_turn': prompt_tokens / turns,
+        'prompt_tokens_saved_per_turn': prompt_tokens_saved / turns,
+        'latency_ms': {intent: percentiles(samples) for intent, samples in sorted(latencies.items())},
+    }
+
+
+def format_run(run: Dict) -> str:
+    lines = [
+        f"{run['mode']:<16} products={run['products']:<9} turns={run['turns']:<6} "
+        f"{run['throughput_turns_per_second']:.1f} turns/s  llm/turn={run['llm_calls_per_turn']:.2f}  "
+        f"sql/turn={run['sql_statements_per_turn']:.2f}  load={run['load_seconds']:.2f}s",
+        f"    prompt tokens/turn={run['prompt_tokens_per_turn']:.0f}  "
+        f"saved by compact tool output/turn={run['prompt_tokens_saved_per_turn']:.0f}"
+    ]
+    for intent, summary in run['latency_ms'].items():
+        lines.append(f"    {intent:<16} n={summary['count']:<6} p50={summary['p50']:.3f}ms "
+                     f"p95={summary['p95']:.3f}ms p99={summary['p99']:.3f}ms")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, nargs='+', default=[10, 1000, 10000],
+                        help="catalog sizes to benchmark (10 to 1000000)")
+    parser.add_argument('--modes', nargs='+', default=['pattern', 'ai', 'ai_multi_prompt'],
+                        choices=['pattern', 'ai', 'ai_multi_prompt'])
+    parser.add_argument('--turns', type=int, default=200, help="utterances replayed per run")
+    parser.add_argument('--llm-latency', type=float, default=0.0, help="stand-in LLM seconds per call")
+    parser.add_argument('--token-latency', type=float, default=0.0, help="stand-in LLM seconds per generated word")
+    parser.add_argument('--llm-cache', action='store_true', help="put CachedLLM in front of the stand-in LLM")
+    parser.add_argument('--semantic', action='store_true', help="blend semantic matches into product search")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json', help="where to write the JSON results")
+    args = parser.parse_args()
+
+    runs = []
+    for size in args.products:
+        for mode in args.modes:
+            run = run_benchmark(mode, size, args.turns, args.llm_latency, args.token_latency, args.llm_cache, args.seed,
+                                args.semantic)
+            print(format_run(run))
+            runs.append(run)
+
+    results = {
+        'meta': {
+            'created_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'runs': runs,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
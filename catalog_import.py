@@ -0,0 +1,210 @@
+"""Streaming catalog importer for EcommerceDB.
+
+Loads product exports in CSV, JSON Lines or Parquet format into the shared catalog
+database in constant memory: records are read lazily, validated into Product, and
+written with executemany in large batched transactions:
+
+    python catalog_import.py products.csv --db ecommerce.db
+    python catalog_import.py nightly_delta.jsonl --incremental
+
+A full import defers index maintenance until the end of the load (EcommerceDB.bulk_load).
+Both modes upsert, so only new or changed SKUs are rewritten; --incremental keeps the
+index triggers live, which is cheaper for small deltas against a large catalog.
+
+Expected fields: id, name, category, price, and optionally description, stock, rating
+and tags (a list, a JSON array, or a '|' or ',' separated string).
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import time
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from app import DB_PATH, EcommerceDB, Product
+
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.parquet': 'parquet'}
+
+# Rejected rows kept in the report, so a bad export doesn't fill memory with errors
+MAX_REPORTED_ERRORS = 20
+
+# Key of the record a reader yields for a row it could not parse; to_product rejects it
+# with the message stored under it
+UNREADABLE = '_unreadable'
+
+
+@dataclass
+class ImportReport:
+    rows_read: int = 0
+    rows_written: int = 0
+    rows_unchanged: int = 0
+    rows_rejected: int = 0
+    seconds: float = 0.0
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows_read / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        return (f"{self.rows_read} rows read, {self.rows_written} written, {self.rows_unchanged} unchanged, "
+                f"{self.rows_rejected} rejected in {self.seconds:.1f}s ({self.rows_per_second:,.0f} rows/s)")
+
+
+def read_csv(path: str) -> Iterator[Dict]:
+    with open(path, newline='', encoding='utf-8') as f:
+        yield from csv.DictReader(f)
+
+
+def read_jsonl(path: str) -> Iterator[Dict]:
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                record = {UNREADABLE: f"line {number}: invalid JSON ({e.msg})"}
+            if not isinstance(record, dict):
+                record = {UNREADABLE: f"line {number}: expected a JSON object"}
+            yield record
+
+
+def read_parquet(path: str, batch_size: int = 50000) -> Iterator[Dict]:
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Reading Parquet files requires pyarrow: pip install pyarrow") from e
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+        yield from batch.to_pylist()
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl, 'parquet': read_parquet}
+
+
+def read_records(path: str, file_format: Optional[str] = None) -> Iterator[Dict]:
+    """Records from a catalog export; the format defaults to the file extension"""
+    file_format = file_format or FORMATS.get(os.path.splitext(path)[1].lower())
+    if file_format not in READERS:
+        raise ValueError(f"Unsupported catalog format for {path}; use one of {', '.join(READERS)}")
+    return READERS[file_format](path)
+
+
+def _parse_tags(value) -> List[str]:
+    if value is None or value == '':
+        return []
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith('['):
+            value = json.loads(value)
+        else:
+            value = value.split('|' if '|' in value else ',')
+    return [str(tag).strip() for tag in value if str(tag).strip()]
+
+
+def to_product(record: Dict) -> Product:
+    """Validate one export record; raises ValueError describing the first problem found"""
+    if UNREADABLE in record:
+        raise ValueError(record[UNREADABLE])
+    for required in ('id', 'name', 'category', 'price'):
+        if record.get(required) in (None, ''):
+            raise ValueError(f"missing {required}")
+
+    price = float(record['price'])
+    stock = int(record.get('stock') or 0)
+    rating = record.get('rating')
+    # Unrated products sort last; a NULL rating would break the keyset page cursors
+    rating = float(rating) if rating not in (None, '') else 0.0
+    if not math.isfinite(price):
+        raise ValueError(f"price {price} is not a finite number")
+    if price < 0:
+        raise ValueError(f"negative price {price}")
+    if stock < 0:
+        raise ValueError(f"negative stock {stock}")
+    if not 0 <= rating <= 5:
+        raise ValueError(f"rating {rating} outside 0-5")
+
+    return Product(
+        str(record['id']).strip(),
+        str(record['name']).strip(),
+        str(record['category']).strip(),
+        price,
+        str(record.get('description') or ''),
+        stock,
+        rating,
+        _parse_tags(record.get('tags')),
+    )
+
+
+def validate(records: Iterable[Dict], report: ImportReport) -> Iterator[Product]:
+    """Products from records, counting rejected rows in report instead of stopping"""
+    for line, record in enumerate(records, start=1):
+        report.rows_read += 1
+        try:
+            yield to_product(record)
+        except (ValueError, TypeError) as e:
+            report.rows_rejected += 1
+            if len(report.errors) < MAX_REPORTED_ERRORS:
+                report.errors.append(f"record {line}: {e}")
+
+
+def import_products(db: EcommerceDB, records: Iterable[Dict], batch_size: int = 50000,
+                    incremental: bool = False,
+                    progress: Optional[Callable[[ImportReport], None]] = None) -> ImportReport:
+    """Upsert records into db in batches of batch_size, calling progress after each batch"""
+    report = ImportReport()
+    products = validate(records, report)
+    started = time.perf_counter()
+
+    def load():
+        while True:
+            batch = list(islice(products, batch_size))
+            if not batch:
+                return
+            written = db.upsert_products(batch, batch_size)
+            report.rows_written += written
+            report.rows_unchanged += len(batch) - written
+            report.seconds = time.perf_counter() - started
+            if progress:
+                progress(report)
+
+    if incremental:
+        load()
+    else:
+        with db.bulk_load():
+            load()
+    report.seconds = time.perf_counter() - started
+    return report
+
+
+def import_catalog(db: EcommerceDB, path: str, file_format: Optional[str] = None, batch_size: int = 50000,
+                   incremental: bool = False,
+                   progress: Optional[Callable[[ImportReport], None]] = None) -> ImportReport:
+    """Stream a CSV / JSONL / Parquet catalog export into db (see import_products)"""
+    return import_products(db, read_records(path, file_format), batch_size, incremental, progress)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help="catalog export (.csv, .jsonl/.ndjson or .parquet)")
+    parser.add_argument('--db', default=DB_PATH, help="database file to load into (default: %(default)s)")
+    parser.add_argument('--format', choices=list(READERS), help="override the format implied by the extension")
+    parser.add_argument('--batch-size', type=int, default=50000, help="rows per transaction")
+    parser.add_argument('--incremental', action='store_true',
+                        help="keep search indexing live instead of rebuilding it after the load")
+    args = parser.parse_args()
+
+    db = EcommerceDB(args.db, sample_data=False)
+    report = import_catalog(db, args.path, args.format, args.batch_size, args.incremental,
+                            progress=lambda r: print(f"  {r.summary()}", flush=True))
+    print(report.summary())
+    for error in report.errors:
+        print(f"  rejected {error}")
+
+
+if __name__ == "__main__":
+    main()
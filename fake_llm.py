@@ -0,0 +1,156 @@
+"""Deterministic stand-in for OllamaLLM, for benchmarks and offline runs.
+
+StandInLLM answers every prompt that app.py sends (structured intent JSON, the
+step-by-step intent/extraction prompts and the final reply prompts) from simple
+keyword rules, with configurable latency, so the chat pipeline can run without Ollama.
+"""
+import json
+import re
+import threading
+import time
+from typing import Dict, Iterator, Optional
+
+
+STOP_WORDS = {
+    'a', 'an', 'the', 'i', "i'm", 'im', 'me', 'my', 'you', 'your', 'have', 'some', 'any', 'for', 'to',
+    'of', 'in', 'on', 'with', 'please', 'can', 'could', 'would', 'show', 'find', 'search', 'looking',
+    'need', 'want', 'new', 'best', 'that', 'this', 'there', 'is', 'are', 'what', "what's", 'whats',
+    'do', 'right', 'now', 'add', 'cart', 'shopping', 'tell', 'more', 'about', 'details', 'info',
+    'product', 'number', 'id', 'work', 'hi', 'hello', 'hey', 'how', 'something',
+    'under', 'below', 'over', 'above', 'less', 'than', 'cheapest', 'cheap', 'rated', 'top', 'stock',
+    'stars', 'star', 'and', 'or',
+}
+
+# Where app.py's prompts quote the user's message (the quote closes at end of line)
+USER_MESSAGE_PATTERNS = [
+    re.compile(prefix + r' "(.*)"[ \t]*$', re.M)
+    for prefix in ('User message:', 'determine their intent:', 'from this message:',
+                   'add something to cart:', 'identifier from:', 'The user said:')
+]
+
+PRODUCT_ID = re.compile(r'\b(?:id|product|number|item)\s*(?:number\s*|#\s*)?(\d+)\b')
+MAX_PRICE = re.compile(r'\b(?:under|below|less than|up to)\s*\$?(\d+(?:\.\d+)?)')
+MIN_PRICE = re.compile(r'\b(?:over|above|more than|from)\s*\$?(\d+(?:\.\d+)?)')
+MIN_RATING = re.compile(r'\b(\d(?:\.\d)?)\s*(?:\+\s*)?stars?\b')
+
+
+def parse_message(message: str) -> Dict:
+    """Keyword-rule version of the structured intent JSON the real model is asked for"""
+    lower = message.lower()
+    words = re.findall(r"[a-z0-9']+", lower)
+    # Digits that belong to a price or rating limit aren't search terms
+    numbers = {digits for pattern in (MAX_PRICE, MIN_PRICE, MIN_RATING) for match in pattern.finditer(lower)
+               for digits in re.findall(r'\d+', match.group(0))}
+    content = [w for w in words if w not in STOP_WORDS and w not in numbers]
+    id_match = PRODUCT_ID.search(lower)
+    quantity = 1
+    quantity_match = re.search(r'\b(\d+)\s*x\b|\b(two|three|four|five)\b', lower)
+    if quantity_match:
+        quantity = {'two': 2, 'three': 3, 'four': 4, 'five': 5}.get(quantity_match.group(2), None) \
+            or int(quantity_match.group(1) or 1)
+
+    parsed = {'intent': 'OTHER', 'search_terms': '', 'product_id': '', 'product_name': '', 'quantity': quantity}
+    if 'cart' in words and 'add' in words:
+        parsed['intent'] = 'ADD_TO_CART'
+    elif 'cart' in words:
+        parsed['intent'] = 'VIEW_CART'
+    elif any(w in words for w in ('details', 'detail', 'info', 'more')):
+        parsed['intent'] = 'PRODUCT_DETAILS'
+    elif words and words[0] in ('hi', 'hello', 'hey'):
+        parsed['intent'] = 'GREETING'
+    elif content:
+        parsed['intent'] = 'SEARCH'
+
+    if id_match:
+        parsed['product_id'] = id_match.group(1)
+    elif parsed['intent'] in ('ADD_TO_CART', 'PRODUCT_DETAILS'):
+        parsed['product_name'] = ' '.join(content)
+    if parsed['intent'] == 'SEARCH':
+        parsed['search_terms'] = ' '.join(content)
+        for key, pattern in (('max_price', MAX_PRICE), ('min_price', MIN_PRICE), ('min_rating', MIN_RATING)):
+            match = pattern.search(lower)
+            if match:
+                parsed[key] = float(match.group(1))
+        if 'in stock' in lower:
+            parsed['in_stock'] = True
+        if 'cheapest' in words or 'cheap' in words:
+            parsed['sort'] = 'price_asc'
+        elif 'best' in words or 'rated' in words or 'top' in words:
+            parsed['sort'] = 'rating'
+    return parsed
+
+
+class StandInLLM:
+    """Offline LLM with canned, deterministic output.
+
+    latency is slept once per call (prompt processing / time to first token) and
+    token_latency once per generated word. `responses` maps a prompt substring to a
+    fixed reply and takes priority over the built-in rules; structured=False makes
+    the structured-intent prompt return non-JSON, exercising the fallback path.
+    """
+
+    model = "stand-in"
+
+    def __init__(self, latency: float = 0.0, token_latency: float = 0.0,
+                 responses: Optional[Dict[str, str]] = None, structured: bool = True):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.responses = responses or {}
+        self.structured = structured
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def invoke(self, prompt: str, **kwargs) -> str:
+        self._count()
+        response = self.respond(prompt)
+        if self.latency or self.token_latency:
+            time.sleep(self.latency + self.token_latency * len(response.split()))
+        return response
+
+    def stream(self, prompt: str, **kwargs) -> Iterator[str]:
+        self._count()
+        response = self.respond(prompt)
+        if self.latency:
+            time.sleep(self.latency)
+        for word in re.findall(r'\S+\s*', response):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            yield word
+
+    def respond(self, prompt: str) -> str:
+        for marker, response in self.responses.items():
+            if marker in prompt:
+                return response
+
+        message = self._user_message(prompt)
+        parsed = parse_message(message)
+        tail = prompt.rstrip()
+
+        if 'reply with ONLY a JSON object' in prompt:
+            return json.dumps(parsed) if self.structured else f"The user wants {parsed['intent'].lower()}."
+        if tail.endswith('Intent:'):
+            return parsed['intent']
+        if tail.endswith('Search terms:'):
+            return parsed['search_terms'] or message
+        if tail.endswith('Product identifier:'):
+            return parsed['product_id'] or parsed['product_name']
+        return self._reply(prompt)
+
+    def _count(self):
+        with self._lock:
+            self.calls += 1
+
+    @staticmethod
+    def _user_message(prompt: str) -> str:
+        for pattern in USER_MESSAGE_PATTERNS:
+            match = pattern.search(prompt)
+            if match:
+                return match.group(1)
+        return ''
+
+    @staticmethod
+    def _reply(prompt: str) -> str:
+        # Echo the first line of tool output so replies stay tied to the data they describe
+        body = prompt.split(':\n', 1)[-1].strip().splitlines()
+        detail = next((line.strip() for line in body if line.strip()), '')
+        return f"Happy to help! {detail} Let me know if you'd like anything else."
@@ -0,0 +1,239 @@
+"""Lightweight latency instrumentation for the chat pipeline.
+
+Timed spans around LLM calls, database methods and agent tools are aggregated into
+fixed-size latency histograms, so memory stays bounded however long the app runs:
+
+    with span("turn.classify"):
+        llm.invoke(prompt)
+
+    @instrument_class("db")
+    class EcommerceDB: ...
+
+METRICS.snapshot() gives calls and p50/p95/p99 per span name, METRICS.cache_rates()
+the hit rate of every cache reporting through count_cache(), and the most recent raw
+spans (with their parent span) can be exported as JSON Lines with export_jsonl().
+"""
+import bisect
+import functools
+import inspect
+import io
+import itertools
+import json
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO
+
+
+# Histogram bucket bounds in milliseconds: 10% apart from 1µs to ~20 minutes, so any
+# percentile is within 10% of the true value
+BUCKET_BOUNDS = [0.001 * 1.1 ** i for i in range(int(math.log(1.2e9) / math.log(1.1)) + 1)]
+
+# Raw spans kept for export; older ones are dropped
+MAX_RECENT_SPANS = 10000
+
+# Id of the innermost open span in this context, recorded as each new span's parent
+_current_span: ContextVar[Optional[int]] = ContextVar('current_span', default=None)
+_span_ids = itertools.count(1)
+
+
+class LatencyHistogram:
+    """Call count, total, max and bucketed latencies (ms) for one span name"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.errors = 0
+
+    def record(self, duration_ms: float, error: bool = False):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, duration_ms)] += 1
+        self.count += 1
+        self.total_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+        if error:
+            self.errors += 1
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th percentile (0-100), capped at the max"""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * q / 100) or 1
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max_ms, self.max_ms)
+        return self.max_ms
+
+
+class Metrics:
+    """Thread-safe registry of span histograms, cache counters and recent raw spans"""
+
+    def __init__(self, max_spans: int = MAX_RECENT_SPANS):
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        # cache name -> [hits, misses]
+        self.caches: Dict[str, List[int]] = {}
+        self.recent_spans: deque = deque(maxlen=max_spans)
+        self.enabled = True
+        self._lock = threading.Lock()
+
+    def record(self, name: str, started: float, duration_ms: float, span_id: int = None,
+               parent: Optional[int] = None, error: Optional[str] = None):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(duration_ms, error is not None)
+            self.recent_spans.append({
+                'id': span_id, 'parent': parent, 'name': name, 'start': started,
+                'duration_ms': round(duration_ms, 3), 'error': error,
+            })
+
+    def count_cache(self, name: str, hit: bool):
+        with self._lock:
+            counts = self.caches.setdefault(name, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def snapshot(self) -> List[Dict]:
+        """Per span name: calls, errors, p50/p95/p99/max and total milliseconds, slowest total first"""
+        with self._lock:
+            rows = [{
+                'step': name,
+                'calls': h.count,
+                'errors': h.errors,
+                'p50_ms': h.percentile(50),
+                'p95_ms': h.percentile(95),
+                'p99_ms': h.percentile(99),
+                'max_ms': h.max_ms,
+                'total_ms': h.total_ms,
+            } for name, h in self.histograms.items()]
+        return sorted(rows, key=lambda row: row['total_ms'], reverse=True)
+
+    def cache_rates(self) -> List[Dict]:
+        with self._lock:
+            return [{
+                'cache': name,
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            } for name, (hits, misses) in sorted(self.caches.items())]
+
+    def spans(self) -> List[Dict]:
+        with self._lock:
+            return list(self.recent_spans)
+
+    def export_jsonl(self, out: TextIO) -> int:
+        """Write the recent spans to out, one JSON object per line; returns the number written"""
+        spans = self.spans()
+        for record in spans:
+            out.write(json.dumps(record) + '\n')
+        return len(spans)
+
+    def spans_jsonl(self) -> str:
+        out = io.StringIO()
+        self.export_jsonl(out)
+        return out.getvalue()
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.caches.clear()
+            self.recent_spans.clear()
+
+
+# Process-wide registry used by span(), instrument() and the System Logs page
+METRICS = Metrics()
+
+
+@contextmanager
+def span(name: str, metrics: Metrics = METRICS):
+    """Time the enclosed block as one span of `name`; exceptions are recorded and re-raised"""
+    if not metrics.enabled:
+        yield
+        return
+    span_id = next(_span_ids)
+    token = _current_span.set(span_id)
+    started = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        _current_span.reset(token)
+        metrics.record(name, started, duration_ms, span_id, _current_span.get(), error)
+
+
+def timed_iter(name: str, chunks: Iterable, metrics: Metrics = METRICS) -> Iterator:
+    """Yield from chunks, timing everything up to the last chunk as one span (for streams).
+
+    The consumer may run other spans between chunks, so this one is never made their parent.
+    """
+    if not metrics.enabled:
+        yield from chunks
+        return
+    parent = _current_span.get()
+    started = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield from chunks
+    except GeneratorExit:
+        # The consumer stopped early; not an error
+        raise
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        metrics.record(name, started, (time.perf_counter() - start) * 1000, next(_span_ids), parent, error)
+
+
+def record_duration(name: str, duration_ms: float, metrics: Metrics = METRICS):
+    """Record a duration measured elsewhere (e.g. time saved) as a span of `name` under the current span"""
+    if metrics.enabled:
+        metrics.record(name, time.time() - duration_ms / 1000, duration_ms, next(_span_ids), _current_span.get())
+
+
+def count_cache(name: str, hit: bool, metrics: Metrics = METRICS):
+    metrics.count_cache(name, hit)
+
+
+def instrument(name: str, metrics: Metrics = METRICS):
+    """Decorator timing every call of a function as a span (generators: until exhausted)"""
+    def decorate(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                return timed_iter(name, func(*args, **kwargs), metrics)
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, metrics):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def instrument_class(prefix: str, exclude: Iterable[str] = (), metrics: Metrics = METRICS):
+    """Class decorator timing each public method defined on the class as '<prefix>.<method>'"""
+    exclude = set(exclude)
+
+    def decorate(cls):
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith('_') or attr in exclude:
+                continue
+            if isinstance(value, staticmethod):
+                setattr(cls, attr, staticmethod(instrument(f"{prefix}.{attr}", metrics)(value.__func__)))
+            elif callable(value):
+                setattr(cls, attr, instrument(f"{prefix}.{attr}", metrics)(value))
+        return cls
+    return decorate
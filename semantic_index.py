@@ -0,0 +1,266 @@
+"""Offline semantic product search.
+
+Products are embedded with a signed hashing vectorizer (words plus character trigrams,
+so "vacuums" still lands near "vacuum") into a contiguous float32 NumPy matrix, one
+L2-normalized row per product. Queries are weighted by inverse document frequency
+computed from running counts, so adding products never re-embeds existing ones.
+
+Retrieval is one matrix-vector product and an argpartition for the top k, CPU only.
+hybrid_search fuses the ranking with EcommerceDB's keyword (BM25) search.
+
+The matrix can be saved to disk and memory-mapped back, so large catalogs don't have to be
+re-embedded or held in RAM on every start:
+
+    index = SemanticIndex.build(db)
+    index.save("catalog_vectors")
+    index = SemanticIndex.load("catalog_vectors")   # memory-mapped
+"""
+import json
+import math
+import re
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Relative weight of each product field in its embedding
+FIELD_WEIGHTS = {'name': 3.0, 'tags': 2.0, 'category': 1.0, 'description': 1.0}
+
+# Character trigrams count for less than whole words
+TRIGRAM_WEIGHT = 0.5
+
+# Reciprocal-rank-fusion constant; larger values flatten the difference between ranks
+RRF_K = 60
+
+# Similarity a semantic match needs to be fused in when keyword search didn't also find it.
+# Hashed trigrams give word fragments some similarity ('headphones' scores 0.2 against
+# 'iPhone'), so a match on meaning alone has to be clearly stronger than that
+SEMANTIC_ONLY_MIN_SIMILARITY = 0.3
+
+
+def _stem(word: str) -> str:
+    # Just enough to make plurals match: 'floors' -> 'floor', but not 'glass' -> 'glas'
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def features(text: str, weight: float = 1.0) -> Dict[str, float]:
+    """Weighted word and character-trigram features of text"""
+    found: Dict[str, float] = {}
+    for word in WORD_PATTERN.findall(text.lower()):
+        word = _stem(word)
+        found[word] = found.get(word, 0.0) + weight
+        padded = f"#{word}#"
+        for i in range(len(padded) - 2):
+            trigram = padded[i:i + 3]
+            found[trigram] = found.get(trigram, 0.0) + weight * TRIGRAM_WEIGHT
+    return found
+
+
+class SemanticIndex:
+    """Hashing-vectorizer embeddings of products with vectorized top-k search.
+
+    add() appends or overwrites rows in place; the matrix grows by doubling, so existing
+    rows are copied (never re-embedded) when it fills up. Thread-safe.
+    """
+
+    def __init__(self, dim: int = 512, capacity: int = 1024):
+        self.dim = dim
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        # Documents containing each hashed feature, for query-time IDF
+        self.doc_freq = np.zeros(dim, dtype=np.float32)
+        self.ids: List[Optional[str]] = []
+        self.rows: Dict[str, int] = {}
+        # Highest products.rowid and product_changes.seq seen by sync()
+        self.last_rowid = 0
+        self.last_change = 0
+        self._lock = threading.Lock()
+        # Held for a whole sync(), so concurrent searches don't read or apply the same changes twice
+        self._sync_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def vectorize(self, weighted_texts: Iterable[Tuple[str, float]]) -> np.ndarray:
+        """Signed, sublinear-TF hashed vector of (text, weight) pairs (not normalized)"""
+        counts: Dict[str, float] = {}
+        for text, weight in weighted_texts:
+            for feature, count in features(text, weight).items():
+                counts[feature] = counts.get(feature, 0.0) + count
+
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, count in counts.items():
+            h = zlib.crc32(feature.encode('utf-8'))
+            # The top hash bit picks the sign, so collisions cancel out instead of piling up
+            sign = -1.0 if h & 0x80000000 else 1.0
+            vector[h % self.dim] += sign * (1.0 + math.log(count)) if count >= 1 else sign * count
+        return vector
+
+    def embed_product(self, product: Dict) -> np.ndarray:
+        vector = self.vectorize([
+            (product['name'], FIELD_WEIGHTS['name']),
+            (' '.join(product.get('tags') or []), FIELD_WEIGHTS['tags']),
+            (product.get('category') or '', FIELD_WEIGHTS['category']),
+            (product.get('description') or '', FIELD_WEIGHTS['description']),
+        ])
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def add(self, products: Iterable[Dict]):
+        """Embed products (dicts as returned by EcommerceDB) and store them; known ids are replaced"""
+        embedded = [(str(product['id']), self.embed_product(product)) for product in products]
+        with self._lock:
+            self._reserve(len(self.ids) + len(embedded))
+            for product_id, vector in embedded:
+                row = self.rows.get(product_id)
+                if row is None:
+                    row = len(self.ids)
+                    self.ids.append(product_id)
+                    self.rows[product_id] = row
+                else:
+                    self.doc_freq -= self.vectors[row] != 0
+                self.vectors[row] = vector
+                self.doc_freq += vector != 0
+
+    def remove(self, product_ids: Iterable[str]):
+        """Drop products from the results; their rows are zeroed, not reclaimed"""
+        with self._lock:
+            self._reserve(len(self.ids))
+            for product_id in product_ids:
+                row = self.rows.pop(str(product_id), None)
+                if row is not None:
+                    self.doc_freq -= self.vectors[row] != 0
+                    self.vectors[row] = 0
+                    self.ids[row] = None
+
+    def _reserve(self, rows: int):
+        if rows <= len(self.vectors) and self.vectors.flags.writeable:
+            return
+        # Double the capacity; a memory-mapped matrix is copied into RAM on the first add
+        grown = np.zeros((max(rows, 2 * len(self.vectors), 1024), self.dim), dtype=np.float32)
+        grown[:len(self.ids)] = self.vectors[:len(self.ids)]
+        self.vectors = grown
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """(product id, cosine similarity) of the k products closest to query, best first"""
+        query_vector = self.vectorize([(query, 1.0)])
+        with self._lock:
+            count = len(self.ids)
+            if not count or not query_vector.any():
+                return []
+            # Weight query features by IDF over the current catalog
+            query_vector *= np.log((1.0 + len(self.rows)) / (1.0 + self.doc_freq)) + 1.0
+            query_vector /= np.linalg.norm(query_vector)
+
+            scores = self.vectors[:count] @ query_vector
+            k = min(k, count)
+            top = np.argpartition(-scores, k - 1)[:k] if k < count else np.arange(count)
+            top = top[np.argsort(-scores[top])]
+            return [(self.ids[row], float(scores[row])) for row in top
+                    if scores[row] > 0 and self.ids[row] is not None]
+
+    def sync(self, db, batch_size: int = 5000) -> int:
+        """Bring the index up to date with db; returns how many products were embedded or removed.
+
+        New rows are found by rowid and edited or deleted ones through db's product_changes
+        log, so this is two indexed queries when nothing changed. Concurrent calls run one
+        after the other.
+        """
+        synced = 0
+        with self._sync_lock:
+            while True:
+                batch = db.get_products_after(self.last_rowid, batch_size)
+                if not batch:
+                    break
+                self.add(product for _, product in batch)
+                self.last_rowid = batch[-1][0]
+                synced += len(batch)
+            while True:
+                changes = db.get_product_changes_after(self.last_change, batch_size)
+                if not changes:
+                    return synced
+                self.add(product for _, _, product in changes if product is not None)
+                self.remove(product_id for _, product_id, product in changes if product is None)
+                self.last_change = changes[-1][0]
+                synced += len(changes)
+
+    @classmethod
+    def build(cls, db, dim: int = 512) -> 'SemanticIndex':
+        """Index every product in db"""
+        index = cls(dim, capacity=max(db.count_products(), 1))
+        # Every product is embedded as it is now, so earlier changes are already reflected
+        index.last_change = db.last_product_change()
+        index.sync(db)
+        return index
+
+    def save(self, path: str):
+        """Write the matrix to {path}.npy and the ids / counts to {path}.json"""
+        with self._lock:
+            np.save(f"{path}.npy", self.vectors[:len(self.ids)])
+            with open(f"{path}.json", 'w') as f:
+                json.dump({'dim': self.dim, 'ids': self.ids, 'last_rowid': self.last_rowid,
+                           'last_change': self.last_change, 'doc_freq': self.doc_freq.tolist()}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'SemanticIndex':
+        """Load an index written by save(); with mmap the matrix stays on disk until modified"""
+        with open(f"{path}.json") as f:
+            meta = json.load(f)
+        index = cls(meta['dim'], capacity=0)
+        index.vectors = np.load(f"{path}.npy", mmap_mode='r' if mmap else None)
+        index.ids = meta['ids']
+        index.rows = {product_id: row for row, product_id in enumerate(index.ids) if product_id is not None}
+        index.doc_freq = np.asarray(meta['doc_freq'], dtype=np.float32)
+        index.last_rowid = meta['last_rowid']
+        # Indexes saved before change tracking replay the whole log once
+        index.last_change = meta.get('last_change', 0)
+        return index
+
+
+def _matches_filters(product: Dict, filters: Dict) -> bool:
+    """Whether product passes search_products' category / price / rating / stock filters"""
+    return ((filters.get('category') is None or product['category'] == filters['category'])
+            and (filters.get('min_price') is None or product['price'] >= filters['min_price'])
+            and (filters.get('max_price') is None or product['price'] <= filters['max_price'])
+            and (filters.get('min_rating') is None or product['rating'] >= filters['min_rating'])
+            and (not filters.get('in_stock') or product['stock'] > 0))
+
+
+def hybrid_search(db, index: SemanticIndex, query: str, limit: int = 5, alpha: float = 0.5,
+                  candidates: int = 50, min_similarity: float = 0.1,
+                  min_semantic_only: float = SEMANTIC_ONLY_MIN_SIMILARITY, **filters) -> List[Dict]:
+    """Products ranked by a blend of keyword (BM25) and semantic rank.
+
+    Uses weighted reciprocal rank fusion over the top `candidates` of each ranking: alpha=1
+    is purely semantic, alpha=0 purely keyword. Semantic matches below min_similarity are
+    dropped so weak neighbours don't pad out precise keyword results, and ones keyword search
+    didn't find need min_semantic_only, so a shared word fragment alone can't surface an
+    unrelated product. filters are
+    search_products' category / price / rating / stock filters and apply to both rankings.
+    """
+    keyword = db.search_products(query, limit=candidates, **filters)
+    products = {product['id']: product for product in keyword}
+    semantic = [(product_id, score) for product_id, score in index.search(query, candidates)
+                if score >= (min_similarity if product_id in products else min_semantic_only)]
+    if filters and semantic:
+        missing = [product_id for product_id, _ in semantic if product_id not in products]
+        products.update(db.get_products(missing))
+        semantic = [(product_id, score) for product_id, score in semantic
+                    if product_id in products and _matches_filters(products[product_id], filters)]
+
+    scores: Dict[str, float] = {}
+    for rank, product in enumerate(keyword):
+        scores[product['id']] = (1 - alpha) / (RRF_K + rank)
+    for rank, (product_id, _) in enumerate(semantic):
+        scores[product_id] = scores.get(product_id, 0.0) + alpha / (RRF_K + rank)
+
+    best = sorted(scores, key=scores.get, reverse=True)[:limit]
+    missing = [product_id for product_id in best if product_id not in products]
+    if missing:
+        products.update(db.get_products(missing))
+    return [products[product_id] for product_id in best if product_id in products]
@@ -0,0 +1,134 @@
+"""Cold-start benchmark for the Streamlit app.
+
+Every run starts a fresh interpreter with an empty database and LLM cache, so nothing
+is already imported or cached, and measures:
+
+- import_ms: `import app`, plus which heavy modules (LangChain, pandas, NumPy) it pulled in
+- first_render_ms: the first script run of the default page, through Streamlit's headless
+  AppTest runner (what a new visitor waits for)
+- rerun_ms: the next run of the same page, with process-wide resources already built
+- page_ms: the first render of each other page
+
+    python startup_benchmark.py --runs 5 --output startup_results.json
+
+Results are written as JSON so two runs can be diffed.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from typing import Dict, List
+
+PAGES = ["AI Chat Interface", "Product Database", "Cart & Wishlist", "Agent Testing", "System Logs"]
+
+# Modules that should only load once a feature needs them
+HEAVY_MODULES = ['langchain', 'langchain_ollama', 'langchain_core', 'pandas', 'numpy']
+
+# Runs in the child interpreter; argv[1] is the JSON list of pages to render
+CHILD = '''
+import json, sys, time
+started = time.perf_counter()
+import app
+result = {'import_ms': (time.perf_counter() - started) * 1000,
+          'heavy_modules': [m for m in json.loads(sys.argv[2]) if m in sys.modules]}
+pages = json.loads(sys.argv[1])
+if pages:
+    from streamlit.testing.v1 import AppTest
+    test = AppTest.from_file(app.__file__, default_timeout=120)
+    started = time.perf_counter()
+    test.run()
+    result['first_render_ms'] = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    test.run()
+    result['rerun_ms'] = (time.perf_counter() - started) * 1000
+    result['page_ms'] = {}
+    for page in pages[1:]:
+        started = time.perf_counter()
+        test.sidebar.selectbox[0].set_value(page).run()
+        result['page_ms'][page] = (time.perf_counter() - started) * 1000
+    result['render_errors'] = [str(e.value) for e in test.exception]
+print(json.dumps(result))
+'''
+
+
+def measure_once(pages: List[str]) -> Dict:
+    """One cold start in a child process, against a throwaway database and cache"""
+    with tempfile.TemporaryDirectory() as scratch:
+        env = dict(os.environ,
+                   ECOMMERCE_DB_PATH=os.path.join(scratch, 'ecommerce.db'),
+                   LLM_CACHE_PATH=os.path.join(scratch, 'llm_cache.db'),
+                   SEMANTIC_INDEX_PATH='')
+        completed = subprocess.run(
+            [sys.executable, '-c', CHILD, json.dumps(pages), json.dumps(HEAVY_MODULES)],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True, check=True
+        )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def summarize(samples: List[float]) -> Dict:
+    return {'median': statistics.median(samples), 'min': min(samples), 'max': max(samples)}
+
+
+def run_startup_benchmark(runs: int, pages: List[str]) -> Dict:
+    measurements = [measure_once(pages) for _ in range(runs)]
+    summary = {
+        'runs': runs,
+        'import_ms': summarize([m['import_ms'] for m in measurements]),
+        'heavy_modules_at_import': measurements[0]['heavy_modules'],
+    }
+    if pages:
+        summary['first_render_ms'] = summarize([m['first_render_ms'] for m in measurements])
+        summary['rerun_ms'] = summarize([m['rerun_ms'] for m in measurements])
+        summary['page_ms'] = {page: summarize([m['page_ms'][page] for m in measurements]) for page in pages[1:]}
+        summary['render_errors'] = sorted({error for m in measurements for error in m['render_errors']})
+    return summary
+
+
+def format_summary(summary: Dict) -> str:
+    lines = [
+        f"import app        median={summary['import_ms']['median']:.1f}ms  max={summary['import_ms']['max']:.1f}ms  "
+        f"heavy modules loaded: {', '.join(summary['heavy_modules_at_import']) or 'none'}"
+    ]
+    if 'first_render_ms' in summary:
+        lines.append(f"first render      median={summary['first_render_ms']['median']:.1f}ms  "
+                     f"max={summary['first_render_ms']['max']:.1f}ms")
+        lines.append(f"rerun             median={summary['rerun_ms']['median']:.1f}ms")
+        for page, timing in summary['page_ms'].items():
+            lines.append(f"  {page:<16} median={timing['median']:.1f}ms")
+        for error in summary['render_errors']:
+            lines.append(f"  render error: {error}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="cold starts to measure")
+    parser.add_argument('--pages', nargs='*', default=PAGES, choices=PAGES,
+                        help="pages to render, default page first (none: measure the import only)")
+    parser.add_argument('--output', default='startup_results.json', help="where to write the JSON results")
+    args = parser.parse_args()
+
+    summary = run_startup_benchmark(args.runs, args.pages)
+    print(format_summary(summary))
+
+    results = {
+        'meta': {
+            'created_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'startup': summary,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
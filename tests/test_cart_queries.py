@@ -0,0 +1,50 @@
+"""A cart or wishlist view costs the same number of SQL statements whatever its size."""
+import pytest
+
+from app import EcommerceDB, EcommerceTools, Product
+
+CART_SIZES = [1, 5, 25, 100]
+
+
+@pytest.fixture
+def db(monkeypatch):
+    # The background recommendation refresher would add its own statements to query_count
+    monkeypatch.setattr(EcommerceDB, 'schedule_recommendation_refresh', lambda self, product_ids=(): None)
+    db = EcommerceDB(sample_data=False)
+    db.upsert_products(Product(str(i), f"Product {i}", "Misc", 10.0 + i, "", 1000, 4.0, ["misc"])
+                       for i in range(max(CART_SIZES)))
+    return db
+
+
+def statements(db, view) -> int:
+    before = db.query_count
+    view()
+    return db.query_count - before
+
+
+def fill(db, user_id: str, size: int):
+    db.add_user(user_id, user_id)
+    for i in range(size):
+        db.add_to_cart(user_id, str(i), 1 + i % 3)
+        db.add_to_wishlist(user_id, str(i))
+
+
+def test_cart_view_statements_do_not_grow_with_cart_size(db):
+    counts = {}
+    for size in CART_SIZES:
+        user_id = f"user{size}"
+        fill(db, user_id, size)
+        tools = EcommerceTools(db, user_id=user_id)
+        counts[size] = statements(db, tools.get_cart_tool)
+        assert len(db.get_user_cart(user_id)) == size
+    assert len(set(counts.values())) == 1, counts
+
+
+def test_wishlist_statements_do_not_grow_with_wishlist_size(db):
+    counts = {}
+    for size in CART_SIZES:
+        user_id = f"user{size}"
+        fill(db, user_id, size)
+        counts[size] = statements(db, lambda: db.get_user_wishlist(user_id))
+    assert len(set(counts.values())) == 1, counts
+